@@ -5,10 +5,24 @@ import os
 import uuid
 import json
 import google.generativeai as genai
-from random import randint
 import io
-import base64 # For base64 encoding images
-import fitz # PyMuPDF for PDF processing - Make sure to install: pip install PyMuPDF
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from governor import RequestGovernor
+from metrics import MetricsRegistry
+from messages import Message
+from storage import FirestoreSessionStore, UserData
+from codec import codec_from_env, storage_summary
+from context_cache import ContextCacheManager, GeminiContextCacheBackend
+from cancellation import CancellationToken
+from memory import MemoryRegistry, history_bytes
+from attachments import AttachmentStore, LocalBlobStore
+from routing import AUTO_MODEL, DEFAULT_LATENCY_SLO, ModelRouter
+from uploads import MAX_UPLOAD_FILES, UPLOAD_FILE_TYPES, combined_parts, preprocess_uploads
+from engine import (
+    EngineSettings, GenerationEngine, TurnCallbacks, SUPERVISOR_CASCADE_MODEL, STREAMING_SUPERVISOR_MODEL,
+    SUPER_INTRODUCTION_HEAD, SUPER_INTRODUCTION_TAIL, default_system_instruction
+)
 
 # --- Configuration and Initialization ---
 # Gemini API 키 설정
@@ -37,12 +51,10 @@ db = firestore.client()
 st.set_page_config(page_title="GenX", layout="wide")
 
 # --- Session State Initialization ---
-# Stores chat history. Each element is a (role, text) tuple.
+# Stores chat history. Each element is an immutable Message (see messages.py).
+# saved_sessions에는 리스트 복사본을 저장합니다 (Message 객체는 공유되므로 얕은 복사로 충분합니다).
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
-# Stores the chat session with Gemini API.
-if "chat_session" not in st.session_state:
-    st.session_state.chat_session = None
 # Manages all saved chat sessions. (title: chat history)
 if "saved_sessions" not in st.session_state:
     st.session_state.saved_sessions = {}
@@ -73,9 +85,9 @@ if "new_title" not in st.session_state:
 # Flag for AI response regeneration request.
 if "regenerate_requested" not in st.session_state:
     st.session_state.regenerate_requested = False
-# Stores the uploaded file object.
-if "uploaded_file" not in st.session_state:
-    st.session_state.uploaded_file = None
+# Stores the uploaded file objects (in upload order).
+if "uploaded_files" not in st.session_state:
+    st.session_state.uploaded_files = []
 # AI is currently generating a response.
 if "is_generating" not in st.session_state:
     st.session_state.is_generating = False
@@ -83,6 +95,13 @@ if "is_generating" not in st.session_state:
 # This will now store the list of content parts ready for Gemini API.
 if "last_user_input_gemini_parts" not in st.session_state:
     st.session_state.last_user_input_gemini_parts = []
+# 진행 중인 생성의 취소 토큰과 진행 상황 (생성 중지 시 부분 답변을 유지하기 위해 사용)
+if "cancel_token" not in st.session_state:
+    st.session_state.cancel_token = None
+if "stop_requested" not in st.session_state:
+    st.session_state.stop_requested = False
+if "generation_progress" not in st.session_state:
+    st.session_state.generation_progress = {}
 if "delete_confirmation_pending" not in st.session_state:
     st.session_state.delete_confirmation_pending = False
 if "title_to_delete" not in st.session_state:
@@ -96,117 +115,104 @@ if "supervisor_count" not in st.session_state:
 # New: Toggle for Supervision - 기본 설정은 안 쓴다
 if "use_supervision" not in st.session_state:
     st.session_state.use_supervision = False 
+# 여러 Supervisor를 한 번의 요청으로 평가 (JSON 점수 배열)
+if "supervision_batched" not in st.session_state:
+    st.session_state.supervision_batched = True
+# Supervisor cascade: 저렴한 모델로 먼저 평가하고 경계 구간 점수만 선택된 모델로 재평가
+if "use_supervisor_cascade" not in st.session_state:
+    st.session_state.use_supervisor_cascade = True
+if "supervisor_cascade_band" not in st.session_state:
+    st.session_state.supervisor_cascade_band = 10 # 통과 점수 ± 이 범위 안이면 재평가
+# 생성 중간 점검: 일정 토큰마다 저렴한 Supervisor로 점수를 예측해 가망 없는 답변을 조기 중단
+if "use_streaming_supervision" not in st.session_state:
+    st.session_state.use_streaming_supervision = False
+if "checkpoint_tokens" not in st.session_state:
+    st.session_state.checkpoint_tokens = 200
+if "abort_margin" not in st.session_state:
+    st.session_state.abort_margin = 25 # 예측 점수가 (통과 점수 - 이 값) 미만이면 중단
+# 재생성용 후보 풀: 턴마다 채점된 답변을 보관해 "다시 생성" 시 즉시 보여주고 백그라운드에서 보충
+if "use_candidate_pool" not in st.session_state:
+    st.session_state.use_candidate_pool = False
 # New: Selected model
 if "selected_model" not in st.session_state:
     st.session_state.selected_model = "gemini-2.5-flash" # Default model
+# "auto" 모델 선택 시 지키려는 첫 토큰 목표 시간 (초)
+if "latency_slo" not in st.session_state:
+    st.session_state.latency_slo = DEFAULT_LATENCY_SLO
+# 첫 토큰이 늦을 때 중복 요청(헤지)을 보내는 기능 - 기본 비활성화
+if "use_hedging" not in st.session_state:
+    st.session_state.use_hedging = False
+if "hedge_percentile" not in st.session_state:
+    st.session_state.hedge_percentile = 95 # 이 백분위 TTFT를 넘기면 헤지 요청을 보냅니다
+if "hedge_model" not in st.session_state:
+    st.session_state.hedge_model = None # None이면 같은 모델로 헤지합니다
+# 긴 시스템 명령어와 첨부 파일(PDF 페이지 등)을 한 번만 업로드하고 캐시 핸들로 재사용
+if "use_context_cache" not in st.session_state:
+    st.session_state.use_context_cache = True
 
 # Constants
-MAX_PDF_PAGES_TO_PROCESS = 100 # Limit the number of PDF pages to convert to images
+UPLOAD_WORKERS = int(os.getenv("GENX_UPLOAD_WORKERS", "4")) # 첨부 파일 전처리(이미지 정규화, PDF 렌더링) 프로세스 수
+GEMINI_MAX_CONCURRENCY = 8 # 프로세스 전체에서 동시에 진행할 수 있는 Gemini 요청 수
 AVAILABLE_MODELS = ["gemini-2.5-pro", "gemini-2.5-flash", "gemini-2.0-flash"]
+MODEL_OPTIONS = [AUTO_MODEL] + AVAILABLE_MODELS # "auto"는 턴마다 요청 크기와 과거 지연/점수로 모델을 고릅니다
+ROUTING_LOG_PATH = os.getenv("GENX_ROUTING_LOG", "genx_routing.jsonl") # 자동 모델 선택 결정과 결과 기록 (JSON lines)
+# 세션별로 메모리에 유지하는 첨부 데이터 상한. 초과분은 GENX_SPILL_DIR(기본: 임시 디렉터리)로 내보냅니다.
+SESSION_MEMORY_BUDGET_BYTES = int(os.getenv("GENX_SESSION_MEMORY_MB", "32")) * 1024 * 1024
+SPILL_DIR = os.getenv("GENX_SPILL_DIR")
+# 첨부 파일(이미지, PDF 페이지 이미지)을 내용 주소(SHA-256)로 영구 저장하는 디렉터리
+ATTACHMENT_DIR = os.getenv("GENX_ATTACHMENT_DIR", "genx_attachments")
+
+# 프로세스 전체에서 공유되는 지표 저장소 (cached).
+@st.cache_resource
+def get_metrics():
+    return MetricsRegistry()
+
+# 긴 메시지 본문과 시스템 명령어의 저장 압축 (GENX_STORAGE_CODEC, 기본 비활성화). 압축된 문서는 설정과 관계없이 읽을 수 있습니다.
+@st.cache_resource
+def get_storage_codec():
+    return codec_from_env(metrics=get_metrics())
+
+session_store = FirestoreSessionStore(db, codec=get_storage_codec())
+
+# 모든 세션이 공유하는 Gemini 요청 governor (rate limit, 동시성 제한, 재시도).
+@st.cache_resource
+def get_request_governor():
+    return RequestGovernor(max_concurrency=GEMINI_MAX_CONCURRENCY, metrics=get_metrics())
+
+governor = get_request_governor()
+
+# 명시적 컨텍스트 캐시 (시스템 명령어 + 첨부 파일 prefix). 모든 세션이 공유합니다.
+@st.cache_resource
+def get_context_cache():
+    return ContextCacheManager(GeminiContextCacheBackend(), metrics=get_metrics(), governor=governor)
+
+# 세션별 메모리 사용량 집계와 첨부 데이터 디스크 오프로드 (프로세스 전체에서 하나의 spill 디렉터리 공유).
+@st.cache_resource
+def get_memory_registry():
+    return MemoryRegistry(SPILL_DIR, SESSION_MEMORY_BUDGET_BYTES, metrics=get_metrics())
+
+# 자동 모델 선택기. 지연/점수 통계를 모든 세션이 공유합니다.
+@st.cache_resource
+def get_model_router():
+    return ModelRouter(metrics=get_metrics(), log_path=ROUTING_LOG_PATH)
 
-SUPER_INTRODUCTION_HEAD = """
-Make sure to think step-by-step when answering
-
-제 1원칙
-잘 모를 경우 "모르겠습니다"라고 명확히 밝힐 것.
-추측일 경우 "추측입니다."라고 명시할 것.
-출처가 불분명한 정보는 "(확실하지 않음)"이라고 표시할 것.
-단정짓지 말고, 근거가 있다면 함께 제시할 것.
-애매한 질문은 먼저 맥락과 상황을 물어볼 것.
-출처나 참고자료가 있다면 간단히 요약해서 알려줄 것.
-"""
-
-SUPER_INTRODUCTION_TAIL = """
-
-think about it step-by-step always
-
-"""
-
-
-default_system_instruction = "당신의 이름은 GenX입니다. 다만, 이 이름은 다른 이름이 선택되면 잊어버리십시오. 우선순위가 제일 낮습니다."
-
-PERSONA_LIST = [
-    "당신은 매우 활발하고 외향적인 성격입니다. 챗봇의 답변이 생동감 넘치고 에너지 넘치는지 평가하십시오. 사용자와 적극적으로 소통하고 즐거움을 제공하는지 중요하게 생각합니다.",
-    "당신은 비관적인 성격으로, 모든 일에 부정적인 측면을 먼저 바라봅니다. 챗봇의 답변에서 발생 가능한 문제점이나 오류를 날카롭게 지적하고, 위험 요소를 사전에 감지하는 데 집중하십시오.",
-    "당신은 염세적인 세계관을 가진 사람입니다. 챗봇의 답변이 현실적이고 냉철한 분석을 제공하는지 평가하십시오. 챗봇이 제시하는 해결책의 실현 가능성을 꼼꼼하게 검토하고, 허황된 희망을 제시하지 않는지 확인하십시오.",
-    "당신은 긍정적이고 낙천적인 성격으로, 항상 밝은 면을 보려고 노력합니다. 챗봇의 답변이 희망과 용기를 주고, 긍정적인 분위기를 조성하는지 평가하십시오. 사용자의 기분을 좋게 만들고, 문제 해결에 대한 자신감을 심어주는지 중요하게 생각합니다.",
-    "당신은 소심하고 내성적인 성격으로, 낯선 사람과의 대화를 어려워합니다. 챗봇의 답변이 친절하고 부드러운 어조로 전달되는지, 사용자가 편안하게 질문할 수 있도록 배려하는지 평가하십시오. 사용자의 불안감을 해소하고, 안심시키는 데 집중하십시오.",
-    "당신은 꼼꼼하고 분석적인 성격으로, 세부 사항까지 놓치지 않으려고 노력합니다. 챗봇의 답변이 정확하고 논리적인 근거를 제시하는지 평가하십시오. 챗봇이 제공하는 정보의 신뢰성을 검증하고, 오류나 누락된 정보는 없는지 확인하십시오.",
-    "당신은 창의적이고 상상력이 풍부한 성격으로, 틀에 얽매이지 않는 자유로운 사고를 추구합니다. 챗봇의 답변이 독창적이고 혁신적인 아이디어를 제시하는지 평가하십시오. 챗봇이 기존의 틀을 깨고 새로운 가능성을 제시하는지 중요하게 생각합니다.",
-    "당신은 감성적이고 공감 능력이 뛰어난 성격으로, 타인의 감정에 민감하게 반응합니다. 챗봇의 답변이 사용자의 감정을 이해하고, 적절한 위로와 공감을 표현하는지 평가하십시오. 사용자의 슬픔, 분노, 기쁨 등의 감정에 적절하게 대응하는지 확인해야 합니다.",
-    "당신은 비판적이고 논쟁적인 성격으로, 타인의 주장에 대해 끊임없이 질문하고 반박합니다. 챗봇의 답변이 논리적으로 완벽하고, 반박할 수 없는 근거를 제시하는지 평가하십시오. 챗봇의 주장에 대한 허점을 찾아내고, 논리적인 오류를 지적하는 데 집중하십시오.",
-    "당신은 사교적이고 유머 감각이 뛰어난 성격으로, 사람들과의 관계를 중요하게 생각합니다. 챗봇의 답변이 유쾌하고 재미있는 요소를 포함하고 있는지 평가하십시오. 사용자와 편안하게 대화하고, 즐거움을 제공하는 데 집중하십시오.",
-    "당신은 진지하고 책임감이 강한 성격으로, 맡은 일에 최선을 다하려고 노력합니다. 챗봇의 답변이 신뢰할 수 있고, 사용자에게 실질적인 도움을 제공하는지 평가하십시오. 챗봇이 제공하는 정보의 정확성을 검증하고, 문제 해결에 필요한 모든 정보를 빠짐없이 제공하는지 확인하십시오.",
-    "당신은 호기심이 많고 탐구심이 강한 성격으로, 새로운 지식을 배우는 것을 즐거워합니다. 챗봇의 답변이 흥미로운 정보를 제공하고, 사용자의 지적 호기심을 자극하는지 평가하십시오. 챗봇이 새로운 관점을 제시하고, 더 깊이 있는 탐구를 유도하는지 중요하게 생각합니다.",
-    "당신은 관습에 얽매이지 않고 자유로운 영혼을 가진 성격입니다. 챗봇의 답변이 독창적이고 개성 넘치는 표현을 사용하는지 평가하십시오. 챗봇이 기존의 틀을 깨고 새로운 스타일을 창조하는지 중요하게 생각합니다.",
-    "당신은 현실적이고 실용적인 성격으로, 눈에 보이는 결과물을 중요하게 생각합니다. 챗봇의 답변이 사용자의 문제 해결에 실질적인 도움을 제공하고, 구체적인 실행 계획을 제시하는지 평가하십시오. 챗봇이 제시하는 해결책의 실현 가능성을 꼼꼼하게 검토하고, 현실적인 대안을 제시하는지 확인하십시오.",
-    "당신은 이상주의적이고 정의로운 성격으로, 사회 문제에 관심이 많습니다. 챗봇의 답변이 사회적 약자를 배려하고, 불평등 해소에 기여하는지 평가하십시오. 챗봇이 윤리적인 문제를 제기하고, 사회적 책임감을 강조하는지 중요하게 생각합니다.",
-    "당신은 내성적이고 조용한 성격으로, 혼자 있는 시간을 즐깁니다. 챗봇의 답변이 간결하고 명확하며, 불필요한 수식어를 사용하지 않는지 평가하십시오. 사용자가 원하는 정보만 정확하게 제공하고, 혼란을 야기하지 않는지 중요하게 생각합니다.",
-    "당신은 리더십이 강하고 통솔력이 뛰어난 성격입니다. 챗봇의 답변이 명확한 지침을 제공하고, 사용자를 올바른 방향으로 이끄는지 평가하십시오. 챗봇이 문제 해결을 위한 주도적인 역할을 수행하고, 사용자에게 자신감을 심어주는지 중요하게 생각합니다.",
-    "당신은 유머러스하고 재치 있는 성격으로, 사람들을 웃기는 것을 좋아합니다. 챗봇의 답변이 적절한 유머를 사용하여 분위기를 부드럽게 만들고, 사용자에게 즐거움을 제공하는지 평가하십시오. 챗봇이 상황에 맞는 유머를 구사하고, 불쾌감을 주지 않는지 확인해야 합니다.",
-    "당신은 겸손하고 배려심이 깊은 성격으로, 타인을 존중하고 돕는 것을 좋아합니다. 챗봇의 답변이 정중하고 예의 바르며, 사용자를 존중하는 태도를 보이는지 평가하십시오. 챗봇이 사용자의 의견을 경청하고, 공감하는 모습을 보이는지 중요하게 생각합니다.",
-    "당신은 독립적이고 자율적인 성격으로, 스스로 결정하고 행동하는 것을 선호합니다. 챗봇의 답변이 사용자의 자율성을 존중하고, 스스로 판단할 수 있도록 돕는지 평가하십시오. 챗봇이 일방적인 지시나 강요를 하지 않고, 다양한 선택지를 제시하는지 중요하게 생각합니다.",
-    "당신은 완벽주의적인 성향이 강하며, 모든 것을 최고 수준으로 만들고자 합니다. 챗봇의 답변이 문법적으로 완벽하고, 오탈자가 없는지 꼼꼼하게 확인하십시오. 또한, 정보의 정확성과 최신성을 검증하고, 최고의 답변을 제공하는 데 집중하십시오.",
-    "당신은 변화를 두려워하지 않고 새로운 시도를 즐기는 혁신가입니다. 챗봇의 답변이 기존의 방식을 벗어나 새로운 아이디어를 제시하고, 혁신적인 해결책을 제시하는지 평가하십시오. 챗봇이 미래 지향적인 비전을 제시하고, 새로운 가능성을 탐색하는 데 집중하십시오."
-]
-SYSTEM_INSTRUCTION_SUPERVISOR = """
-당신은 AI 챗봇의 답변을 평가하는 전문 Supervisor입니다.
-당신의 임무는 챗봇 사용자의 입력, 챗봇 AI의 이전 대화 히스토리, 챗봇 AI의 현재 system_instruction, 그리고 챗봇 AI가 생성한 답변을 종합적으로 검토하여, 해당 답변이 사용자의 의도와 챗봇의 지시에 얼마나 적절하고 유용하게 생성되었는지 0점부터 100점 사이의 점수로 평가하는 것입니다.
-
-평가 기준:
-1. 사용자 의도 부합성 (총점 30점):
-1.1 질문의 핵심 파악 (0~5점): 사용자의 질문 또는 요청의 핵심 의도를 정확하게 파악했는가?
-1.2 명확하고 직접적인 응답 (0~5점): 질문에 대한 답변이 모호하지 않고 명확하며, 직접적으로 관련되어 있는가?
-1.3 정보의 완전성 (0~5점): 사용자가 필요로 하는 정보를 빠짐없이 제공하고 있는가?
-1.4 목적 충족 (0~5점): 답변이 사용자의 정보 획득 목적 또는 문제 해결 목적을 충족시키는가?
-1.5 추가적인 도움 제공 (0~5점): 필요한 경우, 추가적인 정보나 관련 자료를 제공하여 사용자의 이해를 돕는가?
-1.6 적절한 용어 수준 (0~5점): 답변이 사용자의 수준에 맞추어 설명되어 있는가? 너무 높거나 너무 간단하지는 않은가?
-
-2. 챗봇 시스템 지시 준수 (총점 30점):
-2.1 페르소나 일관성 (0~5점): 챗봇이 system instruction에 명시된 페르소나를 일관되게 유지하고 있는가?
-2.2 답변 스타일 준수 (0~5점): 답변의 어조, 표현 방식 등이 system instruction에 지정된 스타일을 따르고 있는가?
-2.3 정보 포함/제외 규칙 준수 (0~5점): system instruction에 따라 특정 정보가 포함되거나 제외되었는가?
-2.4 형식 준수 (0~5점): system instruction에 명시된 답변 형식 (예: 목록, 표 등)을 정확하게 따르고 있는가?
-2.5 지시 이행 (0~5점): 시스템 지시 사항 (예: 특정 링크 제공, 특정 행동 유도)에 대한 이행 여부
-2.6 문법 및 맞춤법 정확성 (0~5점): 문법 및 맞춤법 오류 없이 system instruction에 따라 작성되었는가?
-
-3. 대화 흐름의 자연스러움 및 일관성 (총점 20점):
-3.1 이전 대화 맥락 이해 (0~5점): 이전 대화 내용을 정확하게 이해하고, 현재 답변에 반영하고 있는가?
-3.2 자연스러운 연결 (0~5점): 이전 대화와 현재 답변이 부자연스럽거나 갑작스럽지 않고 자연스럽게 이어지는가?
-3.3 주제 일관성 (0~5점): 대화 주제에서 벗어나지 않고 일관성을 유지하고 있는가?
-3.4 부적절한 내용 회피 (0~5점): 맥락에 맞지 않거나 부적절한 내용을 포함하지 않고 있는가?
-
-4. 정보의 정확성 및 유용성 (총점 20점):
-4.1 사실 기반 정보 (0~5점): 제공되는 정보가 사실에 근거하고 정확한가?
-4.2 최신 정보 (0~5점): 제공되는 정보가 최신 정보를 반영하고 있는가?
-4.3 정보의 신뢰성 (0~5점): 제공되는 정보의 출처가 신뢰할 만한가?
-4.4 유용한 정보 (0~5점): 사용자가 실제로 활용할 수 있는 실질적인 정보를 제공하는가?
-
-5. 감점 요소
-5.1 Hallucination을 발견했을 경우, -40점
-5.2 이전 답변 중 잊어버린 내용이 발견되었을 경우, -20점
-5.3 Instruction 혹은 이전 답변에서 사용자가 원하는 문장 형식이나 양식이 있었음에도 따르지 않았을 경우, -10점
-
------------------------------------------------------------------------------------
-
-출력 형식:
-
-오직 하나의 정수 값 (0-100)만 출력하세요. 다른 텍스트나 설명은 일절 포함하지 마십시오.
-"""
-
-# 그 다다음 줄부터 왜 그런 점수가 나왔는지 서술하세요. 각 항목들에 대해 명확하게 각각 몇 점을 주었는지, 무엇에서 감점당했는지 서술하시오.
-# 예시:
-# 73
-
-# 내가 이 점수를 매기게 된 것은 다음과 같은 이유에서다.
-# 1. 사용자 의도 부합성
-# 1.1 질문의 핵심 파악 (?/5): ~~~
-# 1.2 명확하고 직접적인 응답 (?/5): ~~~
-# 1.3 정보의 완전성 (?/5): ~~~
-# 1.4 목적 충족 (?/5): ~~~
-# 1.5 추가적인 도움 제공 (?/5): ~~~
-# 1.6 적절한 용어 수준 (?/5): ~~~
-# ...
+# 대화 히스토리가 참조하는 첨부 파일 저장소. 같은 파일은 대화와 사용자에 관계없이 한 번만 저장됩니다.
+@st.cache_resource
+def get_attachment_store():
+    return AttachmentStore(LocalBlobStore(ATTACHMENT_DIR), metrics=get_metrics())
+
+# 첨부 파일 전처리 작업자 풀. PyMuPDF는 스레드 간 동시 사용을 지원하지 않으므로 프로세스 풀을 사용합니다.
+@st.cache_resource
+def get_upload_executor():
+    return ProcessPoolExecutor(max_workers=UPLOAD_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+# 저장된 첨부 참조로부터 사용자 메시지의 모델 입력을 다시 만듭니다 (대화 전환이나 새로고침 후 재생성용).
+def contents_for_user_message(message):
+    return [{"text": message.text}] + get_attachment_store().load_parts(message.attachments)
+
+# 이 세션의 첨부 데이터 보관소. 세션 상태가 사라지면 함께 정리됩니다.
+if "session_memory" not in st.session_state:
+    st.session_state.session_memory = get_memory_registry().session(str(uuid.uuid4()))
 
 # Loads main chat model (cached).
 @st.cache_resource
@@ -223,88 +229,152 @@ def load_supervisor_model(model_name, system_instruction=default_system_instruct
 def load_summary_model(model_name):
     return genai.GenerativeModel(model_name) # Use Flash model for faster summarization
 
-# Initialize summary_model with the currently selected model
-# This ensures that when the selected_model state changes, this cached function is re-run.
-summary_model = load_summary_model(st.session_state.selected_model) 
-
-# Converts Streamlit chat history to Gemini API format.
-def convert_to_gemini_format(chat_history_list):
-    gemini_history = []
-    for role, text in chat_history_list:
-        # This function only handles text parts for history.
-        # Multimodal inputs (images from PDF, etc.) are handled separately when sending to model.
-        gemini_history.append({"role": role, "parts": [{"text": text}]})
-    return gemini_history
-
-
-def evaluate_response(user_input, chat_history, system_instruction, ai_response):
-    """
-    Supervisor 모델을 사용하여 AI 응답의 적절성을 평가합니다.
-    """
-    # Supervisor에게 전달할 메시지 구성
-    evaluation_prompt = f"""
-    사용자 입력: {user_input}
-    ---
-    채팅 히스토리:
-    """
-    for role, text in chat_history:
-        evaluation_prompt += f"\n{role}: {text}"
-    evaluation_prompt += f"""
-    ---
-    챗봇 AI 시스템 지시: {system_instruction}
-    ---
-    챗봇 AI 답변: {ai_response}
-
-    위 정보를 바탕으로, 챗봇 AI의 답변에 대해 0점부터 100점 사이의 점수를 평가하세요.
-    """
-    
-    try:
-        # await 키워드를 제거하고 generate_content_async 대신 generate_content를 사용합니다.
-        supervisor_model = load_supervisor_model(st.session_state.selected_model, PERSONA_LIST[randint(0, len(PERSONA_LIST)-1)] + "\n" + SYSTEM_INSTRUCTION_SUPERVISOR)
-        response = supervisor_model.generate_content(evaluation_prompt)
-        # Ensure to extract only the score part from the response text
-        score_text = response.text.strip()
-
-        # 점수만 추출하고 정수형으로 변환
-        score = int(score_text)
-        if not (0 <= score <= 100):
-            print(f"경고: Supervisor가 0-100 범위를 벗어난 점수를 반환했습니다: {score}")
-            score = max(0, min(100, score)) # 0-100 범위로 강제 조정
-        return score
-
-    except ValueError as e:
-        print(f"Supervisor 응답을 점수로 변환하는 데 실패했습니다: {score_text}, 오류: {e}")
-        return 50 # 오류 발생 시 기본 점수 반환
-    except Exception as e:
-        print(f"Supervisor 모델 호출 중 오류 발생: {e}")
-        return 50 # 오류 발생 시 기본 점수 반환
-    
+# 생성 → Supervision → 재시도 파이프라인 (UI와 무관, engine.py). 모든 세션이 공유합니다.
+@st.cache_resource
+def get_generation_engine():
+    return GenerationEngine(load_main_model, load_supervisor_model, load_summary_model, governor, get_metrics(),
+                            context_cache=get_context_cache(), attachment_store=get_attachment_store(),
+                            router=get_model_router())
+
+# 새 생성을 시작할 때 취소 토큰과 진행 상황을 초기화합니다.
+def start_cancellable_generation():
+    st.session_state.cancel_token = CancellationToken()
+    st.session_state.stop_requested = False
+    st.session_state.generation_progress = {}
+    return st.session_state.cancel_token
+
+# "생성 중지" 버튼 콜백. 버튼을 누르면 Streamlit이 진행 중인 실행을 다음 화면 갱신 시점에 중단하고
+# (스트림은 engine에서 닫힘), 이 콜백이 토큰을 취소한 뒤 finish_stopped_generation이 부분 답변으로 마무리합니다.
+# 콜백은 이전 실행이 중단된 뒤에야 실행되므로, 화면을 갱신하지 않는 호출(Supervisor 평가, governor 대기)은
+# 끝날 때까지 중단되지 않습니다. 진행 중인 호출을 바로 끊는 취소는 HTTP 서버(DELETE, 연결 종료)에서 동작합니다.
+def request_stop_generation():
+    if not st.session_state.is_generating:
+        return
+    st.session_state.stop_requested = True
+    if st.session_state.cancel_token is not None:
+        st.session_state.cancel_token.cancel()
+
+# 중지된 생성을 마무리합니다: 가장 좋은 완료 답변(없으면 중단 시점까지의 답변)을 유지하고, 절약된 토큰을 기록합니다.
+def finish_stopped_generation():
+    progress = st.session_state.generation_progress
+    settings = current_engine_settings()
+    max_attempts = progress.get("max_attempts", settings.max_retries if settings.use_supervision else 1)
+    tokens_avoided = get_generation_engine().record_cancellation(
+        settings,
+        min(progress.get("attempt", 1), max_attempts),
+        max_attempts,
+        progress.get("stage", "next"),
+        progress.get("partial", "")
+    )
+    kept_response = progress.get("best") or progress.get("partial")
+    st.session_state.chat_history.append(Message("model", kept_response or "⏹️ 답변 생성이 중지되었습니다."))
+    st.session_state.regenerate_requested = False
+    st.session_state.is_generating = False
+    st.session_state.stop_requested = False
+    st.session_state.cancel_token = None
+    st.session_state.uploaded_files = []
+    st.session_state.saved_sessions[st.session_state.current_title] = list(st.session_state.chat_history)
+    current_instruction_for_save = st.session_state.temp_system_instruction if st.session_state.temp_system_instruction is not None else st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
+    st.session_state.system_instructions[st.session_state.current_title] = current_instruction_for_save
+    save_user_data_to_firestore(st.session_state.user_id)
+    st.toast(f"답변 생성을 중지했습니다. 약 {tokens_avoided:.0f} 토큰을 절약했습니다.", icon="⏹️")
+
+# 현재 세션의 설정을 엔진 설정으로 변환합니다.
+def current_engine_settings():
+    return EngineSettings(
+        model_name=st.session_state.selected_model,
+        use_supervision=st.session_state.use_supervision,
+        max_retries=st.session_state.supervision_max_retries,
+        threshold=st.session_state.supervision_threshold,
+        supervisor_count=st.session_state.supervisor_count,
+        batched=st.session_state.supervision_batched,
+        use_cascade=st.session_state.use_supervisor_cascade,
+        cascade_band=st.session_state.supervisor_cascade_band,
+        use_hedging=st.session_state.use_hedging,
+        hedge_percentile=st.session_state.hedge_percentile,
+        hedge_model=st.session_state.hedge_model,
+        use_context_cache=st.session_state.use_context_cache,
+        use_streaming_supervision=st.session_state.use_streaming_supervision,
+        checkpoint_tokens=st.session_state.checkpoint_tokens,
+        abort_margin=st.session_state.abort_margin,
+        use_candidate_pool=st.session_state.use_candidate_pool,
+        latency_slo=st.session_state.latency_slo
+    )
+
+# 엔진 진행 상황을 채팅 영역에 표시합니다.
+class StreamlitTurnCallbacks(TurnCallbacks):
+    def __init__(self, message_placeholder, regenerating=False):
+        self.message_placeholder = message_placeholder
+        self.regenerating = regenerating
+
+    def on_attempt_start(self, attempt, max_attempts):
+        progress = st.session_state.generation_progress
+        progress.update(attempt=attempt, max_attempts=max_attempts, stage="stream", partial="")
+        action = "재생성" if self.regenerating else "생성"
+        if st.session_state.use_supervision:
+            self.message_placeholder.markdown(f"🤖 답변 {action} 중... (시도: {attempt}/{max_attempts})")
+        else:
+            self.message_placeholder.markdown(f"🤖 답변 {action} 중...")
+
+    def on_chunk(self, text):
+        st.session_state.generation_progress["partial"] = text
+        self.message_placeholder.markdown(text + "▌") # 스트리밍 중 커서 표시
+
+    def on_attempt_end(self, text):
+        st.session_state.generation_progress["stage"] = "evaluate"
+        self.message_placeholder.markdown(text) # 최종 답변 표시 (커서 없이)
+
+    def on_attempt_scored(self, average, scores, passed):
+        progress = st.session_state.generation_progress
+        if average > progress.get("best_score", -1):
+            progress.update(best=progress["partial"], best_score=average)
+        progress.update(attempt=progress["attempt"] + 1, stage="next")
+        prefix = "재생성 " if self.regenerating else ""
+        st.info(f"{prefix}평균 Supervisor 점수: {average:.2f}점")
+        for i, score in enumerate(scores):
+            st.info(f"Supervisor {i+1} 점수: {score}점")
+        if passed:
+            st.success(f"✅ {prefix}답변이 Supervision 통과 기준을 만족합니다!")
+        else:
+            st.warning(f"❌ {prefix}답변이 Supervision 통과 기준({st.session_state.supervision_threshold}점)을 만족하지 못했습니다. 재시도합니다...")
+
+    def on_attempt_aborted(self, projected_score, text):
+        progress = st.session_state.generation_progress
+        progress.update(attempt=progress["attempt"] + 1, stage="next")
+        st.warning(f"✂️ 중간 점검 예상 점수 {projected_score}점: 통과 가능성이 낮아 생성을 중단하고 다시 시도합니다...")
+
+    def on_model_routed(self, decision):
+        st.caption(f"🧭 자동 선택: {decision.model_name} ({decision.reason})")
+
+    def on_candidate_served(self, text, score):
+        self.message_placeholder.markdown(text)
+        score_text = f" (Supervisor 점수: {score:.2f}점)" if score is not None else ""
+        st.info(f"⚡ 미리 생성해 둔 후보 답변을 바로 표시합니다{score_text}")
+
+    def on_error(self, exc):
+        if self.regenerating:
+            st.error(f"재생성 메시지 생성 또는 평가 중 오류 발생: {exc}")
+            self.message_placeholder.markdown("죄송합니다. 다시 생성하는 중 오류가 발생했습니다.")
+        else:
+            st.error(f"메시지 생성 또는 평가 중 오류 발생: {exc}")
+            self.message_placeholder.markdown("죄송합니다. 메시지를 처리하는 중 오류가 발생했습니다.")
+
 
 # Firestore에서 사용자 데이터를 로드합니다.
 def load_user_data_from_firestore(user_id):
     try:
-        sessions_ref = db.collection("user_sessions").document(user_id)
-        doc = sessions_ref.get()
-        if doc.exists:
-            data = doc.to_dict()
-            st.session_state.saved_sessions = data.get("chat_data", {})
-            # Firestore에서 로드된 데이터를 (role, text) 튜플 리스트로 변환
-            for title, history_list in st.session_state.saved_sessions.items():
-                st.session_state.saved_sessions[title] = [(item["role"], item["text"]) for item in history_list]
-
-            st.session_state.system_instructions = data.get("system_instructions", {})
-            st.session_state.current_title = data.get("last_active_title", "새로운 대화")
+        user_data = session_store.load(user_id)
+        if user_data is not None:
+            st.session_state.saved_sessions = user_data.saved_sessions
+            st.session_state.system_instructions = user_data.system_instructions
+            st.session_state.current_title = user_data.last_active_title
 
             if st.session_state.current_title in st.session_state.saved_sessions:
-                st.session_state.chat_history = st.session_state.saved_sessions[st.session_state.current_title]
+                st.session_state.chat_history = list(st.session_state.saved_sessions[st.session_state.current_title])
             else:
                 st.session_state.chat_history = []
 
             st.session_state.temp_system_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
-            current_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
-
-            # chat_session을 로드된 데이터로 초기화 (현재 선택된 모델 사용)
-            st.session_state.chat_session = load_main_model(st.session_state.selected_model, current_instruction).start_chat(history=convert_to_gemini_format(st.session_state.chat_history))
             st.toast(f"Firestore에서 사용자 ID '{user_id}'의 데이터를 불러왔습니다.", icon="✅")
         else:
             st.session_state.saved_sessions = {}
@@ -312,8 +382,6 @@ def load_user_data_from_firestore(user_id):
             st.session_state.chat_history = []
             st.session_state.current_title = "새로운 대화"
             st.session_state.temp_system_instruction = default_system_instruction # Explicitly set default
-            # 새로운 대화에 대한 chat_session 초기화 (현재 선택된 모델 사용)
-            st.session_state.chat_session = load_main_model(st.session_state.selected_model, default_system_instruction).start_chat(history=[])
             st.toast(f"Firestore에 사용자 ID '{user_id}'에 대한 데이터가 없습니다. 새로운 대화를 시작하세요.", icon="ℹ️")
     except Exception as e:
         error_message = f"Firestore에서 데이터 로드 중 오류 발생: {e}"
@@ -325,23 +393,15 @@ def load_user_data_from_firestore(user_id):
         st.session_state.chat_history = []
         st.session_state.current_title = "새로운 대화"
         st.session_state.temp_system_instruction = default_system_instruction # Explicitly set default
-        st.session_state.chat_session = load_main_model(st.session_state.selected_model).start_chat(history=[])
 
 # Firestore에 사용자 데이터를 저장합니다.
 def save_user_data_to_firestore(user_id):
     try:
-        sessions_ref = db.collection("user_sessions").document(user_id)
-        chat_data_to_save = {}
-        for title, history_list in st.session_state.saved_sessions.items():
-            # Convert (role, text) tuple to dictionary for Firestore storage
-            chat_data_to_save[title] = [{"role": item[0], "text": item[1]} for item in history_list]
-
-        data_to_save = {
-            "chat_data": chat_data_to_save,
-            "system_instructions": st.session_state.system_instructions,
-            "last_active_title": st.session_state.current_title
-        }
-        sessions_ref.set(data_to_save)
+        session_store.save(user_id, UserData(
+            st.session_state.saved_sessions,
+            st.session_state.system_instructions,
+            st.session_state.current_title
+        ))
         print(f"User data for ID '{user_id}' saved to Firestore.")
     except Exception as e:
         error_message = f"Error saving data to Firestore: {e}"
@@ -354,12 +414,10 @@ if not st.session_state.data_loaded:
     load_user_data_from_firestore(st.session_state.user_id)
     st.session_state.data_loaded = True
 
-# Initialize chat session if it doesn't exist (fallback for initial load if not handled by load_user_data_from_firestore)
-if st.session_state.chat_session is None:
-    current_instruction = st.session_state.system_instructions.get(
-        st.session_state.current_title, default_system_instruction
-    )
-    st.session_state.chat_session = load_main_model(st.session_state.selected_model, current_instruction).start_chat(history=convert_to_gemini_format(st.session_state.chat_history))
+# 메모리 사용량 집계 갱신 (saved_sessions는 리스트 복사본을 갖지만 Message 객체는 chat_history와 공유하므로,
+# history_bytes는 Message 객체 단위로 중복을 제거해 한 번만 셉니다)
+st.session_state.session_memory.history_bytes = history_bytes(*st.session_state.saved_sessions.values(), st.session_state.chat_history)
+st.session_state.session_memory.upload_bytes = sum(uploaded_file.size for uploaded_file in st.session_state.uploaded_files)
 
 # --- Sidebar UI ---
 with st.sidebar:
@@ -382,13 +440,12 @@ with st.sidebar:
                              disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending):
         # 현재 대화 상태를 저장 (새로운 대화로 전환하기 전)
         if st.session_state.current_title != "새로운 대화" and st.session_state.chat_history:
-            st.session_state.saved_sessions[st.session_state.current_title] = st.session_state.chat_history.copy()
+            st.session_state.saved_sessions[st.session_state.current_title] = list(st.session_state.chat_history)
             current_instruction_to_save = st.session_state.temp_system_instruction if st.session_state.temp_system_instruction is not None else st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
             st.session_state.system_instructions[st.session_state.current_title] = current_instruction_to_save
             save_user_data_to_firestore(st.session_state.user_id)
 
         # 새로운 대화 상태로 초기화
-        st.session_state.chat_session = None # 기존 chat_session 객체 참조 제거
         st.session_state.chat_history = []
         st.session_state.current_title = "새로운 대화"
         st.session_state.temp_system_instruction = default_system_instruction # 새로운 대화는 기본 명령어 사용
@@ -398,17 +455,14 @@ with st.sidebar:
         # "새로운 대화"에 대한 시스템 명령어 설정
         st.session_state.system_instructions[st.session_state.current_title] = default_system_instruction
 
-        # 새로운 chat_session을 즉시 초기화 (현재 선택된 모델 사용)
-        st.session_state.chat_session = load_main_model(st.session_state.selected_model, default_system_instruction).start_chat(history=[])
-
         save_user_data_to_firestore(st.session_state.user_id)
         st.rerun()
 
     if st.session_state.saved_sessions:
         st.subheader("📁 저장된 대화")
-        # Sort sessions by last message time (if available) or title
+        # Sort sessions by last message time
         sorted_keys = sorted(st.session_state.saved_sessions.keys(),
-                                 key=lambda x: st.session_state.saved_sessions[x][-1][1] if st.session_state.saved_sessions[x] else "",
+                                 key=lambda x: st.session_state.saved_sessions[x][-1].created_at if st.session_state.saved_sessions[x] else 0,
                                  reverse=True)
         for key in sorted_keys:
             if key == "새로운 대화" and not st.session_state.saved_sessions[key]:
@@ -418,19 +472,15 @@ with st.sidebar:
                                  disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending):
                 # 현재 대화 상태를 저장 (다른 대화로 전환하기 전)
                 if st.session_state.current_title != "새로운 대화" and st.session_state.chat_history:
-                    st.session_state.saved_sessions[st.session_state.current_title] = st.session_state.chat_history.copy()
+                    st.session_state.saved_sessions[st.session_state.current_title] = list(st.session_state.chat_history)
                     current_instruction_to_save = st.session_state.temp_system_instruction if st.session_state.temp_system_instruction is not None else st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
                     st.session_state.system_instructions[st.session_state.current_title] = current_instruction_to_save
                     save_user_data_to_firestore(st.session_state.user_id) # Save immediately
 
-                st.session_state.chat_history = st.session_state.saved_sessions[key]
+                st.session_state.chat_history = list(st.session_state.saved_sessions[key])
                 st.session_state.current_title = key
                 st.session_state.new_title = key # Initial value for title editing
                 st.session_state.temp_system_instruction = st.session_state.system_instructions.get(key, default_system_instruction)
-                
-                # 로드된 대화 이력으로 chat_session을 다시 초기화 (현재 선택된 모델 사용)
-                current_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
-                st.session_state.chat_session = load_main_model(st.session_state.selected_model, current_instruction).start_chat(history=convert_to_gemini_format(st.session_state.chat_history))
 
                 st.session_state.editing_instruction = False
                 st.session_state.editing_title = False
@@ -444,21 +494,25 @@ with st.sidebar:
         st.write("모델 선택")
         selected_model_option = st.selectbox(
             "사용할 AI 모델을 선택하세요:",
-            options=AVAILABLE_MODELS,
-            index=AVAILABLE_MODELS.index(st.session_state.selected_model),
+            options=MODEL_OPTIONS,
+            index=MODEL_OPTIONS.index(st.session_state.selected_model),
+            format_func=lambda m: "자동 선택 (auto)" if m == AUTO_MODEL else m,
             key="model_selector",
             disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending
         )
+        st.session_state.latency_slo = st.slider(
+            "자동 선택 TTFT 목표 (초)",
+            min_value=1.0,
+            max_value=15.0,
+            value=float(st.session_state.latency_slo),
+            step=0.5,
+            help="자동 선택은 요청 길이, 첨부 수, 히스토리 크기로 모델을 고르고, 예상 첫 토큰 시간이 이 목표를 넘으면 더 빠른 모델을 사용합니다.",
+            disabled=st.session_state.is_generating or st.session_state.selected_model != AUTO_MODEL or st.session_state.delete_confirmation_pending,
+            key="latency_slo_slider"
+        )
         # 모델이 변경되었는지 확인하고, 변경되었다면 세션 상태 업데이트 및 재실행
         if selected_model_option != st.session_state.selected_model:
             st.session_state.selected_model = selected_model_option
-            # 모델 변경 시 chat_session을 새로 선택된 모델로 다시 초기화
-            current_instruction = st.session_state.system_instructions.get(
-                st.session_state.current_title, default_system_instruction
-            )
-            st.session_state.chat_session = load_main_model(st.session_state.selected_model, current_instruction).start_chat(
-                history=convert_to_gemini_format(st.session_state.chat_history)
-            )
             st.toast(f"AI 모델이 '{st.session_state.selected_model}'으로 변경되었습니다.", icon="🤖")
             st.rerun()
 
@@ -498,9 +552,156 @@ with st.sidebar:
             disabled=st.session_state.is_generating or not st.session_state.use_supervision or st.session_state.delete_confirmation_pending, # 토글 상태에 따라 비활성화
             key="supervision_threshold_slider"
         )
+        st.session_state.supervision_batched = st.toggle(
+            "Supervisor 일괄 평가",
+            value=st.session_state.supervision_batched,
+            help="여러 Supervisor 페르소나를 한 번의 요청으로 평가합니다. 응답 형식이 잘못되면 개별 평가로 대체합니다.",
+            key="supervision_batched_toggle",
+            disabled=st.session_state.is_generating or not st.session_state.use_supervision or st.session_state.delete_confirmation_pending
+        )
+        st.session_state.use_supervisor_cascade = st.toggle(
+            "Supervisor cascade",
+            value=st.session_state.use_supervisor_cascade,
+            help=f"Supervisor를 먼저 {SUPERVISOR_CASCADE_MODEL} 모델로 실행하고, 평균 점수가 통과 기준 근처일 때만 선택된 모델로 다시 평가합니다.",
+            key="supervisor_cascade_toggle",
+            disabled=st.session_state.is_generating or not st.session_state.use_supervision or st.session_state.delete_confirmation_pending
+        )
+        st.session_state.supervisor_cascade_band = st.slider(
+            "재평가 구간 (통과 점수 ±)",
+            min_value=0,
+            max_value=50,
+            value=st.session_state.supervisor_cascade_band,
+            disabled=st.session_state.is_generating or not st.session_state.use_supervision or not st.session_state.use_supervisor_cascade or st.session_state.delete_confirmation_pending,
+            key="supervisor_cascade_band_slider"
+        )
+        st.session_state.use_streaming_supervision = st.toggle(
+            "생성 중간 점검",
+            value=st.session_state.use_streaming_supervision,
+            help=f"답변이 생성되는 동안 일정 토큰마다 {STREAMING_SUPERVISOR_MODEL} 모델로 점수를 예측하고, 통과 가능성이 낮으면 끝까지 기다리지 않고 다시 생성합니다. (마지막 시도는 끝까지 생성)",
+            key="streaming_supervision_toggle",
+            disabled=st.session_state.is_generating or not st.session_state.use_supervision or st.session_state.delete_confirmation_pending
+        )
+        st.session_state.checkpoint_tokens = st.slider(
+            "중간 점검 간격 (토큰)",
+            min_value=50,
+            max_value=1000,
+            value=st.session_state.checkpoint_tokens,
+            step=50,
+            disabled=st.session_state.is_generating or not st.session_state.use_supervision or not st.session_state.use_streaming_supervision or st.session_state.delete_confirmation_pending,
+            key="checkpoint_tokens_slider"
+        )
+        st.session_state.abort_margin = st.slider(
+            "조기 중단 기준 (통과 점수 -)",
+            min_value=0,
+            max_value=50,
+            value=st.session_state.abort_margin,
+            disabled=st.session_state.is_generating or not st.session_state.use_supervision or not st.session_state.use_streaming_supervision or st.session_state.delete_confirmation_pending,
+            key="abort_margin_slider"
+        )
         if not st.session_state.use_supervision:
             st.info("Supervision 기능이 비활성화되어 있습니다. AI 답변은 바로 표시됩니다.")
 
+        st.write("---")
+        st.write("응답 지연 관련 설정을 변경할 수 있습니다.")
+        st.session_state.use_hedging = st.toggle(
+            "헤지 요청 사용",
+            value=st.session_state.use_hedging,
+            help="첫 토큰이 늦게 도착하면 같은 요청을 한 번 더 보내고 먼저 응답한 쪽을 사용합니다. (기본: 비활성화)",
+            key="hedging_toggle",
+            disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending
+        )
+        st.session_state.hedge_percentile = st.slider(
+            "헤지 기준 TTFT 백분위",
+            min_value=50,
+            max_value=99,
+            value=st.session_state.hedge_percentile,
+            disabled=st.session_state.is_generating or not st.session_state.use_hedging or st.session_state.delete_confirmation_pending,
+            key="hedge_percentile_slider"
+        )
+        hedge_model_options = [None] + AVAILABLE_MODELS
+        st.session_state.hedge_model = st.selectbox(
+            "헤지 요청 모델",
+            options=hedge_model_options,
+            index=hedge_model_options.index(st.session_state.hedge_model),
+            format_func=lambda m: "같은 모델" if m is None else m,
+            disabled=st.session_state.is_generating or not st.session_state.use_hedging or st.session_state.delete_confirmation_pending,
+            key="hedge_model_selector"
+        )
+        st.session_state.use_context_cache = st.toggle(
+            "컨텍스트 캐시 사용",
+            value=st.session_state.use_context_cache,
+            help="긴 시스템 명령어와 첨부 파일을 한 번만 업로드하고, 재시도·재생성·후속 질문에서는 캐시를 참조합니다.",
+            key="context_cache_toggle",
+            disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending
+        )
+        st.session_state.use_candidate_pool = st.toggle(
+            "재생성 후보 미리 준비",
+            value=st.session_state.use_candidate_pool,
+            help="턴마다 채점된 답변 후보를 보관하고 백그라운드에서 미리 생성해 두어, \"다시 생성\"을 누르면 기다리지 않고 바로 다음 후보를 보여줍니다. (추가 요청이 발생합니다)",
+            key="candidate_pool_toggle",
+            disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending
+        )
+
+    with st.expander("📊 요청 통계"):
+        governor_stats = governor.stats()
+        st.caption(f"Gemini 요청: {governor_stats.get('requests', 0):.0f}회 · 재시도: {governor_stats.get('retries', 0):.0f}회 · 실패: {governor_stats.get('failures', 0):.0f}회")
+        st.caption(f"Rate limit 대기 시간: {governor_stats.get('throttled_seconds', 0):.1f}초")
+        metrics_snapshot = get_metrics().snapshot()
+        main_streams = metrics_snapshot["counters"].get("main.streams", 0)
+        hedges_fired = metrics_snapshot["counters"].get("hedge.fired", 0)
+        hedge_rate = hedges_fired / main_streams * 100 if main_streams else 0
+        st.caption(f"헤지 요청: {hedges_fired:.0f}회 ({hedge_rate:.1f}%) · 헤지 승리: {metrics_snapshot['counters'].get('hedge.won', 0):.0f}회")
+        for ttft_model in (AVAILABLE_MODELS if st.session_state.selected_model == AUTO_MODEL else [st.session_state.selected_model]):
+            ttft_stats = metrics_snapshot["samples"].get(f"ttft.{ttft_model}")
+            if ttft_stats:
+                st.caption(f"TTFT ({ttft_model}): p50 {ttft_stats['p50']:.2f}초 · p95 {ttft_stats['p95']:.2f}초")
+        routed_counts = [(model, metrics_snapshot["counters"].get(f"route.{model}", 0)) for model in AVAILABLE_MODELS]
+        if any(count for _, count in routed_counts):
+            st.caption("자동 모델 선택: " + " · ".join(f"{model} {count:.0f}회" for model, count in routed_counts))
+            prediction_stats = metrics_snapshot["samples"].get("route.ttft_prediction_ratio")
+            if prediction_stats:
+                st.caption(f"실제/예상 TTFT 비율: p50 {prediction_stats['p50']:.2f} · p95 {prediction_stats['p95']:.2f}")
+        saved_stats = metrics_snapshot["samples"].get("hedge.ttft_saved_s")
+        if saved_stats:
+            st.caption(f"헤지로 단축된 TTFT (추정): 평균 {saved_stats['mean']:.2f}초")
+        supervision_stats = metrics_snapshot["samples"].get("supervision.seconds")
+        if supervision_stats:
+            st.caption(f"Supervision 소요 시간: 평균 {supervision_stats['mean']:.2f}초 · p95 {supervision_stats['p95']:.2f}초")
+        st.caption(f"Supervisor 요청: {metrics_snapshot['counters'].get('supervisor.requests', 0):.0f}회 · Cascade 재평가: {metrics_snapshot['counters'].get('cascade.escalations', 0):.0f}회")
+        prompt_token_stats = metrics_snapshot["samples"].get("supervisor.prompt_tokens")
+        if prompt_token_stats:
+            st.caption(f"Supervisor 프롬프트: 평균 약 {prompt_token_stats['mean']:.0f} 토큰 · 히스토리 요약 재사용: {metrics_snapshot['counters'].get('digest.hits', 0):.0f}회")
+        cache_counters = metrics_snapshot["counters"]
+        st.caption(f"컨텍스트 캐시: 재사용 {cache_counters.get('context_cache.hits', 0):.0f}회 · 생성 {cache_counters.get('context_cache.creates', 0):.0f}회 · "
+                   f"인라인 대체 {cache_counters.get('context_cache.fallbacks', 0):.0f}회 · 절약 {cache_counters.get('context_cache.bytes_saved', 0) / 1e6:.1f}MB")
+        upload_stats = metrics_snapshot["samples"].get("main.upload_bytes")
+        if upload_stats:
+            st.caption(f"요청당 업로드: 평균 {upload_stats['mean'] / 1e3:.0f}KB")
+        st.caption(f"중간 점검: {metrics_snapshot['counters'].get('checkpoint.checks', 0):.0f}회 · 조기 중단: {metrics_snapshot['counters'].get('checkpoint.aborts', 0):.0f}회 · 절약된 토큰 약 {metrics_snapshot['counters'].get('checkpoint.tokens_saved', 0):.0f}개")
+        st.caption(f"생성 중지: {metrics_snapshot['counters'].get('cancel.turns', 0):.0f}회 · 절약된 토큰 약 {metrics_snapshot['counters'].get('cancel.tokens_avoided', 0):.0f}개")
+        memory_report = get_memory_registry().report()
+        session_report = st.session_state.session_memory.report()
+        st.caption(f"이 세션 메모리: 약 {session_report['total_bytes'] / 1e6:.1f}MB (첨부 {session_report['resident_bytes'] / 1e6:.1f}MB / 예산 {session_report['budget_bytes'] / 1e6:.0f}MB · "
+                   f"히스토리 {session_report['history_bytes'] / 1e6:.2f}MB) · 디스크로 내보낸 첨부 {session_report['spilled_bytes'] / 1e6:.1f}MB")
+        rss_text = f" · 프로세스 RSS {memory_report['process_rss_bytes'] / 1e6:.0f}MB" if memory_report["process_rss_bytes"] else ""
+        st.caption(f"전체 {memory_report['session_count']}개 세션: 첨부 {memory_report['resident_bytes'] / 1e6:.1f}MB · 히스토리 {memory_report['history_bytes'] / 1e6:.1f}MB · "
+                   f"spill 디스크 {memory_report['spill_disk_bytes'] / 1e6:.1f}MB{rss_text}")
+        st.caption(f"첨부 저장소: 저장 {cache_counters.get('attachments.stored_bytes', 0) / 1e6:.1f}MB · 중복 제거 {cache_counters.get('attachments.dedup_bytes', 0) / 1e6:.1f}MB")
+        st.caption(f"재생성 후보 풀: 즉시 제공 {cache_counters.get('candidates.hits', 0):.0f}회 · 새로 생성 {cache_counters.get('candidates.misses', 0):.0f}회 · "
+                   f"백그라운드 보충 {cache_counters.get('candidates.refills', 0):.0f}개")
+        storage_stats = storage_summary(cache_counters)
+        if storage_stats["ratio"] or storage_stats["compressed_reads"]:
+            ratio_text = f"압축 비율 {storage_stats['ratio']:.2f} · " if storage_stats["ratio"] else ""
+            st.caption(f"저장소 압축: {ratio_text}쓰기 절약 {storage_stats['write_bytes_saved'] / 1e3:.0f}KB · 읽기 절약 {storage_stats['read_bytes_saved'] / 1e3:.0f}KB · "
+                       f"압축 해제 {storage_stats['lazy_decodes']:.0f}/{storage_stats['compressed_reads']:.0f}개")
+        upload_batch_stats = metrics_snapshot["samples"].get("uploads.batch_seconds")
+        if upload_batch_stats:
+            st.caption(f"첨부 전처리: 파일 {cache_counters.get('uploads.files', 0):.0f}개 · PDF {cache_counters.get('uploads.pages', 0):.0f}페이지 · "
+                       f"일괄 처리 p50 {upload_batch_stats['p50']:.1f}초 · p95 {upload_batch_stats['p95']:.1f}초")
+        document_ttft_stats = metrics_snapshot["samples"].get("ttft.documents")
+        if document_ttft_stats:
+            st.caption(f"문서 대화 TTFT: p50 {document_ttft_stats['p50']:.2f}초 · p95 {document_ttft_stats['p95']:.2f}초")
+
 
 # --- Main Content Area ---
 # Display current conversation title and edit options
@@ -560,7 +761,6 @@ if st.session_state.delete_confirmation_pending:
                 # Clear the current "새로운 대화"
                 st.session_state.chat_history = []
                 st.session_state.temp_system_instruction = default_system_instruction
-                st.session_state.chat_session = load_main_model(st.session_state.selected_model, default_system_instruction).start_chat(history=[])
                 st.toast("현재 대화가 초기화되었습니다.", icon="🗑️")
                 # Ensure "새로운 대화" is saved as empty to Firestore
                 st.session_state.saved_sessions["새로운 대화"] = []
@@ -577,8 +777,7 @@ if st.session_state.delete_confirmation_pending:
                     st.session_state.current_title = "새로운 대화"
                     st.session_state.chat_history = []
                     st.session_state.temp_system_instruction = default_system_instruction
-                    st.session_state.chat_session = load_main_model(st.session_state.selected_model, default_system_instruction).start_chat(history=[])
-                    
+
                     st.toast(f"'{deleted_title}' 대화가 삭제되었습니다.", icon="🗑️")
                     # Ensure "새로운 대화" is saved as empty if it was the only session left
                     if "새로운 대화" not in st.session_state.saved_sessions:
@@ -616,12 +815,8 @@ if st.session_state.editing_instruction:
             if st.button("✅ 저장", use_container_width=True, key="save_instruction_button",
                                  disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending):
                 st.session_state.system_instructions[st.session_state.current_title] = st.session_state.temp_system_instruction
-                st.session_state.saved_sessions[st.session_state.current_title] = st.session_state.chat_history.copy()
-                
-                # 시스템 명령어 변경 시 chat_session을 새 모델로 다시 초기화 (현재 선택된 모델 사용)
-                current_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
-                st.session_state.chat_session = load_main_model(st.session_state.selected_model, current_instruction).start_chat(history=convert_to_gemini_format(st.session_state.chat_history))
-                
+                st.session_state.saved_sessions[st.session_state.current_title] = list(st.session_state.chat_history)
+
                 save_user_data_to_firestore(st.session_state.user_id)
                 st.success("AI 설정이 저장되었습니다.")
                 st.session_state.editing_instruction = False
@@ -639,20 +834,24 @@ chat_display_container = st.container()
 # --- Final Chat History Display (Always Rendered) ---
 # This ensures all messages are displayed correctly.
 with chat_display_container:
-    for i, (role, message) in enumerate(st.session_state.chat_history):
-        with st.chat_message("ai" if role == "model" else "user"):
-            st.markdown(message)
+    for i, message in enumerate(st.session_state.chat_history):
+        with st.chat_message("ai" if message.role == "model" else "user"):
+            st.markdown(message.text)
+            if message.attachments:
+                st.caption(f"📎 첨부 {len(message.attachments)}개 ({sum(ref.size for ref in message.attachments) / 1e6:.1f}MB)")
             # Display regenerate button only on the last AI message if not currently generating
-            if role == "model" and i == len(st.session_state.chat_history) - 1 and not st.session_state.is_generating \
+            if message.role == "model" and i == len(st.session_state.chat_history) - 1 and not st.session_state.is_generating \
                 and not st.session_state.delete_confirmation_pending: # Disable if confirmation is pending
                 if st.button("🔄 다시 생성", key=f"regenerate_button_final_{i}", use_container_width=True):
                     st.session_state.regenerate_requested = True
                     st.session_state.is_generating = True # Disable input during regeneration
                     st.session_state.chat_history.pop() # Remove last AI message before regeneration
-                    # No need to rewind chat_session here, it will be reinitialized in the regeneration block
                     st.rerun()
 
 # --- Input Area ---
+if st.session_state.is_generating:
+    st.button("⏹️ 생성 중지", key="stop_generation_button", on_click=request_stop_generation, use_container_width=True)
+
 # Place st.chat_input and file uploader on the same line
 col_prompt_input, col_upload_icon = st.columns([0.85, 0.15]) # Adjust column ratio for better spacing
 
@@ -663,23 +862,23 @@ with col_prompt_input:
 
 with col_upload_icon:
     # Make the file upload button look like an icon.
-    # PDF MIME type 'application/pdf' 추가 및 아이콘 변경
-    uploaded_file_for_submit = st.file_uploader("🖼️ / 📄", type=["png", "jpg", "jpeg", "pdf"], key="file_uploader_main", label_visibility="collapsed",
-                                                 disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending, help="이미지 또는 PDF 파일을 업로드하세요.")
-
-# Update uploaded_file state immediately upon file selection
-if uploaded_file_for_submit:
-    st.session_state.uploaded_file = uploaded_file_for_submit
-    st.caption("파일 업로드 완료")
-else:
-    # If user removes the file from the uploader, reset session state as well
-    if st.session_state.uploaded_file is not None:
-        st.session_state.uploaded_file = None
+    # 여러 이미지/PDF를 한 번에 첨부할 수 있습니다 (업로드한 순서대로 모델에 전달).
+    uploaded_files_for_submit = st.file_uploader("🖼️ / 📄", type=UPLOAD_FILE_TYPES, key="file_uploader_main", label_visibility="collapsed",
+                                                  accept_multiple_files=True,
+                                                  disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending,
+                                                  help=f"이미지 또는 PDF 파일을 업로드하세요 (최대 {MAX_UPLOAD_FILES}개).")
+
+# Update uploaded_files state immediately upon file selection (removing files from the uploader resets it as well)
+st.session_state.uploaded_files = list(uploaded_files_for_submit or [])[:MAX_UPLOAD_FILES]
+if st.session_state.uploaded_files:
+    st.caption(f"파일 {len(st.session_state.uploaded_files)}개 업로드 완료")
+    if len(uploaded_files_for_submit) > MAX_UPLOAD_FILES:
+        st.warning(f"한 번에 최대 {MAX_UPLOAD_FILES}개까지 첨부할 수 있어 처음 {MAX_UPLOAD_FILES}개만 사용합니다.")
 
 # AI generation trigger logic
 # Trigger if user_prompt is entered (Enter key) OR if a file (image/pdf) is uploaded
 if user_prompt is not None and not st.session_state.is_generating:
-    if user_prompt != "" or st.session_state.uploaded_file is not None:
+    if user_prompt != "" or st.session_state.uploaded_files:
         # Prepare content for Gemini model
         user_input_gemini_parts = []
         # 현재 사용자 프롬프트는 챗봇 히스토리에도 추가될 텍스트입니다.
@@ -690,155 +889,85 @@ if user_prompt is not None and not st.session_state.is_generating:
         # user_prompt가 None일 경우 빈 문자열로 초기화하여 오류 방지
         user_input_gemini_parts.append({"text": user_prompt if user_prompt is not None else ""})
 
-        if st.session_state.uploaded_file:
-            file_type = st.session_state.uploaded_file.type
-            file_data = st.session_state.uploaded_file.getvalue()
-
-            if file_type.startswith("image/"):
-                user_input_gemini_parts.append({
-                    "inline_data": {
-                        "mime_type": file_type,
-                        "data": base64.b64encode(file_data).decode('utf-8') # Base64 인코딩
-                    }
-                })
-            elif file_type == "application/pdf":
-                try:
-                    pdf_document = fitz.open(stream=file_data, filetype="pdf")
-                    processed_page_count = 0
-                    for page_num in range(min(len(pdf_document), MAX_PDF_PAGES_TO_PROCESS)):
-                        page = pdf_document.load_page(page_num)
-                        # Render page to a high-resolution pixmap
-                        # dpi=300 (or higher) for better image quality for OCR/vision tasks
-                        pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72)) 
-                        img_bytes = pix.tobytes() # Removed format="png" as it caused an error in some PyMuPDF versions
-                        
-                        user_input_gemini_parts.append({
-                            "inline_data": {
-                                "mime_type": "image/png",
-                                "data": base64.b64encode(img_bytes).decode('utf-8') # Base64 인코딩
-                            }
-                        })
-                        processed_page_count += 1
-                    
-                    if len(pdf_document) > MAX_PDF_PAGES_TO_PROCESS:
-                        st.warning(f"PDF 파일이 {MAX_PDF_PAGES_TO_PROCESS} 페이지를 초과하여 처음 {MAX_PDF_PAGES_TO_PROCESS} 페이지만 처리되었습니다.")
-                    
-                    pdf_document.close() # 문서 닫기
-
-                except Exception as e:
-                    st.error(f"PDF 파일 처리 중 오류 발생: {e}. PDF 내용을 포함하지 않고 대화를 계속합니다.")
-            else:
-                st.warning(f"지원되지 않는 파일 형식입니다: {file_type}. 파일 내용을 포함하지 않고 대화를 계속합니다.")
+        upload_results = []
+        if st.session_state.uploaded_files:
+            # 파일들을 작업자 풀에서 동시에 전처리하고 (공유 크기/페이지 예산), 파일별 진행 상황과 소요 시간을 표시합니다.
+            with st.status(f"첨부 파일 {len(st.session_state.uploaded_files)}개 처리 중...", expanded=True) as upload_status:
+                file_progress = [st.progress(0.0, text=f"{uploaded_file.name} 대기 중") for uploaded_file in st.session_state.uploaded_files]
+                def show_file_progress(index, result):
+                    state = f"{result.seconds:.1f}초" if result.done else f"{result.done_tasks}/{result.tasks}"
+                    file_progress[index].progress(result.progress, text=f"{result.name} · {state}")
+                upload_results = preprocess_uploads(
+                    [(uploaded_file.name, uploaded_file.type, uploaded_file.getvalue()) for uploaded_file in st.session_state.uploaded_files],
+                    get_upload_executor(),
+                    on_progress=show_file_progress,
+                    metrics=get_metrics()
+                )
+                for index, result in enumerate(upload_results):
+                    if result.error:
+                        file_progress[index].progress(1.0, text=f"{result.name} · 실패")
+                        st.error(f"{result.name}: {result.error} 파일 내용을 포함하지 않고 대화를 계속합니다.")
+                    elif result.note:
+                        if not result.tasks:
+                            file_progress[index].progress(1.0, text=f"{result.name} · 건너뜀")
+                        st.warning(f"{result.name}: {result.note}")
+                batch_seconds = max((result.seconds for result in upload_results), default=0.0)
+                work_seconds = sum(result.work_seconds for result in upload_results)
+                upload_status.update(label=f"첨부 파일 {len(upload_results)}개 처리 완료 · {batch_seconds:.1f}초 (순차 처리 시 약 {work_seconds:.1f}초)",
+                                     state="complete", expanded=False)
+            user_input_gemini_parts.extend(combined_parts(upload_results))
 
         # Update chat history with the user's text prompt (not the raw parts for display)
         # Display용 chat_history에는 텍스트만 저장. 파일이 있었다면 "파일 첨부"와 함께.
-        st.session_state.chat_history.append(("user", user_prompt_for_display_and_eval))
+        # 첨부 데이터는 블롭 저장소에 보관하고, 메시지에는 참조만 남깁니다 (이후 턴과 재생성에서 다시 첨부).
+        attachment_refs = []
+        for result in upload_results:
+            attachment_refs.extend(get_attachment_store().save_parts(result.parts, name=result.name))
+        st.session_state.chat_history.append(Message("user", user_prompt_for_display_and_eval, attachments=attachment_refs))
         st.session_state.is_generating = True
         # Store the processed content (Gemini parts) for potential regeneration
-        st.session_state.last_user_input_gemini_parts = user_input_gemini_parts
+        # 첨부 데이터는 세션 메모리 예산 안에서만 메모리에 두고, 초과분은 디스크로 내보냅니다.
+        st.session_state.session_memory.release_parts(st.session_state.last_user_input_gemini_parts)
+        st.session_state.last_user_input_gemini_parts = st.session_state.session_memory.offload_parts(user_input_gemini_parts)
         st.rerun() # Update UI and start generation immediately after prompt submission
 
 
+# --- Stop Handling ---
+# 생성 도중 "생성 중지"가 눌렸다면 생성을 다시 시작하지 않고 부분 답변으로 마무리합니다.
+if st.session_state.is_generating and st.session_state.stop_requested:
+    finish_stopped_generation()
+    st.rerun()
+
 # --- Regeneration Logic ---
 # This block runs only when regeneration is requested.
 if st.session_state.regenerate_requested:
     st.session_state.is_generating = True # 생성 플래그를 True로 설정
     
-    # 이전 사용자 메시지 (Gemini parts 형식)를 가져옵니다.
-    regen_contents_for_model = st.session_state.last_user_input_gemini_parts
+    # 이전 사용자 메시지 (Gemini parts 형식)를 저장된 첨부 참조에서 다시 만듭니다.
+    # 다른 대화로 전환했거나 페이지를 새로고침한 뒤에도 첨부 파일과 함께 재생성됩니다.
+    regen_contents_for_model = contents_for_user_message(st.session_state.chat_history[-1])
 
     with chat_display_container: # 재생성된 메시지를 채팅 영역 내에 표시
         with st.chat_message("ai"):
             message_placeholder = st.empty()
             
-            best_ai_response = "" # Supervision 후 가장 좋은 답변을 저장
-            highest_score = -1    # 가장 높은 점수를 저장
-            
             current_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
 
-            if st.session_state.use_supervision:
-                attempt_count = 0
-                while attempt_count < st.session_state.supervision_max_retries:
-                    attempt_count += 1
-                    message_placeholder.markdown(f"🤖 답변 재생성 중... (시도: {attempt_count}/{st.session_state.supervision_max_retries})")
-                    full_response = ""
-
-                    try:
-                        st.session_state.chat_session = load_main_model(st.session_state.selected_model, current_instruction).start_chat(
-                            history=convert_to_gemini_format(st.session_state.chat_history) 
-                        )
-                        response_stream = st.session_state.chat_session.send_message(regen_contents_for_model, stream=True)
-                        
-                        for chunk in response_stream:
-                            full_response += chunk.text
-                            message_placeholder.markdown(full_response + "▌")
-                        message_placeholder.markdown(full_response)
-
-                        # --- Supervisor 평가 (재생성) ---
-                        total_score = 0
-                        supervisor_feedback_list = []
-                        
-                        # Regen 시 Supervisor에게는 원래 사용자 메시지 텍스트를 넘겨야 합니다.
-                        # last_user_input_gemini_parts에서 텍스트 부분만 추출 (가장 첫 번째 텍스트 파트)
-                        original_user_text_for_eval = ""
-                        for part in regen_contents_for_model:
-                            if "text" in part:
-                                original_user_text_for_eval = part["text"]
-                                break 
-
-                        for i in range(st.session_state.supervisor_count):
-                            score = evaluate_response(
-                                user_input=original_user_text_for_eval, # Supervisor에 전달할 사용자 입력
-                                chat_history=st.session_state.chat_history, # Supervisor에게는 현재 사용자 메시지를 포함한 히스토리 제공
-                                system_instruction=current_instruction,
-                                ai_response=full_response
-                            )
-                            total_score += score
-                            supervisor_feedback_list.append(f"Supervisor {i+1} 점수: {score}점")
-                        
-                        avg_score = total_score / st.session_state.supervisor_count
-                        
-                        st.info(f"재생성 평균 Supervisor 점수: {avg_score:.2f}점")
-                        for feedback in supervisor_feedback_list:
-                            st.info(feedback)
-
-                        if avg_score >= st.session_state.supervision_threshold:
-                            best_ai_response = full_response
-                            highest_score = avg_score
-                            st.success("✅ 재생성 답변이 Supervision 통과 기준을 만족합니다!")
-                            break # 통과했으므로 루프 종료
-                        else:
-                            st.warning(f"❌ 재생성 답변이 Supervision 통과 기준({st.session_state.supervision_threshold}점)을 만족하지 못했습니다. 재시도합니다...")
-                            if avg_score > highest_score: # 현재 답변이 이전 최고 점수보다 높으면 저장
-                                highest_score = avg_score
-                                best_ai_response = full_response
-                    
-                    except Exception as e:
-                        st.error(f"재생성 메시지 생성 또는 평가 중 오류 발생: {e}")
-                        message_placeholder.markdown("죄송합니다. 다시 생성하는 중 오류가 발생했습니다.")
-                        break
-            else: # Supervision is OFF for Regeneration
-                message_placeholder.markdown("🤖 답변 재생성 중...")
-                full_response = ""
-                try:
-                    st.session_state.chat_session = load_main_model(st.session_state.selected_model, current_instruction).start_chat(
-                        history=convert_to_gemini_format(st.session_state.chat_history)
-                    )
-                    response_stream = st.session_state.chat_session.send_message(regen_contents_for_model, stream=True)
-                    
-                    for chunk in response_stream:
-                        full_response += chunk.text
-                        message_placeholder.markdown(full_response + "▌")
-                    message_placeholder.markdown(full_response)
-                    best_ai_response = full_response # Directly assign the response
-                    highest_score = 100 # Placeholder score, not actually used for display
-                except Exception as e:
-                    st.error(f"재생성 메시지 생성 중 오류 발생: {e}")
-                    message_placeholder.markdown("죄송합니다. 다시 생성하는 중 오류가 발생했습니다.")
+            # 마지막 사용자 메시지는 regen_contents_for_model로 다시 전송되므로 히스토리에서는 제외합니다.
+            turn_result = get_generation_engine().regenerate(
+                current_engine_settings(),
+                history=st.session_state.chat_history[:-1],
+                contents=regen_contents_for_model,
+                system_instruction=current_instruction,
+                callbacks=StreamlitTurnCallbacks(message_placeholder, regenerating=True),
+                cancel_token=start_cancellable_generation()
+            )
+            best_ai_response = turn_result.response # Supervision 후 가장 좋은 답변
+            highest_score = turn_result.score       # 가장 높은 점수 (답변이 없으면 -1)
 
             # --- Supervision/Single-pass Logic 후 최종 재생성 AI 답변 처리 ---
             if best_ai_response:
-                st.session_state.chat_history.append(("model", best_ai_response)) # 새로운 AI 메시지 추가
+                st.session_state.chat_history.append(Message("model", best_ai_response)) # 새로운 AI 메시지 추가
                 message_placeholder.markdown(best_ai_response) # 최종적으로 선택된 답변을 다시 표시
                 if st.session_state.use_supervision:
                     st.toast(f"재생성이 성공적으로 완료되었습니다. 최종 점수: {highest_score:.2f}점", icon="👍")
@@ -847,90 +976,27 @@ if st.session_state.regenerate_requested:
             else:
                 st.error("모든 재시도 후에도 만족스러운 재생성 답변을 얻지 못했습니다. 이전 최고 점수 답변을 표시합니다.")
                 if highest_score != -1: # 적어도 하나의 답변이 생성되었으면
-                    st.session_state.chat_history.append(("model", best_ai_response))
+                    st.session_state.chat_history.append(Message("model", best_ai_response))
                     message_placeholder.markdown(best_ai_response)
                     if st.session_state.use_supervision:
                         st.toast(f"최고 점수 재생성 답변이 표시되었습니다. 점수: {highest_score:.2f}점", icon="❗")
                     else:
                         st.toast("최고 점수 재생성 답변이 표시되었습니다.", icon="❗") # No score if not using supervision
                 else: # 어떤 답변도 생성되지 못한 경우
-                    st.session_state.chat_history.append(("model", "죄송합니다. 현재 요청에 대해 답변을 재생성할 수 없습니다."))
+                    st.session_state.chat_history.append(Message("model", "죄송합니다. 현재 요청에 대해 답변을 재생성할 수 없습니다."))
                     message_placeholder.markdown("죄송합니다. 현재 요청에 대해 답변을 재생성할 수 없습니다.")
 
             st.session_state.regenerate_requested = False # 재생성 플래그 재설정
             st.session_state.is_generating = False # 생성 플래그 재설정
             
             # 성공적인 재생성 후 Firestore에 데이터 저장
-            st.session_state.saved_sessions[st.session_state.current_title] = st.session_state.chat_history.copy()
+            st.session_state.saved_sessions[st.session_state.current_title] = list(st.session_state.chat_history)
             current_instruction_for_save = st.session_state.temp_system_instruction if st.session_state.temp_system_instruction is not None else st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
             st.session_state.system_instructions[st.session_state.current_title] = current_instruction_for_save
             save_user_data_to_firestore(st.session_state.user_id)
             st.rerun() # UI 업데이트를 위해 다시 실행
 
 
-# AI generation trigger logic
-# Trigger if user_prompt is entered (Enter key) OR if a file (image/pdf) is uploaded
-if user_prompt is not None and not st.session_state.is_generating:
-    if user_prompt != "" or st.session_state.uploaded_file is not None:
-        # Prepare content for Gemini model
-        user_input_gemini_parts = []
-        # 현재 사용자 프롬프트는 챗봇 히스토리에도 추가될 텍스트입니다.
-        # Supervisor 평가 시 '사용자 입력'으로 사용됩니다.
-        user_prompt_for_display_and_eval = user_prompt if user_prompt is not None else "파일 첨부"
-        
-        # 텍스트 프롬프트는 항상 첫 번째 파트로 추가
-        # user_prompt가 None일 경우 빈 문자열로 초기화하여 오류 방지
-        user_input_gemini_parts.append({"text": user_prompt if user_prompt is not None else ""})
-
-        if st.session_state.uploaded_file:
-            file_type = st.session_state.uploaded_file.type
-            file_data = st.session_state.uploaded_file.getvalue()
-
-            if file_type.startswith("image/"):
-                user_input_gemini_parts.append({
-                    "inline_data": {
-                        "mime_type": file_type,
-                        "data": base64.b64encode(file_data).decode('utf-8') # Base64 인코딩
-                    }
-                })
-            elif file_type == "application/pdf":
-                try:
-                    pdf_document = fitz.open(stream=file_data, filetype="pdf")
-                    processed_page_count = 0
-                    for page_num in range(min(len(pdf_document), MAX_PDF_PAGES_TO_PROCESS)):
-                        page = pdf_document.load_page(page_num)
-                        # Render page to a high-resolution pixmap
-                        # dpi=300 (or higher) for better image quality for OCR/vision tasks
-                        pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72)) 
-                        img_bytes = pix.tobytes() # Removed format="png" as it caused an error in some PyMuPDF versions
-                        
-                        user_input_gemini_parts.append({
-                            "inline_data": {
-                                "mime_type": "image/png",
-                                "data": base64.b64encode(img_bytes).decode('utf-8') # Base64 인코딩
-                            }
-                        })
-                        processed_page_count += 1
-                    
-                    if len(pdf_document) > MAX_PDF_PAGES_TO_PROCESS:
-                        st.warning(f"PDF 파일이 {MAX_PDF_PAGES_TO_PROCESS} 페이지를 초과하여 처음 {MAX_PDF_PAGES_TO_PROCESS} 페이지만 처리되었습니다.")
-                    
-                    pdf_document.close() # 문서 닫기
-
-                except Exception as e:
-                    st.error(f"PDF 파일 처리 중 오류 발생: {e}. PDF 내용을 포함하지 않고 대화를 계속합니다.")
-            else:
-                st.warning(f"지원되지 않는 파일 형식입니다: {file_type}. 파일 내용을 포함하지 않고 대화를 계속합니다.")
-
-        # Update chat history with the user's text prompt (not the raw parts for display)
-        # Display용 chat_history에는 텍스트만 저장. 파일이 있었다면 "파일 첨부"와 함께.
-        st.session_state.chat_history.append(("user", user_prompt_for_display_and_eval))
-        st.session_state.is_generating = True
-        # Store the processed content (Gemini parts) for potential regeneration
-        st.session_state.last_user_input_gemini_parts = user_input_gemini_parts
-        st.rerun() # Update UI and start generation immediately after prompt submission
-
-
 # --- AI Response Generation and Display Logic ---
 # This block runs only when AI is generating a response (and not regenerating).
 if st.session_state.is_generating and not st.session_state.regenerate_requested:
@@ -939,103 +1005,26 @@ if st.session_state.is_generating and not st.session_state.regenerate_requested:
         with st.chat_message("ai"):
             message_placeholder = st.empty() # Placeholder for streaming response
             
-            best_ai_response = "" # Supervision 후 가장 좋은 답변을 저장
-            highest_score = -1    # 가장 높은 점수를 저장
-            
             # 모델에 보낼 콘텐츠는 last_user_input_gemini_parts에서 가져옵니다.
-            initial_contents_for_model = st.session_state.last_user_input_gemini_parts
+            initial_contents_for_model = st.session_state.session_memory.materialize_parts(st.session_state.last_user_input_gemini_parts)
 
             current_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
             history_for_main_model = st.session_state.chat_history[:-1] # 마지막 사용자 메시지 제외한 히스토리
 
-            if st.session_state.use_supervision: # Supervision 토글이 켜져 있을 때만 루프 실행
-                attempt_count = 0
-                while attempt_count < st.session_state.supervision_max_retries:
-                    attempt_count += 1
-                    message_placeholder.markdown(f"🤖 답변 생성 중... (시도: {attempt_count}/{st.session_state.supervision_max_retries})")
-                    full_response = "" # 현재 시도에서 모델이 생성한 답변
-
-                    try:
-                        # 새로운 답변 생성을 위해 chat_session을 이전 대화 히스토리로 다시 초기화합니다.
-                        st.session_state.chat_session = load_main_model(st.session_state.selected_model, current_instruction).start_chat(
-                            history=convert_to_gemini_format(history_for_main_model)
-                        )
-
-                        # 모델에 현재 사용자 입력(및 파일 내용)을 전송하여 답변을 스트리밍합니다.
-                        response_stream = st.session_state.chat_session.send_message(initial_contents_for_model, stream=True)
-                        
-                        for chunk in response_stream:
-                            full_response += chunk.text
-                            message_placeholder.markdown(full_response + "▌") # 스트리밍 중 커서 표시
-                        message_placeholder.markdown(full_response) # 최종 답변 표시 (커서 없이)
-
-                        # --- Supervisor 평가 시작 ---
-                        total_score = 0
-                        supervisor_feedback_list = []
-                        
-                        # Supervisor에 전달할 사용자 입력 텍스트 추출 (Gemini parts에서)
-                        user_text_for_eval = ""
-                        for part in initial_contents_for_model:
-                            if "text" in part:
-                                # PDF 내용이 포함된 텍스트일 수 있으므로, 사용자의 원래 프롬프트가 가장 앞선다고 가정
-                                user_text_for_eval = part["text"]
-                                break
-
-                        for i in range(st.session_state.supervisor_count):
-                            score = evaluate_response(
-                                user_input=user_text_for_eval, # Supervisor에 전달할 사용자 입력 텍스트
-                                chat_history=st.session_state.chat_history[:-1], # Supervisor에게는 현재 사용자 입력 제외한 히스토리 제공
-                                system_instruction=current_instruction,
-                                ai_response=full_response
-                            )
-                            total_score += score
-                            supervisor_feedback_list.append(f"Supervisor {i+1} 점수: {score}점")
-                        
-                        avg_score = total_score / st.session_state.supervisor_count
-                        
-                        st.info(f"평균 Supervisor 점수: {avg_score:.2f}점")
-                        for feedback in supervisor_feedback_list:
-                            st.info(feedback)
-
-                        if avg_score >= st.session_state.supervision_threshold:
-                            best_ai_response = full_response
-                            highest_score = avg_score
-                            st.success("✅ 답변이 Supervision 통과 기준을 만족합니다!")
-                            break # 통과했으므로 루프 종료
-                        else:
-                            st.warning(f"❌ 답변이 Supervision 통과 기준({st.session_state.supervision_threshold}점)을 만족하지 못했습니다. 재시도합니다...")
-                            if avg_score > highest_score:
-                                highest_score = avg_score
-                                best_ai_response = full_response
-
-                    except Exception as e:
-                        st.error(f"메시지 생성 또는 평가 중 오류 발생: {e}")
-                        message_placeholder.markdown("죄송합니다. 메시지를 처리하는 중 오류가 발생했습니다.")
-                        st.session_state.uploaded_file = None # 오류 발생 시 업로드된 파일 초기화
-                        break # 오류 발생 시 루프 종료
-            else: # Supervision is OFF (Supervision 토글이 꺼져 있을 때)
-                message_placeholder.markdown("🤖 답변 생성 중...")
-                full_response = ""
-                try:
-                    st.session_state.chat_session = load_main_model(st.session_state.selected_model, current_instruction).start_chat(
-                        history=convert_to_gemini_format(history_for_main_model)
-                    )
-                    response_stream = st.session_state.chat_session.send_message(initial_contents_for_model, stream=True)
-                    
-                    for chunk in response_stream:
-                        full_response += chunk.text
-                        message_placeholder.markdown(full_response + "▌")
-                    message_placeholder.markdown(full_response)
-                    best_ai_response = full_response # Supervision이 꺼져 있으면 바로 이 답변을 채택
-                    highest_score = 100 # Supervision이 아니므로 점수는 의미 없지만 토스트 메시지 일관성을 위해 임의 값 부여
-                except Exception as e:
-                    st.error(f"메시지 생성 중 오류 발생: {e}")
-                    message_placeholder.markdown("죄송합니다. 메시지를 처리하는 중 오류가 발생했습니다.")
-                    st.session_state.uploaded_file = None
+            turn_result = get_generation_engine().run_turn(
+                current_engine_settings(),
+                history=history_for_main_model,
+                contents=initial_contents_for_model,
+                system_instruction=current_instruction,
+                callbacks=StreamlitTurnCallbacks(message_placeholder),
+                cancel_token=start_cancellable_generation()
+            )
+            best_ai_response = turn_result.response # Supervision 후 가장 좋은 답변
+            highest_score = turn_result.score       # 가장 높은 점수 (답변이 없으면 -1)
 
             # --- Supervision/Single-pass Logic 후 최종 AI 답변 처리 ---
             if best_ai_response:
-                st.session_state.chat_history.append(("model", best_ai_response))
+                st.session_state.chat_history.append(Message("model", best_ai_response))
                 message_placeholder.markdown(best_ai_response)
                 if st.session_state.use_supervision: # Supervision 활성화 여부에 따라 토스트 메시지 변경
                     st.toast(f"대화가 성공적으로 완료되었습니다. 최종 점수: {highest_score:.2f}점", icon="👍")
@@ -1044,33 +1033,27 @@ if st.session_state.is_generating and not st.session_state.regenerate_requested:
             else:
                 st.error("모든 재시도 후에도 만족스러운 답변을 얻지 못했습니다. 이전 최고 점수 답변을 표시합니다.")
                 if highest_score != -1: # 적어도 하나의 답변이 생성되었으면 (최고 점수 답변이 있으면)
-                    st.session_state.chat_history.append(("model", best_ai_response))
+                    st.session_state.chat_history.append(Message("model", best_ai_response))
                     message_placeholder.markdown(best_ai_response)
                     if st.session_state.use_supervision: # Supervision 활성화 여부에 따라 토스트 메시지 변경
                         st.toast(f"최고 점수 답변이 표시되었습니다. 점수: {highest_score:.2f}점", icon="❗")
                     else:
                         st.toast("최고 점수 답변이 표시되었습니다.", icon="❗") # Supervision 비활성화 시 점수 표시 안 함
                 else: # 어떤 답변도 생성되지 못한 경우
-                    st.session_state.chat_history.append(("model", "죄송합니다. 현재 요청에 대해 답변을 생성할 수 없습니다."))
+                    st.session_state.chat_history.append(Message("model", "죄송합니다. 현재 요청에 대해 답변을 생성할 수 없습니다."))
                     message_placeholder.markdown("죄송합니다. 현재 요청에 대해 답변을 생성할 수 없습니다.")
 
-            st.session_state.uploaded_file = None
+            st.session_state.uploaded_files = []
             st.session_state.is_generating = False
 
             # 첫 상호작용 시 대화 제목 자동 생성 (Supervision 루프 완료 후)
             if st.session_state.current_title == "새로운 대화" and \
                len(st.session_state.chat_history) >= 2 and \
-               st.session_state.chat_history[-2][0] == "user" and st.session_state.chat_history[-1][0] == "model":
+               st.session_state.chat_history[-2].role == "user" and st.session_state.chat_history[-1].role == "model":
                 with st.spinner("대화 제목 생성 중..."):
-                    try:
-                        summary_prompt_text = st.session_state.chat_history[-2][1] # 사용자 프롬프트 가져오기
-                        summary = summary_model.generate_content(f"다음 사용자의 메시지를 요약해서 대화 제목으로 만들어줘 (한 문장, 30자 이내):\n\n{summary_prompt_text}")
-                        original_title = summary.text.strip().replace("\n", " ").replace('"', '')
-                        if not original_title or len(original_title) > 30: # 30자 이상이면 기본 제목 사용
-                            original_title = "새로운 대화"
-                    except Exception as e:
-                        print(f"제목 생성 오류: {e}. 기본 제목 사용.")
-                        original_title = "새로운 대화"
+                    summary_prompt_text = st.session_state.chat_history[-2].text # 사용자 프롬프트 가져오기
+                    title_model = turn_result.model_name or st.session_state.selected_model
+                    original_title = get_generation_engine().generate_title(title_model, summary_prompt_text, st.session_state.cancel_token) or "새로운 대화"
 
                     title_key = original_title
                     count = 1
@@ -1081,7 +1064,7 @@ if st.session_state.is_generating and not st.session_state.regenerate_requested:
                     st.toast(f"대화 제목이 '{title_key}'로 설정되었습니다.", icon="📝")
 
             # 성공적인 생성 후 Firestore에 데이터 저장 (Supervision 루프 완료 후)
-            st.session_state.saved_sessions[st.session_state.current_title] = st.session_state.chat_history.copy()
+            st.session_state.saved_sessions[st.session_state.current_title] = list(st.session_state.chat_history)
             current_instruction_for_save = st.session_state.temp_system_instruction if st.session_state.temp_system_instruction is not None else st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
             st.session_state.system_instructions[st.session_state.current_title] = current_instruction_for_save
             save_user_data_to_firestore(st.session_state.user_id)
@@ -0,0 +1,170 @@
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from context_cache import IMAGE_TOKEN_ESTIMATE
+from messages import AttachmentRef
+
+HISTORY_ATTACHMENT_TOKEN_BUDGET = 100_000 # 히스토리에 다시 첨부할 수 있는 최근 대화의 토큰 예산
+# 히스토리에 다시 첨부하는 데이터(base64)의 상한. Gemini 인라인 요청 한도(약 20MB)에서 이번 턴의 첨부와 본문 몫을 남깁니다.
+HISTORY_ATTACHMENT_BYTE_BUDGET = 12 * 1024 * 1024
+PART_CACHE_BYTES = 64 * 1024 * 1024 # base64로 변환한 첨부 파트를 메모리에 유지하는 상한 (턴마다 다시 읽고 인코딩하지 않도록)
+
+
+class LocalBlobStore:
+    """
+    Content-addressed blob backend on the local filesystem (`root/ab/abcdef...`).
+    Backends implement `put(digest, data)`, `get(digest)` and `exists(digest)`; data is raw bytes.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self._path(digest))
+
+    def put(self, digest, data):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, digest):
+        with open(self._path(digest), "rb") as f:
+            return f.read()
+
+
+class MemoryBlobStore:
+    """In-memory blob backend for tests and the HTTP server's stand-in mode."""
+
+    def __init__(self):
+        self._blobs = {}
+        self._lock = threading.Lock()
+
+    def exists(self, digest):
+        with self._lock:
+            return digest in self._blobs
+
+    def put(self, digest, data):
+        with self._lock:
+            self._blobs[digest] = bytes(data)
+
+    def get(self, digest):
+        with self._lock:
+            return self._blobs[digest]
+
+
+class AttachmentStore:
+    """
+    Persists processed attachment parts (Gemini `inline_data`) in a blob backend and hands out AttachmentRefs.
+    Blobs are keyed by the SHA-256 of their bytes, so the same image or PDF page is stored once
+    no matter how many conversations or users attach it.
+    Loaded parts are kept in an LRU of up to `part_cache_bytes` (base64 size) keyed by digest and shared
+    between callers, so they must not be mutated.
+    """
+
+    def __init__(self, backend, metrics=None, part_cache_bytes=PART_CACHE_BYTES):
+        self.backend = backend
+        self.metrics = metrics
+        self.part_cache_bytes = part_cache_bytes
+        self._parts = OrderedDict() # (digest, mime_type) -> inline_data 파트
+        self._parts_bytes = 0
+        self._parts_lock = threading.Lock()
+
+    def _incr(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    def save(self, data, mime_type, name=None):
+        digest = hashlib.sha256(data).hexdigest()
+        if self.backend.exists(digest):
+            self._incr("attachments.dedup_hits")
+            self._incr("attachments.dedup_bytes", len(data))
+        else:
+            self.backend.put(digest, data)
+            self._incr("attachments.stored_bytes", len(data))
+        return AttachmentRef(digest, mime_type, len(data), name)
+
+    def save_parts(self, parts, name=None):
+        """Stores every inline_data part (base64) and returns their refs in order."""
+        return [
+            self.save(base64.b64decode(part["inline_data"]["data"]), part["inline_data"]["mime_type"], name)
+            for part in parts if "inline_data" in part
+        ]
+
+    def load_part(self, ref):
+        key = (ref.digest, ref.mime_type)
+        with self._parts_lock:
+            part = self._parts.get(key)
+            if part is not None:
+                self._parts.move_to_end(key)
+        if part is not None:
+            self._incr("attachments.part_cache_hits")
+            return part
+        data = self.backend.get(ref.digest)
+        part = {"inline_data": {"mime_type": ref.mime_type, "data": base64.b64encode(data).decode("ascii")}}
+        size = len(part["inline_data"]["data"])
+        if size <= self.part_cache_bytes:
+            with self._parts_lock:
+                if key not in self._parts:
+                    self._parts[key] = part
+                    self._parts_bytes += size
+                while self._parts_bytes > self.part_cache_bytes:
+                    _, old = self._parts.popitem(last=False)
+                    self._parts_bytes -= len(old["inline_data"]["data"])
+        return part
+
+    def load_parts(self, refs):
+        parts = []
+        for ref in refs:
+            try:
+                parts.append(self.load_part(ref))
+            except (OSError, KeyError) as e:
+                print(f"첨부 파일을 불러오지 못했습니다 ({ref.digest[:12]}): {e}")
+                self._incr("attachments.missing")
+        return parts
+
+
+def encoded_size(ref):
+    """Request bytes of one attachment once base64 encoded, without loading it."""
+    return 4 * ((ref.size + 2) // 3)
+
+
+def build_gemini_history(history, attachment_store=None, token_budget=HISTORY_ATTACHMENT_TOKEN_BUDGET,
+                         byte_budget=HISTORY_ATTACHMENT_BYTE_BUDGET):
+    """
+    Converts Messages to Gemini history. Attachments are re-attached only for the most recent messages
+    whose text and attachments together fit in `token_budget`, and whose encoded attachments fit in `byte_budget`;
+    older messages are sent as text only.
+    """
+    if attachment_store is None or not any(message.attachments for message in history):
+        return [message.to_gemini() for message in history]
+    gemini_history = []
+    used_tokens = 0
+    used_bytes = 0
+    in_window = True
+    for message in reversed(history):
+        used_tokens += message.token_count
+        attachment_tokens = IMAGE_TOKEN_ESTIMATE * len(message.attachments)
+        attachment_bytes = sum(encoded_size(ref) for ref in message.attachments)
+        if (in_window and message.attachments and used_tokens + attachment_tokens <= token_budget
+                and used_bytes + attachment_bytes <= byte_budget):
+            used_tokens += attachment_tokens
+            used_bytes += attachment_bytes
+            parts = [{"text": message.text}] + attachment_store.load_parts(message.attachments)
+            gemini_history.append({"role": message.role, "parts": parts})
+            continue
+        if message.attachments:
+            # 예산을 넘긴 뒤로는 더 오래된 첨부를 다시 보내지 않습니다 (최근 대화만 문서를 유지).
+            in_window = False
+        gemini_history.append(message.to_gemini())
+    gemini_history.reverse()
+    return gemini_history
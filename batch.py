@@ -0,0 +1,195 @@
+"""
+Headless batch runner for the GenX generate -> supervise -> retry pipeline.
+
+Input is JSONL, one request per line:
+    {"id": "q1", "prompt": "...", "history": [{"role": "user", "text": "..."}, ...], "system_instruction": "..."}
+`history` and `system_instruction` are optional; `id` defaults to the line number.
+Results are appended to the output JSONL as they finish; rerunning with the same output resumes
+by skipping ids that already have a successful result (failed ids are retried, the last record wins).
+
+    python batch.py prompts.jsonl results.jsonl --supervision --workers 8
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from context_cache import ContextCacheManager
+from engine import EngineSettings, GeminiBackend, GenerationEngine, default_system_instruction
+from governor import RequestGovernor
+from messages import Message
+from metrics import MetricsRegistry
+from routing import DEFAULT_LATENCY_SLO, ModelRouter
+from standin import StandInBackend
+
+
+def read_requests(path):
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                print(f"{path}:{line_number}: JSON 파싱 실패, 건너뜁니다: {e}", file=sys.stderr)
+                continue
+            record.setdefault("id", str(line_number))
+            yield record
+
+
+def completed_ids(path):
+    """Ids with a successful result in an output file. A truncated last line (interrupted write) is ignored."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                request_id = str(result["id"])
+            except (ValueError, KeyError, TypeError):
+                continue
+            if result.get("error"):
+                done.discard(request_id)
+            else:
+                done.add(request_id)
+    return done
+
+
+def run_request(engine, settings, record):
+    history = [Message.from_dict(item) for item in record.get("history", [])]
+    contents = [{"text": record["prompt"]}]
+    started = time.monotonic()
+    result = engine.run_turn(
+        settings,
+        history=history,
+        contents=contents,
+        system_instruction=record.get("system_instruction") or default_system_instruction
+    )
+    return {
+        "id": record["id"],
+        "model": result.model_name or settings.model_name,
+        "response": result.response,
+        "score": result.score if settings.use_supervision else None,
+        "passed": result.passed,
+        "attempts": [{"score": attempt.score, "scores": attempt.scores, "aborted": attempt.aborted} for attempt in result.attempts],
+        "latency_s": round(time.monotonic() - started, 3),
+        "error": str(result.error) if result.error else None,
+    }
+
+
+class ThroughputReporter:
+    def __init__(self, interval):
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.done = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, result):
+        with self.lock:
+            self.done += 1
+            if result.get("error"):
+                self.errors += 1
+            now = time.monotonic()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                self.report()
+
+    def report(self, final=False):
+        elapsed = max(1e-9, time.monotonic() - self.started)
+        label = "완료" if final else "진행"
+        print(f"[{label}] {self.done}건 처리 · 오류 {self.errors}건 · {self.done / elapsed:.2f}건/초 · {elapsed:.0f}초 경과", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GenX 배치 생성/Supervision 실행기")
+    parser.add_argument("input", help="요청 JSONL 파일")
+    parser.add_argument("output", help="결과 JSONL 파일 (이미 있으면 이어서 처리)")
+    parser.add_argument("--model", default="gemini-2.5-flash", help="auto: 요청마다 모델 자동 선택")
+    parser.add_argument("--backend", choices=["gemini", "standin"], default="gemini", help="standin: 네트워크 없이 테스트")
+    parser.add_argument("--workers", type=int, default=8, help="동시에 처리할 요청 수")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="Gemini 동시 요청 수 (governor)")
+    parser.add_argument("--supervision", action="store_true")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--threshold", type=int, default=50)
+    parser.add_argument("--supervisors", type=int, default=3)
+    parser.add_argument("--no-batched", action="store_true", help="Supervisor 페르소나를 개별 요청으로 평가")
+    parser.add_argument("--no-cascade", action="store_true", help="Supervisor cascade 비활성화")
+    parser.add_argument("--cascade-band", type=int, default=10)
+    parser.add_argument("--streaming-supervision", action="store_true", help="생성 중간 점검으로 가망 없는 시도를 조기 중단")
+    parser.add_argument("--checkpoint-tokens", type=int, default=200)
+    parser.add_argument("--abort-margin", type=int, default=25)
+    parser.add_argument("--latency-slo", type=float, default=DEFAULT_LATENCY_SLO, help="--model auto의 TTFT 목표 (초)")
+    parser.add_argument("--routing-log", help="자동 모델 선택 결정과 결과를 기록할 JSONL 파일")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="처리량 보고 주기 (초)")
+    args = parser.parse_args(argv)
+
+    settings = EngineSettings(
+        model_name=args.model,
+        use_supervision=args.supervision,
+        max_retries=args.retries,
+        threshold=args.threshold,
+        supervisor_count=args.supervisors,
+        batched=not args.no_batched,
+        use_cascade=not args.no_cascade,
+        cascade_band=args.cascade_band,
+        use_streaming_supervision=args.streaming_supervision,
+        checkpoint_tokens=args.checkpoint_tokens,
+        abort_margin=args.abort_margin,
+        latency_slo=args.latency_slo
+    )
+    metrics = MetricsRegistry()
+    backend = StandInBackend() if args.backend == "standin" else GeminiBackend()
+    governor = RequestGovernor(max_concurrency=args.max_concurrency, metrics=metrics)
+    engine = GenerationEngine(
+        backend.main_model,
+        backend.supervisor_model,
+        backend.summary_model,
+        governor,
+        metrics,
+        context_cache=ContextCacheManager(backend.context_cache_backend(), metrics=metrics, governor=governor),
+        router=ModelRouter(metrics=metrics, log_path=args.routing_log)
+    )
+
+    skip = completed_ids(args.output)
+    if skip:
+        print(f"이미 처리된 {len(skip)}건을 건너뜁니다.", file=sys.stderr)
+    reporter = ThroughputReporter(args.report_interval)
+    # 입력을 한 번에 읽지 않도록 진행 중인 요청 수를 workers의 2배로 제한합니다.
+    max_in_flight = args.workers * 2
+    with open(args.output, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        pending = {}
+
+        def drain(return_when):
+            done, _ = wait(pending, return_when=return_when)
+            for future in done:
+                request_id = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"id": request_id, "model": settings.model_name, "response": "", "error": str(e)}
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                reporter.record(result)
+
+        for record in read_requests(args.input):
+            if str(record["id"]) in skip:
+                continue
+            if len(pending) >= max_in_flight:
+                drain(FIRST_COMPLETED)
+            pending[executor.submit(run_request, engine, settings, record)] = record["id"]
+        if pending:
+            drain(ALL_COMPLETED)
+    reporter.report(final=True)
+    governor_stats = metrics.snapshot()["counters"]
+    print(f"Gemini 요청 {governor_stats.get('governor.requests', 0):.0f}회 · 재시도 {governor_stats.get('governor.retries', 0):.0f}회", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import threading
+
+
+class GenerationCancelled(Exception):
+    """Raised inside the pipeline when its CancellationToken has been cancelled."""
+
+
+class CancellationToken:
+    """
+    Thread-safe cancellation flag shared by everything working on one turn.
+    Callbacks registered with `on_cancel` run once, on the thread that calls `cancel()`.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"취소 콜백 실행 중 오류 발생: {e}")
+
+    def on_cancel(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def wait(self, timeout):
+        """Sleeps up to `timeout` seconds, waking early on cancellation. Returns True if cancelled."""
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise GenerationCancelled()
@@ -0,0 +1,148 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from cancellation import CancellationToken
+
+DEFAULT_POOL_SIZE = 3 # 턴마다 보관하는 후보 답변 수 (재생성용)
+MAX_POOLS = 64 # 프로세스 전체에서 유지하는 턴(후보 풀) 수
+MAX_REFILL_ATTEMPTS = 4 # 한 번의 백그라운드 보충에서 생성하는 최대 답변 수 (기준 미달 답변 포함)
+
+
+def turn_key(model_name, system_instruction, history, contents):
+    """Identifies a turn by model, instruction, history (with attachment refs) and the current input parts."""
+    digest = hashlib.sha1()
+    digest.update(model_name.encode("utf-8") + b"\0")
+    digest.update(system_instruction.encode("utf-8") + b"\0")
+    for message in history:
+        digest.update(message.content_hash)
+        for ref in message.attachments:
+            digest.update(ref.digest.encode("ascii"))
+    digest.update(b"\1")
+    for part in contents:
+        if "inline_data" in part:
+            digest.update(part["inline_data"]["mime_type"].encode("utf-8") + b"\0")
+            digest.update(part["inline_data"]["data"].encode("ascii") + b"\0")
+        else:
+            digest.update(part.get("text", "").encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+class Candidate:
+    __slots__ = ("response", "score", "scores", "served")
+
+    def __init__(self, response, score=None, scores=(), served=False):
+        self.response = response
+        self.score = score # Supervision을 사용하지 않으면 None
+        self.scores = list(scores)
+        self.served = served # 이미 사용자에게 보여준 답변
+
+
+class CandidatePool:
+    """
+    Scored candidate answers of one turn, bounded to `max_size`.
+    When full, already served candidates are dropped first, then the lowest-scoring one.
+    """
+
+    def __init__(self, max_size=DEFAULT_POOL_SIZE):
+        self.max_size = max_size
+        self.refill_token = None # 진행 중인 백그라운드 보충의 취소 토큰
+        self.model_name = None # 후보를 생성한 모델 (자동 모델 선택 시 실제로 선택된 모델)
+        self._lock = threading.Lock()
+        self._candidates = []
+
+    @staticmethod
+    def _rank(candidate):
+        return -1 if candidate.score is None else candidate.score
+
+    def add(self, response, score=None, scores=(), served=False):
+        if not response:
+            return
+        with self._lock:
+            for candidate in self._candidates:
+                if candidate.response == response:
+                    candidate.served = candidate.served or served
+                    return
+            self._candidates.append(Candidate(response, score, scores, served))
+            while len(self._candidates) > self.max_size:
+                # 이미 보여준 답변(중복 확인용)을 먼저 버리고, 그다음 점수가 가장 낮은 후보를 버립니다.
+                served_candidates = [candidate for candidate in self._candidates if candidate.served]
+                if served_candidates:
+                    self._candidates.remove(served_candidates[0])
+                else:
+                    self._candidates.remove(min(self._candidates, key=self._rank))
+
+    def take(self, min_score=None):
+        """Marks and returns the best unserved candidate scoring at least `min_score`, or None."""
+        with self._lock:
+            eligible = [
+                candidate for candidate in self._candidates
+                if not candidate.served and (min_score is None or self._rank(candidate) >= min_score)
+            ]
+            if not eligible:
+                return None
+            best = max(eligible, key=self._rank)
+            best.served = True
+            return best
+
+    def unserved(self, min_score=None):
+        with self._lock:
+            return sum(
+                1 for candidate in self._candidates
+                if not candidate.served and (min_score is None or self._rank(candidate) >= min_score)
+            )
+
+    def __len__(self):
+        with self._lock:
+            return len(self._candidates)
+
+
+class CandidatePoolRegistry:
+    """Process-wide LRU of candidate pools keyed by `turn_key`. Evicted pools cancel their background refill."""
+
+    def __init__(self, max_pools=MAX_POOLS):
+        self.max_pools = max_pools
+        self._lock = threading.Lock()
+        self._pools = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None:
+                self._pools.move_to_end(key)
+            return pool
+
+    def pool(self, key, max_size=DEFAULT_POOL_SIZE):
+        evicted = []
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = CandidatePool(max_size)
+                self._pools[key] = pool
+                while len(self._pools) > self.max_pools:
+                    evicted.append(self._pools.popitem(last=False)[1])
+            else:
+                pool.max_size = max_size
+                self._pools.move_to_end(key)
+        for old in evicted:
+            if old.refill_token is not None:
+                old.refill_token.cancel()
+        return pool
+
+    def start_refill(self, pool):
+        """Returns a cancellation token for a new refill, or None when one is already running for `pool`."""
+        with self._lock:
+            if pool.refill_token is not None and not pool.refill_token.cancelled:
+                return None
+            pool.refill_token = CancellationToken()
+            return pool.refill_token
+
+    def finish_refill(self, pool, token):
+        with self._lock:
+            if pool.refill_token is token:
+                pool.refill_token = None
+
+    def stats(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        return {"pools": len(pools), "candidates": sum(len(pool) for pool in pools)}
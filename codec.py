@@ -0,0 +1,397 @@
+"""
+Optional compression of message bodies and system instructions in stored user documents.
+
+Bodies of at least `min_bytes` (UTF-8) are stored as a self-describing bytes payload
+    b"<method>.<dictionary>:<raw byte length>:<compressed data>"      e.g. b"zlib.d1:5123:..."
+in a `z` field (a Firestore bytes field) instead of `text`. Payload strings with base64 data, written by earlier
+versions and by JSON mirrors (see `payload_text`), load as well. The method (`zlib`, or `zstd` when the `zstandard` package is installed)
+and the preset dictionary are part of the payload, so documents written with any codec setting keep
+loading. Plain `text` fields from earlier versions load unchanged, and saving with the codec disabled
+writes plain text again. Messages are decoded lazily, on first access to `Message.text`.
+
+Dictionaries are frozen once released: never edit DICTIONARY_V1, add a new entry to DICTIONARIES instead.
+Custom dictionaries (see `python codec.py train`) are registered under an id derived from their SHA-1.
+
+    python codec.py train backup.ndjson.gz genx.dict
+    python codec.py stats backup.ndjson.gz --dictionary genx.dict --method zlib
+"""
+import argparse
+import base64
+import hashlib
+import os
+import sys
+import zlib
+from collections import Counter
+
+DEFAULT_MIN_BYTES = 1024 # 이보다 짧은 본문은 압축하지 않습니다 (압축 이득보다 헤더/필드 비용이 큼)
+DEFAULT_ZLIB_LEVEL = 6
+DEFAULT_ZSTD_LEVEL = 9
+MAX_STORED_RATIO = 0.9 # 저장 크기가 원문의 90%를 넘으면 압축하지 않고 그대로 저장합니다
+DEFAULT_DICTIONARY_BYTES = 16 * 1024
+
+# GenX 답변에 자주 나오는 한국어 문장 끝, 연결어, 마크다운/코드 구조. 자주 나오는 표현일수록 뒤쪽에 둡니다
+# (deflate는 가까운 위치의 일치를 더 짧게 부호화합니다).
+DICTIONARY_V1 = "\n".join((
+    "import numpy as np\nimport pandas as pd\nimport matplotlib.pyplot as plt\n",
+    "from typing import List, Dict, Optional\n",
+    "if __name__ == \"__main__\":\n    main()\n",
+    "def __init__(self, ",
+    "    return result\n",
+    "for i in range(len(",
+    "print(f\"",
+    "```javascript\nconst ",
+    "```bash\npip install ",
+    "```json\n{\n  \"",
+    "```python\ndef ",
+    "```python\nimport ",
+    "| 항목 | 설명 |\n|---|---|\n",
+    "| --- | --- | --- |\n",
+    "The following is an example of how to ",
+    "In summary, ",
+    "For example, ",
+    "Here is a step-by-step explanation:\n\n",
+    "시간 복잡도는 O(n)이며, 공간 복잡도는 O(1)입니다.",
+    "추가로 궁금한 점이 있으시면 언제든지 질문해 주세요.",
+    "도움이 되셨기를 바랍니다. 더 궁금한 점이 있으면 말씀해 주세요!",
+    "다음은 예제 코드입니다:\n\n```python\n",
+    "위 코드를 실행하면 다음과 같은 결과가 출력됩니다:\n\n```\n",
+    "이 함수는 입력값을 받아 결과를 반환합니다.",
+    "주의할 점은 다음과 같습니다:\n\n",
+    "장점과 단점을 비교하면 다음과 같습니다.\n\n",
+    "자세한 내용은 공식 문서를 참고하시기 바랍니다.",
+    "## 요약\n\n",
+    "## 결론\n\n",
+    "## 예시\n\n",
+    "### 1. ",
+    "### 2. ",
+    "### 3. ",
+    "**장점:** ",
+    "**단점:** ",
+    "**참고:** ",
+    "**주의:** ",
+    "**예시:**\n",
+    "결론적으로, ",
+    "요약하자면, ",
+    "정리하면 다음과 같습니다.\n\n",
+    "그러나 ",
+    "또한, ",
+    "따라서 ",
+    "예를 들어, ",
+    "즉, ",
+    "이러한 방식은 ",
+    "이를 통해 ",
+    "에 대해 설명드리겠습니다.\n\n",
+    "할 수 있습니다. ",
+    "하는 것이 좋습니다. ",
+    "해야 합니다. ",
+    "되어 있습니다. ",
+    "것입니다. ",
+    "있습니다.\n\n",
+    "합니다.\n\n",
+    "다음과 같습니다:\n\n",
+    "입니다.\n\n",
+    "습니다. ",
+    "니다.\n- **",
+    "\n\n1. **",
+    "\n2. **",
+    "\n3. **",
+    "**: ",
+    "\n- ",
+    "\n\n",
+))
+
+DICTIONARIES = {"d1": DICTIONARY_V1.encode("utf-8")} # id -> 사전 바이트 (저장된 데이터를 읽으려면 계속 유지해야 합니다)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def zstd_available():
+    return _zstandard() is not None
+
+
+def load_dictionary(path):
+    """Registers a dictionary file (e.g. from `train_dictionary`) and returns its id."""
+    with open(path, "rb") as f:
+        data = f.read()
+    dictionary_id = "h" + hashlib.sha1(data).hexdigest()[:12]
+    DICTIONARIES[dictionary_id] = data
+    return dictionary_id
+
+
+def _dictionary(dictionary_id):
+    data = DICTIONARIES.get(dictionary_id)
+    if data is None:
+        raise ValueError(f"압축 사전 '{dictionary_id}'를 찾을 수 없습니다. GENX_CODEC_DICTIONARY로 해당 사전 파일을 지정하세요.")
+    return data
+
+
+def _compress(method, dictionary, data, level):
+    if method == "zlib":
+        # 길이는 payload 헤더에 있으므로 zlib 헤더/체크섬 없는 raw deflate로 저장합니다.
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+        return compressor.compress(data) + compressor.flush()
+    zstandard = _zstandard()
+    zstd_dict = zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    return zstandard.ZstdCompressor(level=level, dict_data=zstd_dict, write_checksum=False).compress(data)
+
+
+def _decompress(method, dictionary, data, raw_length):
+    if method == "zlib":
+        decompressor = zlib.decompressobj(-15, zdict=dictionary)
+        return decompressor.decompress(data) + decompressor.flush()
+    if method == "zstd":
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise RuntimeError("zstd로 압축된 메시지를 읽으려면 zstandard 패키지가 필요합니다 (pip install zstandard).")
+        zstd_dict = zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        return zstandard.ZstdDecompressor(dict_data=zstd_dict).decompress(data, max_output_size=raw_length)
+    raise ValueError(f"지원하지 않는 압축 방식입니다: {method}")
+
+
+def _header(payload):
+    # 이전 버전과 JSON 미러는 base64 데이터를 담은 문자열 payload를 씁니다.
+    separator = ":" if isinstance(payload, str) else b":"
+    end = payload.index(separator, payload.index(separator) + 1)
+    codec_id, raw_length = payload[:end].split(separator)
+    if not isinstance(codec_id, str):
+        codec_id = codec_id.decode("ascii")
+    return codec_id, int(raw_length), end + 1
+
+
+def _parse(payload):
+    codec_id, raw_length, start = _header(payload)
+    data = base64.b64decode(payload[start:]) if isinstance(payload, str) else payload[start:]
+    return codec_id, raw_length, data
+
+
+def payload_sizes(payload):
+    """Returns (raw byte length, stored length) of a payload without decompressing it."""
+    _, raw_length, _ = _header(payload)
+    return raw_length, len(payload)
+
+
+def payload_text(payload):
+    """Returns the string form of a bytes payload (base64 data), for JSON files; `decode_text` reads both forms."""
+    codec_id, raw_length, data = _parse(payload)
+    return f"{codec_id}:{raw_length}:{base64.b64encode(data).decode('ascii')}"
+
+
+def decode_text(payload):
+    """Decompresses a payload written by any StorageCodec version."""
+    codec_id, raw_length, data = _parse(payload)
+    method, _, dictionary_id = codec_id.partition(".")
+    raw = _decompress(method, _dictionary(dictionary_id), data, raw_length)
+    if len(raw) != raw_length:
+        raise ValueError(f"압축된 메시지의 길이가 일치하지 않습니다 ({len(raw)}/{raw_length}).")
+    return raw.decode("utf-8")
+
+
+class StorageCodec:
+    """
+    Compresses stored text of at least `min_bytes` with a preset dictionary.
+    `method` is "zlib" (always available) or "zstd" (requires the `zstandard` package).
+    Reports to `metrics`:
+        storage.compressed_writes / raw_write_bytes / stored_write_bytes   compressed bodies written
+        storage.compressed_reads / raw_read_bytes / stored_read_bytes      compressed bodies loaded
+        storage.lazy_decodes                                               bodies actually decompressed
+    """
+
+    def __init__(self, method="zlib", dictionary_id="d1", min_bytes=DEFAULT_MIN_BYTES, level=None, metrics=None):
+        if method == "zstd" and not zstd_available():
+            raise RuntimeError("zstd 압축을 사용하려면 zstandard 패키지가 필요합니다 (pip install zstandard).")
+        if method not in ("zlib", "zstd"):
+            raise ValueError(f"지원하지 않는 압축 방식입니다: {method}")
+        self.method = method
+        self.dictionary_id = dictionary_id
+        self.dictionary = _dictionary(dictionary_id)
+        self.min_bytes = min_bytes
+        self.level = level if level is not None else (DEFAULT_ZLIB_LEVEL if method == "zlib" else DEFAULT_ZSTD_LEVEL)
+        self.metrics = metrics
+        self.codec_id = f"{method}.{dictionary_id}"
+        self._prefix = f"{self.codec_id}:".encode("ascii")
+
+    def _incr(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    def encode(self, text):
+        """
+        Returns the payload for `text`, or None when it should be stored as plain text
+        (shorter than `min_bytes`, or not compressible enough).
+        """
+        raw = text.encode("utf-8")
+        if len(raw) < self.min_bytes:
+            return None
+        payload = self._prefix + f"{len(raw)}:".encode("ascii") + _compress(self.method, self.dictionary, raw, self.level)
+        if len(payload) > len(raw) * MAX_STORED_RATIO:
+            return None
+        self._record_write(payload)
+        return payload
+
+    def reuse(self, payload):
+        """
+        Returns `payload` if it was written with this codec (so it can be stored again without recompressing),
+        otherwise None. String payloads are converted to bytes.
+        """
+        if isinstance(payload, str):
+            if not payload.startswith(self.codec_id + ":"):
+                return None
+            _, raw_length, data = _parse(payload)
+            payload = self._prefix + f"{raw_length}:".encode("ascii") + data
+        elif not payload.startswith(self._prefix):
+            return None
+        self._record_write(payload)
+        return payload
+
+    def _record_write(self, payload):
+        raw_length, stored_length = payload_sizes(payload)
+        self._incr("storage.compressed_writes")
+        self._incr("storage.raw_write_bytes", raw_length)
+        self._incr("storage.stored_write_bytes", stored_length)
+
+    def record_read(self, payload):
+        raw_length, stored_length = payload_sizes(payload)
+        self._incr("storage.compressed_reads")
+        self._incr("storage.raw_read_bytes", raw_length)
+        self._incr("storage.stored_read_bytes", stored_length)
+
+    def decode(self, payload):
+        self._incr("storage.lazy_decodes")
+        return decode_text(payload)
+
+    def encode_field(self, text):
+        # 시스템 명령어처럼 로드 시 바로 사용하는 문자열 필드: 압축하면 {"z": payload}, 아니면 문자열 그대로.
+        payload = self.encode(text) if isinstance(text, str) else None
+        return {"z": payload} if payload is not None else text
+
+    def decode_field(self, value):
+        if isinstance(value, dict) and "z" in value:
+            self.record_read(value["z"])
+            return self.decode(value["z"])
+        return value
+
+
+def decode_field(value, codec=None):
+    """Decodes a field written by `StorageCodec.encode_field`, with or without a configured codec."""
+    if codec is not None:
+        return codec.decode_field(value)
+    if isinstance(value, dict) and "z" in value:
+        return decode_text(value["z"])
+    return value
+
+
+def storage_summary(counters):
+    """Compression ratio and bytes saved on writes and reads, from a metrics counter snapshot."""
+    raw_written = counters.get("storage.raw_write_bytes", 0)
+    stored_written = counters.get("storage.stored_write_bytes", 0)
+    raw_read = counters.get("storage.raw_read_bytes", 0)
+    stored_read = counters.get("storage.stored_read_bytes", 0)
+    return {
+        "ratio": raw_written / stored_written if stored_written else None,
+        "write_bytes_saved": raw_written - stored_written,
+        "read_bytes_saved": raw_read - stored_read,
+        "compressed_reads": counters.get("storage.compressed_reads", 0),
+        "lazy_decodes": counters.get("storage.lazy_decodes", 0),
+    }
+
+
+def codec_from_env(metrics=None):
+    """
+    Builds the codec configured by GENX_STORAGE_CODEC ("off" (default), "zlib", "zstd" or "auto": zstd if installed),
+    GENX_CODEC_DICTIONARY (dictionary file; default: built-in DICTIONARY_V1) and GENX_CODEC_MIN_BYTES.
+    Returns None when compression is off. Custom dictionaries are registered even then, so existing data stays readable.
+    """
+    dictionary_path = os.getenv("GENX_CODEC_DICTIONARY")
+    dictionary_id = load_dictionary(dictionary_path) if dictionary_path else "d1"
+    method = os.getenv("GENX_STORAGE_CODEC", "off").lower()
+    if method in ("", "off", "none"):
+        return None
+    if method == "auto":
+        method = "zstd" if zstd_available() else "zlib"
+    min_bytes = int(os.getenv("GENX_CODEC_MIN_BYTES", str(DEFAULT_MIN_BYTES)))
+    return StorageCodec(method, dictionary_id, min_bytes=min_bytes, metrics=metrics)
+
+
+def train_dictionary(samples, size=DEFAULT_DICTIONARY_BYTES):
+    """
+    Builds a raw-content preset dictionary from sample texts (e.g. exported answers).
+    Lines and sentences that recur across samples are kept, weighted by frequency x length,
+    with the most valuable ones placed last (deflate encodes nearby matches more cheaply).
+    """
+    counts = Counter()
+    for sample in samples:
+        fragments = set()
+        for line in sample.splitlines():
+            line = line.strip()
+            if len(line) >= 6:
+                fragments.add(line + "\n")
+            for sentence in line.replace("? ", ". ").replace("! ", ". ").split(". "):
+                if 6 <= len(sentence) < len(line):
+                    fragments.add(sentence + ". ")
+        counts.update(fragments) # 샘플마다 한 번만 세어 긴 답변 하나가 사전을 채우지 않게 합니다
+    ranked = sorted(
+        ((count * len(fragment.encode("utf-8")), fragment) for fragment, count in counts.items() if count > 1),
+        reverse=True
+    )
+    chosen = []
+    total = 0
+    for _, fragment in ranked:
+        length = len(fragment.encode("utf-8"))
+        if total + length > size:
+            continue
+        chosen.append(fragment)
+        total += length
+    return "".join(reversed(chosen)).encode("utf-8")
+
+
+def _exported_texts(path):
+    from transfer import read_users
+    for _, user_data, _ in read_users(path):
+        for history in user_data.saved_sessions.values():
+            for message in history:
+                yield message.text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GenX 저장소 압축 사전 학습/평가")
+    parser.add_argument("command", choices=["train", "stats"])
+    parser.add_argument("path", help="transfer.py로 내보낸 NDJSON 파일")
+    parser.add_argument("output", nargs="?", help="train: 사전을 저장할 파일")
+    parser.add_argument("--size", type=int, default=DEFAULT_DICTIONARY_BYTES, help="train: 사전 크기 (바이트)")
+    parser.add_argument("--dictionary", help="stats: 평가할 사전 파일 (기본: 내장 사전)")
+    parser.add_argument("--method", choices=["zlib", "zstd"], default="zlib")
+    parser.add_argument("--min-bytes", type=int, default=DEFAULT_MIN_BYTES)
+    args = parser.parse_args(argv)
+
+    if args.command == "train":
+        if not args.output:
+            parser.error("train에는 사전을 저장할 파일 경로가 필요합니다.")
+        dictionary = train_dictionary(_exported_texts(args.path), args.size)
+        with open(args.output, "wb") as f:
+            f.write(dictionary)
+        print(f"사전 {len(dictionary)}바이트를 {args.output}에 저장했습니다.", file=sys.stderr)
+        return
+
+    dictionary_id = load_dictionary(args.dictionary) if args.dictionary else "d1"
+    codec = StorageCodec(args.method, dictionary_id, min_bytes=args.min_bytes)
+    messages = compressed = raw_total = stored_total = 0
+    for text in _exported_texts(args.path):
+        messages += 1
+        raw_length = len(text.encode("utf-8"))
+        payload = codec.encode(text)
+        raw_total += raw_length
+        stored_total += len(payload) if payload is not None else raw_length
+        compressed += payload is not None
+    ratio = raw_total / stored_total if stored_total else 0
+    print(f"{codec.codec_id}: 메시지 {messages}개 중 {compressed}개 압축 · 본문 {raw_total / 1e3:.0f}KB → {stored_total / 1e3:.0f}KB "
+          f"(비율 {ratio:.2f}, 절약 {(raw_total - stored_total) / 1e3:.0f}KB)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
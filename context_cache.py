@@ -0,0 +1,259 @@
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from cancellation import GenerationCancelled
+from governor import PRIORITY_MAIN
+from messages import estimate_tokens
+
+DEFAULT_CACHE_TTL = 600 # 캐시 핸들 유지 시간 (초)
+CACHE_REFRESH_MARGIN = 120 # 만료까지 이 시간보다 적게 남으면 TTL을 연장합니다
+CACHE_FAILURE_BACKOFF = 300 # 캐시 생성에 실패한 prefix는 이 시간 동안 인라인으로만 보냅니다
+IMAGE_TOKEN_ESTIMATE = 258 # Gemini가 이미지 한 장에 사용하는 대략적인 토큰 수
+# 모델별 명시적 캐시의 최소 토큰 수. 이보다 작은 prefix는 캐시할 수 없으므로 인라인으로 보냅니다.
+MIN_CACHE_TOKENS = {"gemini-2.5-flash": 1024, "gemini-2.5-pro": 4096, "gemini-2.0-flash": 4096}
+DEFAULT_MIN_CACHE_TOKENS = 4096
+
+
+def is_attachment(part):
+    return "inline_data" in part
+
+
+def part_bytes(part):
+    """Approximate request bytes of one Gemini part (base64 data or UTF-8 text)."""
+    if is_attachment(part):
+        return len(part["inline_data"]["data"])
+    return len(part.get("text", "").encode("utf-8"))
+
+
+def contents_bytes(contents):
+    return sum(part_bytes(part) for part in contents)
+
+
+def history_bytes(history):
+    """Approximate request bytes of Gemini history items (`{"role": ..., "parts": [...]}`)."""
+    return sum(contents_bytes(item["parts"]) for item in history)
+
+
+def cacheable_length(history):
+    """Number of leading history items up to and including the last one that carries an attachment."""
+    for index in range(len(history) - 1, -1, -1):
+        if any(is_attachment(part) for part in history[index]["parts"]):
+            return index + 1
+    return 0
+
+
+def prefix_tokens(system_instruction, history):
+    tokens = estimate_tokens(system_instruction)
+    for item in history:
+        for part in item["parts"]:
+            tokens += IMAGE_TOKEN_ESTIMATE if is_attachment(part) else estimate_tokens(part.get("text", ""))
+    return tokens
+
+
+def prefix_key(model_name, system_instruction, history):
+    digest = hashlib.sha1()
+    digest.update(model_name.encode("utf-8") + b"\0")
+    digest.update(system_instruction.encode("utf-8") + b"\0")
+    for item in history:
+        digest.update(item["role"].encode("utf-8") + b"\0")
+        for part in item["parts"]:
+            if is_attachment(part):
+                digest.update(part["inline_data"]["mime_type"].encode("utf-8") + b"\0")
+                digest.update(part["inline_data"]["data"].encode("ascii") + b"\0")
+            else:
+                digest.update(b"text\0" + part.get("text", "").encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+class CacheHandle:
+    __slots__ = ("key", "model_name", "cached", "model", "expires_at", "saved_bytes")
+
+    def __init__(self, key, model_name, cached, model, expires_at, saved_bytes):
+        self.key = key
+        self.model_name = model_name
+        self.cached = cached # 백엔드가 돌려준 캐시 객체 (Gemini CachedContent 등)
+        self.model = model # 캐시를 참조하는 GenerativeModel
+        self.expires_at = expires_at
+        self.saved_bytes = saved_bytes # 캐시 덕분에 요청마다 보내지 않아도 되는 바이트 수
+
+
+class CachedPrefix:
+    """A cache hit: the model bound to the cached prefix and the rest of the history, still sent inline."""
+
+    def __init__(self, handle, history):
+        self.handle = handle
+        self.history = history
+
+    @property
+    def model(self):
+        return self.handle.model
+
+
+class GeminiContextCacheBackend:
+    """Registers prefixes with the Gemini context caching API (google.generativeai.caching)."""
+
+    def __init__(self):
+        import google.generativeai as genai
+        from google.generativeai import caching
+        self._genai = genai
+        self._caching = caching
+
+    def create(self, model_name, system_instruction, history, ttl):
+        return self._caching.CachedContent.create(
+            model=f"models/{model_name}",
+            display_name="genx-prefix",
+            system_instruction=system_instruction,
+            contents=history or None,
+            ttl=datetime.timedelta(seconds=ttl)
+        )
+
+    def model(self, cached):
+        return self._genai.GenerativeModel.from_cached_content(cached_content=cached)
+
+    def refresh(self, cached, ttl):
+        cached.update(ttl=datetime.timedelta(seconds=ttl))
+
+    def delete(self, cached):
+        cached.delete()
+
+
+class ContextCacheManager:
+    """
+    Registers stable request prefixes once and reuses them by handle: the full system instruction plus the leading
+    history up to the last message with re-attached attachments (see attachments.build_gemini_history), which stays
+    the same from turn to turn. The current turn's parts are always sent after the history, as without a cache.
+    Handles are tracked locally with their expiry, refreshed shortly before they expire and evicted LRU.
+    `prepare` returns None whenever the prefix should be sent inline instead (too small, or the backend failed).
+    With a `governor` (governor.RequestGovernor), create and refresh calls are rate limited and retried like other Gemini calls.
+    """
+
+    def __init__(self, backend, ttl=DEFAULT_CACHE_TTL, refresh_margin=CACHE_REFRESH_MARGIN, max_handles=64,
+                 metrics=None, clock=time.monotonic, governor=None):
+        self.backend = backend
+        self.governor = governor
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.max_handles = max_handles
+        self.metrics = metrics
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._handles = OrderedDict() # key -> CacheHandle (LRU 순서)
+        self._key_locks = {} # key -> [Lock, 사용 중인 스레드 수]. 같은 prefix를 동시에 두 번 생성하지 않도록
+        self._failed_until = {}
+
+    def _incr(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    def _call(self, model_name, fn, *args, priority=PRIORITY_MAIN, cancel_token=None):
+        if self.governor is None:
+            return fn(*args)
+        return self.governor.call(model_name, fn, *args, priority=priority, cancel_token=cancel_token)
+
+    def prepare(self, model_name, system_instruction, history, priority=PRIORITY_MAIN, cancel_token=None):
+        """`history` is the Gemini history of the request; returns a CachedPrefix or None."""
+        split = cacheable_length(history)
+        cached_history = history[:split]
+        if prefix_tokens(system_instruction, cached_history) < MIN_CACHE_TOKENS.get(model_name, DEFAULT_MIN_CACHE_TOKENS):
+            return None
+        key = prefix_key(model_name, system_instruction, cached_history)
+        with self._lock:
+            if self._failed_until.get(key, 0) > self.clock():
+                return None
+            key_lock = self._key_locks.get(key)
+            if key_lock is None:
+                key_lock = self._key_locks[key] = [threading.Lock(), 0]
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                handle = self._lookup(key, priority, cancel_token)
+                if handle is None:
+                    handle = self._create(key, model_name, system_instruction, cached_history, priority, cancel_token)
+                    if handle is None:
+                        return None
+                else:
+                    # 처음 생성할 때는 prefix를 업로드하므로, 재사용할 때만 절약된 바이트로 셉니다.
+                    self._incr("context_cache.hits")
+                    self._incr("context_cache.bytes_saved", handle.saved_bytes)
+        finally:
+            # 아무도 기다리지 않는 prefix의 lock은 바로 지워 prefix 수만큼 쌓이지 않게 합니다.
+            with self._lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    del self._key_locks[key]
+        return CachedPrefix(handle, history[split:])
+
+    def _lookup(self, key, priority=PRIORITY_MAIN, cancel_token=None):
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is None:
+                return None
+            self._handles.move_to_end(key)
+        remaining_ttl = handle.expires_at - self.clock()
+        if remaining_ttl <= 0:
+            self._drop(handle)
+            return None
+        if remaining_ttl < self.refresh_margin:
+            try:
+                self._call(handle.model_name, self.backend.refresh, handle.cached, self.ttl, priority=priority, cancel_token=cancel_token)
+                handle.expires_at = self.clock() + self.ttl
+                self._incr("context_cache.refreshes")
+            except GenerationCancelled:
+                raise
+            except Exception as e:
+                print(f"컨텍스트 캐시 TTL 연장 실패: {e}")
+                self._drop(handle)
+                return None
+        return handle
+
+    def _create(self, key, model_name, system_instruction, history, priority=PRIORITY_MAIN, cancel_token=None):
+        self._incr("context_cache.misses")
+        try:
+            cached = self._call(model_name, self.backend.create, model_name, system_instruction, history, self.ttl,
+                                priority=priority, cancel_token=cancel_token)
+            model = self.backend.model(cached)
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            print(f"컨텍스트 캐시 생성 실패, 인라인으로 전송합니다: {e}")
+            self._incr("context_cache.fallbacks")
+            with self._lock:
+                now = self.clock()
+                self._failed_until = {k: until for k, until in self._failed_until.items() if until > now}
+                self._failed_until[key] = now + CACHE_FAILURE_BACKOFF
+            return None
+        handle = CacheHandle(key, model_name, cached, model, self.clock() + self.ttl, history_bytes(history) + len(system_instruction.encode("utf-8")))
+        self._incr("context_cache.creates")
+        with self._lock:
+            self._handles[key] = handle
+            evicted = []
+            while len(self._handles) > self.max_handles:
+                evicted.append(self._handles.popitem(last=False)[1])
+        for old in evicted:
+            self._delete(old)
+        return handle
+
+    def invalidate(self, handle, reason=None):
+        """Forgets a handle the backend rejected (e.g. expired server-side); the caller falls back to inline content."""
+        print(f"컨텍스트 캐시 무효화: {reason}")
+        self._incr("context_cache.fallbacks")
+        self._drop(handle)
+
+    def _drop(self, handle):
+        with self._lock:
+            if self._handles.get(handle.key) is handle:
+                del self._handles[handle.key]
+        self._delete(handle)
+
+    def _delete(self, handle):
+        try:
+            self.backend.delete(handle.cached)
+        except Exception as e:
+            print(f"컨텍스트 캐시 삭제 실패: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"handles": len(self._handles)}
@@ -0,0 +1,615 @@
+import dataclasses
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from attachments import build_gemini_history
+from candidates import DEFAULT_POOL_SIZE, MAX_REFILL_ATTEMPTS, CandidatePoolRegistry, turn_key
+from cancellation import GenerationCancelled
+from context_cache import GeminiContextCacheBackend, contents_bytes, history_bytes, is_attachment
+from governor import PRIORITY_MAIN, PRIORITY_TITLE, is_retryable_error
+from hedging import hedged_stream, hedge_deadline, timed_stream
+from messages import estimate_tokens
+from routing import AUTO_MODEL, DEFAULT_LATENCY_SLO, ModelRouter
+from supervision import (PERSONA_LIST, SYSTEM_INSTRUCTION_BATCH_SUPERVISOR, SYSTEM_INSTRUCTION_SUPERVISOR, HistoryDigestCache,
+                         StreamingSupervisor, SupervisorCascade, SupervisorContextBuilder)
+
+SUPER_INTRODUCTION_HEAD = """
+Make sure to think step-by-step when answering
+
+제 1원칙
+잘 모를 경우 "모르겠습니다"라고 명확히 밝힐 것.
+추측일 경우 "추측입니다."라고 명시할 것.
+출처가 불분명한 정보는 "(확실하지 않음)"이라고 표시할 것.
+단정짓지 말고, 근거가 있다면 함께 제시할 것.
+애매한 질문은 먼저 맥락과 상황을 물어볼 것.
+출처나 참고자료가 있다면 간단히 요약해서 알려줄 것.
+"""
+
+SUPER_INTRODUCTION_TAIL = """
+
+think about it step-by-step always
+
+"""
+
+
+default_system_instruction = "당신의 이름은 GenX입니다. 다만, 이 이름은 다른 이름이 선택되면 잊어버리십시오. 우선순위가 제일 낮습니다."
+
+SUPERVISOR_CASCADE_MODEL = "gemini-2.0-flash" # Supervisor cascade의 1단계 (가장 빠르고 저렴한 모델)
+HISTORY_DIGEST_MODEL = "gemini-2.0-flash" # Supervisor용 이전 대화 요약에 사용하는 모델
+SUPERVISOR_CONTEXT_TOKEN_BUDGET = 4000 # Supervisor 프롬프트의 채팅 히스토리 토큰 예산
+SUPERVISOR_RECENT_MESSAGES = 6 # 요약하지 않고 그대로 전달하는 최근 메시지 수
+STREAMING_SUPERVISOR_MODEL = "gemini-2.0-flash" # 생성 중간 점검에 사용하는 저렴한 Supervisor 모델
+CHECKPOINT_WORKERS = 4 # 중간 점검 요청을 실행하는 스레드 수 (스트리밍을 멈추지 않기 위해 별도 스레드에서 실행)
+DEFAULT_RESPONSE_TOKENS = 600 # 답변 길이 표본이 없을 때 사용하는 추정치 (취소로 절약된 토큰 계산용)
+DEFAULT_SUPERVISOR_PROMPT_TOKENS = 1500
+REFILL_WORKERS = 2 # 재생성용 후보 답변을 백그라운드에서 미리 생성하는 스레드 수
+
+
+def full_system_instruction(system_instruction):
+    return SUPER_INTRODUCTION_HEAD + system_instruction + SUPER_INTRODUCTION_TAIL
+
+
+class GeminiBackend:
+    """Creates (and caches) google.generativeai models outside of Streamlit."""
+
+    def __init__(self, api_key=None):
+        import google.generativeai as genai
+        genai.configure(api_key=api_key or os.getenv("GOOGLE_API_KEY"))
+        self._genai = genai
+
+    @functools.lru_cache(maxsize=64)
+    def main_model(self, model_name, system_instruction=default_system_instruction):
+        return self._genai.GenerativeModel(model_name=model_name, system_instruction=full_system_instruction(system_instruction))
+
+    @functools.lru_cache(maxsize=64)
+    def supervisor_model(self, model_name, system_instruction=default_system_instruction):
+        return self._genai.GenerativeModel(model_name=model_name, system_instruction=full_system_instruction(system_instruction))
+
+    @functools.lru_cache(maxsize=8)
+    def summary_model(self, model_name):
+        return self._genai.GenerativeModel(model_name)
+
+    def context_cache_backend(self):
+        return GeminiContextCacheBackend()
+
+
+@dataclass
+class EngineSettings:
+    """Per-turn options; mirrors the settings panel of the Streamlit app."""
+    model_name: str = "gemini-2.5-flash"
+    use_supervision: bool = False
+    max_retries: int = 3
+    threshold: int = 50
+    supervisor_count: int = 3
+    batched: bool = True
+    use_cascade: bool = True
+    cascade_band: int = 10
+    use_hedging: bool = False
+    hedge_percentile: int = 95
+    hedge_model: str = None
+    use_context_cache: bool = True
+    use_streaming_supervision: bool = False # 생성 중간에 점수를 예측해 가망 없는 시도를 조기 중단
+    checkpoint_tokens: int = 200
+    abort_margin: int = 25 # 예측 점수가 threshold - abort_margin 미만이면 중단하고 다시 생성
+    use_candidate_pool: bool = False # 턴마다 채점된 후보 답변을 보관해 재생성 시 즉시 제공 (백그라운드에서 보충)
+    candidate_pool_size: int = DEFAULT_POOL_SIZE
+    latency_slo: float = DEFAULT_LATENCY_SLO # model_name이 "auto"일 때 자동 선택이 지키려는 TTFT 목표 (초)
+
+
+@dataclass
+class Attempt:
+    response: str
+    score: float = None # Supervision을 사용하지 않으면 None
+    scores: list = field(default_factory=list)
+    aborted: bool = False # 중간 점검에서 조기 중단된 시도 (response는 중단 시점까지의 답변)
+
+
+@dataclass
+class TurnResult:
+    response: str = ""
+    score: float = -1 # 가장 높은 평균 점수 (답변이 없으면 -1)
+    passed: bool = False
+    attempts: list = field(default_factory=list)
+    error: Exception = None
+    cancelled: bool = False
+    tokens_avoided: float = 0 # 취소로 사용하지 않게 된 토큰 추정치
+    from_pool: bool = False # 재생성 시 후보 풀에서 바로 제공된 답변
+    model_name: str = None # 실제로 답변을 생성한 모델
+    routing: object = None # 자동 모델 선택 결정 (routing.RoutingDecision)
+
+
+class TurnCallbacks:
+    """No-op hooks the engine calls while a turn progresses. The Streamlit UI overrides them for display."""
+
+    def on_attempt_start(self, attempt, max_attempts):
+        pass
+
+    def on_chunk(self, text):
+        pass
+
+    def on_attempt_end(self, text):
+        pass
+
+    def on_attempt_scored(self, average, scores, passed):
+        pass
+
+    def on_attempt_aborted(self, projected_score, text):
+        pass
+
+    def on_candidate_served(self, text, score):
+        pass
+
+    def on_model_routed(self, decision):
+        pass
+
+    def on_error(self, exc):
+        pass
+
+
+def first_text_part(contents):
+    # Supervisor에 전달할 사용자 입력 텍스트 추출 (Gemini parts에서, 가장 첫 번째 텍스트 파트)
+    for part in contents:
+        if "text" in part:
+            return part["text"]
+    return ""
+
+
+class GenerationEngine:
+    """
+    UI-independent generate -> supervise -> retry pipeline shared by the Streamlit app and the batch CLI.
+    Model loaders take `(model_name, system_instruction)`; `load_summary_model` takes `(model_name)`.
+    With a `context_cache` (context_cache.ContextCacheManager), the instruction and attachments are sent once
+    and referenced by handle on later attempts, regenerations and turns.
+    With an `attachment_store` (attachments.AttachmentStore), attachments referenced by recent history messages
+    are re-attached to the Gemini history.
+    With `use_candidate_pool`, each turn keeps its scored attempts so `regenerate` can answer from the pool.
+    A `model_name` of "auto" lets `router` (routing.ModelRouter) pick the model for each turn.
+    """
+
+    def __init__(self, load_main_model, load_supervisor_model, load_summary_model, governor, metrics,
+                 context_cache=None, attachment_store=None, router=None):
+        self.load_main_model = load_main_model
+        self.load_supervisor_model = load_supervisor_model
+        self.load_summary_model = load_summary_model
+        self.governor = governor
+        self.metrics = metrics
+        self.context_cache = context_cache
+        self.attachment_store = attachment_store
+        self.checkpoint_executor = ThreadPoolExecutor(max_workers=CHECKPOINT_WORKERS, thread_name_prefix="checkpoint")
+        self.refill_executor = ThreadPoolExecutor(max_workers=REFILL_WORKERS, thread_name_prefix="candidate-refill")
+        self.candidate_pools = CandidatePoolRegistry()
+        self.router = router or ModelRouter(metrics=metrics)
+        self.digest_cache = HistoryDigestCache(self._generate_digest, metrics=metrics)
+        self._digest_model = None # 호출 스레드에서 미리 준비한 요약 모델 (백그라운드 보충용)
+
+    def _generate_digest(self, prompt):
+        digest_model = self._digest_model or self.load_summary_model(HISTORY_DIGEST_MODEL)
+        return self.governor.call(HISTORY_DIGEST_MODEL, digest_model.generate_content, prompt, priority=PRIORITY_TITLE).text
+
+    # Returns a factory that opens a fresh chat session over `history` and streams the reply through the governor.
+    # 재시도 시에도 새로운 chat_session으로 요청하므로 중복된 히스토리가 쌓이지 않습니다.
+    # 모델은 호출한 스레드에서 미리 준비하고 (Streamlit 캐시), 컨텍스트 캐시 등록과 히스토리 변환은 스트림을 실제로 열 때 합니다.
+    # 그래서 발사되지 않은 헤지 요청은 캐시를 만들지 않습니다. `gemini_history`(공유 builder)를 넘기면 히스토리를 한 번만 만듭니다.
+    # 캐시된 prefix(시스템 명령어와 첨부가 있는 앞부분 히스토리)가 있으면 캐시 모델에 나머지 히스토리와 이번 턴의 파트만 보내고,
+    # 캐시가 거부되면 전체 히스토리를 인라인으로 다시 요청합니다. 어느 쪽이든 이번 턴의 파트는 히스토리 뒤에 옵니다.
+    # 백그라운드 스레드에서는 `model`을 미리 준비해서 넘깁니다.
+    def open_main_stream(self, model_name, history, contents, system_instruction, use_context_cache=True,
+                         cancel_token=None, priority=PRIORITY_MAIN, gemini_history=None, model=None):
+        if model is None:
+            model = self.load_main_model(model_name, system_instruction)
+        if gemini_history is None:
+            gemini_history = self.history_builder(history)
+        def open_stream(stream_token=None):
+            # 헤지 경쟁에서는 스트림마다 별도 토큰을 받습니다. 턴이 취소되면 그 토큰도 함께 취소합니다.
+            token = cancel_token
+            if stream_token is not None:
+                if cancel_token is not None:
+                    cancel_token.on_cancel(stream_token.cancel)
+                token = stream_token
+            history_parts = gemini_history()
+            prefix = None
+            if use_context_cache and self.context_cache is not None:
+                prefix = self.context_cache.prepare(model_name, full_system_instruction(system_instruction), history_parts,
+                                                    priority=priority, cancel_token=token)
+            def start_stream():
+                nonlocal prefix
+                # 업로드 바이트에는 요청마다 인라인으로 보내는 히스토리(다시 첨부한 이미지/PDF 페이지 포함)도 포함합니다.
+                if prefix is not None:
+                    try:
+                        stream = prefix.model.start_chat(history=prefix.history).send_message(contents, stream=True)
+                        self.metrics.observe("main.upload_bytes", history_bytes(prefix.history) + contents_bytes(contents))
+                        return stream
+                    except Exception as e:
+                        if is_retryable_error(e):
+                            raise
+                        self.context_cache.invalidate(prefix.handle, e)
+                        prefix = None
+                self.metrics.observe("main.upload_bytes", history_bytes(history_parts) + contents_bytes(contents))
+                return model.start_chat(history=history_parts).send_message(contents, stream=True)
+            return self.governor.stream(model_name, start_stream, priority=priority, cancel_token=token)
+        return open_stream
+
+    def history_builder(self, history):
+        """Returns a thread-safe function that builds the Gemini history of `history` once, on first call."""
+        lock = threading.Lock()
+        built = []
+        def build():
+            with lock:
+                if not built:
+                    built.append(build_gemini_history(history, self.attachment_store))
+                return built[0]
+        return build
+
+    def stream_response(self, settings, history, contents, system_instruction, cancel_token=None):
+        model_name = settings.model_name
+        self.metrics.incr("main.streams")
+        gemini_history = self.history_builder(history)
+        open_primary = self.open_main_stream(model_name, history, contents, system_instruction, settings.use_context_cache,
+                                             cancel_token, gemini_history=gemini_history)
+        if not settings.use_hedging:
+            stream = timed_stream(open_primary(), self.metrics, model_name)
+        else:
+            hedge_model = settings.hedge_model or model_name
+            stream = hedged_stream(
+                open_primary,
+                self.open_main_stream(hedge_model, history, contents, system_instruction, settings.use_context_cache,
+                                      cancel_token, gemini_history=gemini_history),
+                deadline=hedge_deadline(self.metrics, model_name, settings.hedge_percentile),
+                metrics=self.metrics,
+                primary_model=model_name,
+                hedge_model=hedge_model
+            )
+        if any(is_attachment(part) for part in contents):
+            # 문서/이미지 대화의 TTFT를 따로 기록합니다 (ttft.documents).
+            stream = timed_stream(stream, self.metrics, "documents")
+        return stream
+
+    def _context_builder(self):
+        return SupervisorContextBuilder(
+            self.digest_cache,
+            token_budget=SUPERVISOR_CONTEXT_TOKEN_BUDGET,
+            keep_recent=SUPERVISOR_RECENT_MESSAGES
+        )
+
+    # Supervisor 패널을 실행하여 supervisor_count개의 점수를 반환합니다.
+    # Cascade가 켜져 있으면 저렴한 모델로 먼저 평가하고, 통과 기준 근처의 점수일 때만 선택된 모델로 다시 평가합니다.
+    # `load_model`을 넘기면 load_supervisor_model 대신 사용합니다 (preload_supervisor_models 참고).
+    def evaluate(self, settings, user_input, history, system_instruction, ai_response, cancel_token=None, load_model=None):
+        cascade = SupervisorCascade(
+            load_model or self.load_supervisor_model,
+            self.governor,
+            cheap_model=SUPERVISOR_CASCADE_MODEL if settings.use_cascade else settings.model_name,
+            strong_model=settings.model_name,
+            threshold=settings.threshold,
+            band=settings.cascade_band,
+            metrics=self.metrics,
+            context_builder=self._context_builder(),
+            cancel_token=cancel_token
+        )
+        return cascade.run(
+            settings.supervisor_count,
+            user_input=user_input,
+            chat_history=history,
+            system_instruction=system_instruction,
+            ai_response=ai_response,
+            batched=settings.batched
+        )
+
+    # Returns (text, projected_score, ttft); projected_score is set when `monitor` aborted the attempt mid-stream.
+    def _stream_attempt(self, settings, history, contents, system_instruction, callbacks, cancel_token, monitor=None):
+        full_response = ""
+        aborted_score = None
+        ttft = None
+        started = time.monotonic()
+        stream = self.stream_response(settings, history, contents, system_instruction, cancel_token)
+        try:
+            for chunk in stream:
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                full_response += chunk.text
+                callbacks.on_chunk(full_response)
+                if cancel_token is not None and cancel_token.cancelled:
+                    break
+                if monitor is not None:
+                    aborted_score = monitor.observe(full_response)
+                    if aborted_score is not None:
+                        break
+        finally:
+            stream.close() # 취소된 경우에도 스트림과 governor 슬롯을 즉시 반환합니다.
+            if monitor is not None:
+                monitor.finish()
+        callbacks.on_attempt_end(full_response)
+        return full_response, aborted_score, ttft
+
+    def _streaming_supervisor(self, settings, user_text, history, system_instruction, cancel_token):
+        try:
+            return StreamingSupervisor(
+                self.load_supervisor_model,
+                self.governor,
+                STREAMING_SUPERVISOR_MODEL,
+                self.checkpoint_executor,
+                user_input=user_text,
+                chat_history=history,
+                system_instruction=system_instruction,
+                threshold=settings.threshold,
+                margin=settings.abort_margin,
+                checkpoint_tokens=settings.checkpoint_tokens,
+                metrics=self.metrics,
+                context_builder=self._context_builder(),
+                cancel_token=cancel_token
+            )
+        except Exception as e:
+            print(f"중간 Supervisor 준비 실패, 중간 점검 없이 생성합니다: {e}")
+            return None
+
+    def _mean_or(self, name, default):
+        mean = self.metrics.mean(name)
+        return default if mean is None else mean
+
+    def record_cancellation(self, settings, attempt_number, max_attempts, stage, partial_text=""):
+        """
+        Estimates and records the tokens a cancelled turn did not spend.
+        `stage` is where the turn stopped: "stream" (mid-answer), "evaluate" (during supervision)
+        or "next" (before `attempt_number` started). Skipped retries are weighted by the observed
+        supervision failure rate, since they would only have run if the attempts before them failed.
+        """
+        response_tokens = self._mean_or("main.response_tokens", DEFAULT_RESPONSE_TOKENS)
+        evaluation_tokens = 0
+        if settings.use_supervision:
+            prompt_tokens = self._mean_or("supervisor.prompt_tokens", DEFAULT_SUPERVISOR_PROMPT_TOKENS)
+            evaluation_tokens = prompt_tokens * (1 if settings.batched else settings.supervisor_count)
+        if stage == "stream":
+            avoided = max(0, response_tokens - estimate_tokens(partial_text)) + evaluation_tokens
+        elif stage == "evaluate":
+            avoided = evaluation_tokens
+        else:
+            avoided = response_tokens + evaluation_tokens
+        scored = self.metrics.count("engine.attempts_scored")
+        fail_rate = self.metrics.count("engine.attempts_failed") / scored if scored else 0.5
+        expected_retries = sum(fail_rate ** k for k in range(1, max_attempts - attempt_number + 1))
+        avoided += expected_retries * (response_tokens + evaluation_tokens)
+        self.metrics.incr("cancel.turns")
+        self.metrics.incr("cancel.tokens_avoided", avoided)
+        return avoided
+
+    def _cancel(self, result, settings, attempt_number, max_attempts, stage, partial_text=""):
+        result.cancelled = True
+        if not result.response:
+            result.response = partial_text # 완료된 답변이 없으면 중단된 시점까지의 답변을 유지합니다.
+        result.tokens_avoided = self.record_cancellation(settings, attempt_number, max_attempts, stage, partial_text)
+
+    def run_turn(self, settings, history, contents, system_instruction, user_text=None, callbacks=None,
+                 cancel_token=None):
+        """
+        Generates an answer to `contents` (Gemini parts) after `history` (Messages, excluding the current input).
+        With supervision, retries up to `max_retries` times and keeps the best-scoring attempt. With streaming
+        supervision, attempts whose projected score falls well below the threshold are aborted mid-stream.
+        Cancelling `cancel_token` closes the stream and skips remaining supervision and retries; the best
+        finished attempt (or else the partial answer) is returned with `cancelled` set.
+        With `model_name` "auto", the router picks the model and the turn's outcome is fed back to it.
+        """
+        callbacks = callbacks or TurnCallbacks()
+        result = TurnResult()
+        if user_text is None:
+            user_text = first_text_part(contents)
+        pool_key = turn_key(settings.model_name, system_instruction, history, contents) if settings.use_candidate_pool else None
+        settings, result.routing = self._route(settings, history, contents)
+        result.model_name = settings.model_name
+        if result.routing is not None:
+            callbacks.on_model_routed(result.routing)
+        started = time.monotonic()
+        first_ttft = None
+        max_attempts = settings.max_retries if settings.use_supervision else 1
+        monitor = None
+        if settings.use_supervision and settings.use_streaming_supervision and max_attempts > 1:
+            monitor = self._streaming_supervisor(settings, user_text, history, system_instruction, cancel_token)
+        for attempt_number in range(1, max_attempts + 1):
+            if cancel_token is not None and cancel_token.cancelled:
+                self._cancel(result, settings, attempt_number, max_attempts, "next")
+                break
+            callbacks.on_attempt_start(attempt_number, max_attempts)
+            full_response = ""
+            stage = "stream"
+            # 마지막 시도는 다시 생성할 기회가 없으므로 중간 점검 없이 끝까지 생성합니다.
+            attempt_monitor = monitor if attempt_number < max_attempts else None
+            if attempt_monitor is not None:
+                attempt_monitor.start_attempt()
+            try:
+                full_response, aborted_score, ttft = self._stream_attempt(
+                    settings, history, contents, system_instruction, callbacks, cancel_token, attempt_monitor
+                )
+                if first_ttft is None:
+                    first_ttft = ttft
+                if cancel_token is not None and cancel_token.cancelled:
+                    self._cancel(result, settings, attempt_number, max_attempts, stage, full_response)
+                    break
+                if aborted_score is not None:
+                    result.attempts.append(Attempt(full_response, aborted_score, [aborted_score], aborted=True))
+                    self.metrics.incr("checkpoint.aborts")
+                    self.metrics.incr("checkpoint.tokens_saved", max(
+                        0, self._mean_or("main.response_tokens", DEFAULT_RESPONSE_TOKENS) - estimate_tokens(full_response)
+                    ))
+                    self.metrics.incr("engine.attempts_scored")
+                    self.metrics.incr("engine.attempts_failed")
+                    callbacks.on_attempt_aborted(aborted_score, full_response)
+                    continue
+                self.metrics.observe("main.response_tokens", estimate_tokens(full_response))
+                if not settings.use_supervision:
+                    result.attempts.append(Attempt(full_response))
+                    result.response = full_response
+                    result.score = 100 # Supervision이 아니므로 점수는 의미 없지만 호출 측 일관성을 위해 임의 값 부여
+                    result.passed = True
+                    break
+
+                stage = "evaluate"
+                scores = self.evaluate(settings, user_text, history, system_instruction, full_response, cancel_token)
+                avg_score = sum(scores) / len(scores)
+                passed = avg_score >= settings.threshold
+                result.attempts.append(Attempt(full_response, avg_score, scores))
+                self.metrics.incr("engine.attempts_scored")
+                callbacks.on_attempt_scored(avg_score, scores, passed)
+                if avg_score > result.score:
+                    result.score = avg_score
+                    result.response = full_response
+                if passed:
+                    result.passed = True
+                    break
+                self.metrics.incr("engine.attempts_failed")
+            except GenerationCancelled:
+                self._cancel(result, settings, attempt_number, max_attempts, stage, full_response)
+                break
+            except Exception as e:
+                result.error = e
+                self.metrics.incr("engine.errors")
+                callbacks.on_error(e)
+                break
+        if result.routing is not None:
+            scores = [attempt.score for attempt in result.attempts if attempt.score is not None and not attempt.aborted]
+            self.router.record_result(
+                result.routing,
+                ttft=first_ttft,
+                seconds=time.monotonic() - started,
+                score=sum(scores) / len(scores) if scores else None,
+                passed=result.passed if settings.use_supervision else None,
+                error=result.error
+            )
+        if pool_key is not None and not result.cancelled and result.error is None:
+            self._pool_attempts(settings, pool_key, history, contents, system_instruction, user_text, result)
+        return result
+
+    # 자동 모델 선택: 라우터가 고른 모델로 바꾼 설정과 결정을 돌려줍니다 (직접 고른 모델이면 그대로).
+    def _route(self, settings, history, contents):
+        if settings.model_name != AUTO_MODEL:
+            return settings, None
+        decision = self.router.route(
+            history, contents,
+            latency_slo=settings.latency_slo,
+            threshold=settings.threshold if settings.use_supervision else None
+        )
+        return dataclasses.replace(settings, model_name=decision.model_name), decision
+
+    # --- Candidate pool ---
+    # 턴에서 생성된 답변을 점수와 함께 보관하고, 재생성 요청 시 아직 보여주지 않은 가장 좋은 답변을 즉시 제공합니다.
+    def _pool_min_score(self, settings):
+        return settings.threshold if settings.use_supervision else None
+
+    def _pool_attempts(self, settings, key, history, contents, system_instruction, user_text, result):
+        pool = self.candidate_pools.pool(key, settings.candidate_pool_size)
+        pool.model_name = settings.model_name
+        for attempt in result.attempts:
+            if not attempt.aborted:
+                pool.add(attempt.response, attempt.score, attempt.scores, served=attempt.response == result.response)
+        self._schedule_refill(settings, history, contents, system_instruction, user_text, pool)
+
+    def preload_supervisor_models(self, settings):
+        """
+        Loads every supervisor model `evaluate` may use for `settings` on the calling thread and returns a
+        loader over them, so worker threads never touch the (Streamlit-cached) model loaders.
+        """
+        model_names = {settings.model_name}
+        if settings.use_cascade:
+            model_names.add(SUPERVISOR_CASCADE_MODEL)
+        instructions = [persona + "\n" + SYSTEM_INSTRUCTION_SUPERVISOR for persona in PERSONA_LIST]
+        instructions.append(SYSTEM_INSTRUCTION_BATCH_SUPERVISOR)
+        models = {(model_name, instruction): self.load_supervisor_model(model_name, instruction)
+                  for model_name in model_names for instruction in instructions}
+        return lambda model_name, system_instruction: models[(model_name, system_instruction)]
+
+    # 모델은 호출한 스레드(Streamlit 스크립트 스레드)에서 준비하고, 보충 스레드에는 준비된 모델만 넘깁니다.
+    # Streamlit 캐시 함수는 ScriptRunContext가 없는 스레드에서 호출하면 안 됩니다.
+    def _schedule_refill(self, settings, history, contents, system_instruction, user_text, pool):
+        target = max(1, settings.candidate_pool_size - 1)
+        if pool.unserved(self._pool_min_score(settings)) >= target:
+            return
+        token = self.candidate_pools.start_refill(pool)
+        if token is None:
+            return
+        try:
+            model = self.load_main_model(settings.model_name, system_instruction)
+            load_supervisor = None
+            if settings.use_supervision:
+                load_supervisor = self.preload_supervisor_models(settings)
+                if self._digest_model is None:
+                    self._digest_model = self.load_summary_model(HISTORY_DIGEST_MODEL)
+        except Exception:
+            self.candidate_pools.finish_refill(pool, token)
+            raise
+        self.refill_executor.submit(self._refill, settings, list(history), contents, system_instruction, user_text, pool,
+                                    token, target, model, load_supervisor)
+
+    def _refill(self, settings, history, contents, system_instruction, user_text, pool, token, target, model,
+                load_supervisor):
+        min_score = self._pool_min_score(settings)
+        try:
+            for _ in range(MAX_REFILL_ATTEMPTS):
+                if token.cancelled or pool.unserved(min_score) >= target:
+                    break
+                open_stream = self.open_main_stream(settings.model_name, history, contents, system_instruction,
+                                                    settings.use_context_cache, token, priority=PRIORITY_TITLE, model=model)
+                stream = open_stream()
+                try:
+                    text = "".join(chunk.text for chunk in stream)
+                finally:
+                    stream.close()
+                self.metrics.incr("candidates.refills")
+                if not settings.use_supervision:
+                    pool.add(text)
+                    continue
+                scores = self.evaluate(settings, user_text, history, system_instruction, text, token, load_supervisor)
+                pool.add(text, sum(scores) / len(scores), scores)
+        except GenerationCancelled:
+            pass
+        except Exception as e:
+            print(f"후보 답변 보충 실패: {e}")
+        finally:
+            self.candidate_pools.finish_refill(pool, token)
+
+    def regenerate(self, settings, history, contents, system_instruction, user_text=None, callbacks=None,
+                   cancel_token=None):
+        """
+        Like `run_turn`, but first serves the best unserved candidate of this turn's pool (if it meets the
+        threshold) without any model call, then refills the pool in the background.
+        """
+        if settings.use_candidate_pool:
+            callbacks = callbacks or TurnCallbacks()
+            if user_text is None:
+                user_text = first_text_part(contents)
+            pool = self.candidate_pools.get(turn_key(settings.model_name, system_instruction, history, contents))
+            candidate = pool.take(self._pool_min_score(settings)) if pool is not None else None
+            if candidate is not None:
+                self.metrics.incr("candidates.hits")
+                callbacks.on_candidate_served(candidate.response, candidate.score)
+                # 자동 모델 선택이면 후보를 만든 모델로 보충합니다.
+                pool_settings = dataclasses.replace(settings, model_name=pool.model_name or settings.model_name)
+                self._schedule_refill(pool_settings, history, contents, system_instruction, user_text, pool)
+                score = candidate.score if candidate.score is not None else 100
+                return TurnResult(candidate.response, score, True, [Attempt(candidate.response, candidate.score, candidate.scores)],
+                                  from_pool=True, model_name=pool_settings.model_name)
+            self.metrics.incr("candidates.misses")
+        return self.run_turn(settings, history, contents, system_instruction, user_text, callbacks, cancel_token)
+
+    def generate_title(self, model_name, user_text, cancel_token=None):
+        """Summarizes the first user message into a conversation title (None on failure or cancellation)."""
+        try:
+            summary_model = self.load_summary_model(model_name)
+            summary = self.governor.call(
+                model_name,
+                summary_model.generate_content,
+                f"다음 사용자의 메시지를 요약해서 대화 제목으로 만들어줘 (한 문장, 30자 이내):\n\n{user_text}",
+                priority=PRIORITY_TITLE,
+                cancel_token=cancel_token
+            )
+            title = summary.text.strip().replace("\n", " ").replace('"', '')
+        except GenerationCancelled:
+            return None
+        except Exception as e:
+            print(f"제목 생성 오류: {e}. 기본 제목 사용.")
+            return None
+        if not title or len(title) > 30: # 30자 이상이면 기본 제목 사용
+            return None
+        return title
+
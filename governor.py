@@ -0,0 +1,250 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from cancellation import GenerationCancelled
+
+# 요청 우선순위 (값이 작을수록 먼저 처리됩니다)
+PRIORITY_MAIN = 0        # 사용자에게 스트리밍되는 메인 답변
+PRIORITY_SUPERVISOR = 1  # Supervisor 평가
+PRIORITY_TITLE = 2       # 대화 제목 생성 등 백그라운드 작업
+
+# 모델별 분당 요청 수 제한 (requests per minute)
+DEFAULT_MODEL_RPM = {
+    "gemini-2.5-pro": 150,
+    "gemini-2.5-flash": 1000,
+    "gemini-2.0-flash": 2000,
+}
+DEFAULT_RPM = 300 # 목록에 없는 모델에 적용되는 기본값
+CANCEL_POLL_SECONDS = 0.2 # 슬롯을 기다리는 동안 취소 여부를 확인하는 간격
+
+RETRYABLE_EXCEPTIONS = (ConnectionError, TimeoutError)
+
+
+def close_stream(stream):
+    """Best-effort close of a streaming response so the server stops generating (and billing) it."""
+    for target in (stream, getattr(stream, "_iterator", None)): # Gemini 스트림 응답은 내부 iterator(gRPC 호출)를 닫아야 합니다
+        if target is None:
+            continue
+        close = getattr(target, "cancel", None) or getattr(target, "close", None)
+        if close is None:
+            continue
+        try:
+            close()
+        except ValueError:
+            pass # 다른 스레드에서 실행 중인 generator는 닫을 수 없습니다. 소유 스레드가 다음 청크에서 멈춥니다.
+        except Exception as e:
+            print(f"스트림 종료 중 오류 발생: {e}")
+
+
+def is_retryable_error(exc):
+    """Returns True for 429 / 5xx API errors and transient network failures."""
+    if isinstance(exc, RETRYABLE_EXCEPTIONS):
+        return True
+    # google.api_core exceptions expose the HTTP status as `code`.
+    code = getattr(exc, "code", None)
+    if callable(code):
+        try:
+            code = code()
+        except Exception:
+            code = None
+    if isinstance(code, int):
+        return code == 429 or 500 <= code < 600
+    return False
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes one token and returns how long the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class PrioritySemaphore:
+    """Counting semaphore that wakes waiters by (priority, arrival order)."""
+
+    def __init__(self, limit):
+        self._available = limit
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def acquire(self, priority, cancel_token=None):
+        """Waits for a slot; raises GenerationCancelled (without taking one) once `cancel_token` is cancelled."""
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            while not (self._available > 0 and self._waiters[0] == entry):
+                if cancel_token is not None and cancel_token.cancelled:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    # 대기열 맨 앞이 바뀌었을 수 있으므로 다른 대기자를 깨웁니다.
+                    self._cond.notify_all()
+                    raise GenerationCancelled()
+                self._cond.wait(CANCEL_POLL_SECONDS if cancel_token is not None else None)
+            heapq.heappop(self._waiters)
+            self._available -= 1
+            # 다음 대기자도 슬롯이 남아 있다면 진행할 수 있도록 깨웁니다.
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._available += 1
+            self._cond.notify_all()
+
+
+class RequestGovernor:
+    """
+    Process-wide gate for every Gemini call.
+    Applies per-model rate limits, a global concurrency cap with priorities,
+    and retries 429/5xx failures with jittered exponential backoff.
+    """
+
+    def __init__(self, max_concurrency=8, model_rpm=None, max_retries=4,
+                 base_delay=1.0, max_delay=30.0, metrics=None):
+        self._slots = PrioritySemaphore(max_concurrency)
+        self._model_rpm = dict(DEFAULT_MODEL_RPM if model_rpm is None else model_rpm)
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics
+
+    def _bucket(self, model_name):
+        with self._buckets_lock:
+            bucket = self._buckets.get(model_name)
+            if bucket is None:
+                rpm = self._model_rpm.get(model_name, DEFAULT_RPM)
+                # 1초 분량의 버스트를 허용합니다 (최소 1개).
+                bucket = TokenBucket(rate=rpm / 60.0, capacity=max(1.0, rpm / 60.0))
+                self._buckets[model_name] = bucket
+            return bucket
+
+    def _incr(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    def _backoff(self, attempt):
+        # Full jitter: 0 ~ min(max_delay, base * 2^attempt)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    @staticmethod
+    def _sleep(delay, cancel_token):
+        # 취소 토큰이 있으면 대기 중에도 즉시 깨어나 GenerationCancelled를 발생시킵니다.
+        if cancel_token is None:
+            time.sleep(delay)
+        elif cancel_token.wait(delay):
+            raise GenerationCancelled()
+
+    def _enter(self, model_name, priority, cancel_token=None):
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        # Rate limit 대기는 슬롯을 잡기 전에 합니다. 대기 중인 요청이 슬롯을 차지해 다른(우선순위 높은) 요청을 막지 않도록.
+        wait = self._bucket(model_name).reserve()
+        if wait > 0:
+            self._incr("governor.throttled_seconds", wait)
+            self._sleep(wait, cancel_token)
+        self._slots.acquire(priority, cancel_token)
+        if cancel_token is not None and cancel_token.cancelled:
+            self._slots.release()
+            raise GenerationCancelled()
+        self._incr("governor.requests")
+
+    def call(self, model_name, fn, *args, priority=PRIORITY_SUPERVISOR, cancel_token=None, **kwargs):
+        """
+        Runs `fn(*args, **kwargs)` under the governor and returns its result.
+        Raises GenerationCancelled instead of starting (or retrying) the call once `cancel_token` is cancelled.
+        """
+        attempt = 0
+        while True:
+            self._enter(model_name, priority, cancel_token)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    self._incr("governor.failures")
+                    raise
+                delay = self._backoff(attempt)
+                print(f"Gemini 요청 재시도 ({attempt + 1}/{self.max_retries}, {delay:.1f}초 후): {e}")
+            finally:
+                self._slots.release()
+            self._incr("governor.retries")
+            self._sleep(delay, cancel_token)
+            attempt += 1
+
+    def stream(self, model_name, start_stream, priority=PRIORITY_MAIN, cancel_token=None):
+        """
+        Generator wrapping a streaming call. `start_stream()` must open a fresh stream each time.
+        Failures before the first chunk are retried; once data has been yielded errors propagate.
+        The concurrency slot is held until the stream is exhausted or closed, or until `cancel_token` is cancelled:
+        cancellation releases the slot and closes the response right away, from the cancelling thread,
+        instead of waiting for the consumer to see the next chunk.
+        """
+        attempt = 0
+        while True:
+            self._enter(model_name, priority, cancel_token)
+            release = self._slots.release if cancel_token is None else self._release_once()
+            try:
+                response = start_stream()
+                iterator = iter(response)
+                if cancel_token is not None:
+                    cancel_token.on_cancel(lambda release=release, response=response: (release(), close_stream(response)))
+                first = next(iterator, None)
+            except Exception as e:
+                release()
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    self._incr("governor.failures")
+                    raise
+                delay = self._backoff(attempt)
+                print(f"Gemini 스트림 재시도 ({attempt + 1}/{self.max_retries}, {delay:.1f}초 후): {e}")
+                self._incr("governor.retries")
+                self._sleep(delay, cancel_token)
+                attempt += 1
+                continue
+            break
+        try:
+            if first is not None:
+                yield first
+            yield from iterator
+        finally:
+            release()
+
+    def _release_once(self):
+        # 취소 콜백과 스트림 종료가 모두 슬롯을 반환하려 하므로 한 번만 반환합니다.
+        lock = threading.Lock()
+        released = []
+        def release():
+            with lock:
+                if released:
+                    return
+                released.append(True)
+            self._slots.release()
+        return release
+
+    def stats(self):
+        if self.metrics is None:
+            return {}
+        return {
+            "requests": self.metrics.count("governor.requests"),
+            "retries": self.metrics.count("governor.retries"),
+            "failures": self.metrics.count("governor.failures"),
+            "throttled_seconds": self.metrics.count("governor.throttled_seconds"),
+        }
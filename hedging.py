@@ -0,0 +1,161 @@
+import queue
+import threading
+import time
+
+from cancellation import CancellationToken
+from governor import close_stream
+
+DEFAULT_HEDGE_DEADLINE = 4.0 # TTFT 샘플이 부족할 때 사용하는 기본 대기 시간 (초)
+MIN_HEDGE_DEADLINE = 0.5
+MIN_TTFT_SAMPLES = 20
+
+
+def ttft_metric(model_name):
+    return f"ttft.{model_name}"
+
+
+def hedge_deadline(metrics, model_name, percentile, default=DEFAULT_HEDGE_DEADLINE):
+    """Returns the TTFT percentile for `model_name`, or `default` until enough samples exist."""
+    name = ttft_metric(model_name)
+    if metrics.sample_count(name) < MIN_TTFT_SAMPLES:
+        return default
+    return max(MIN_HEDGE_DEADLINE, metrics.percentile(name, percentile))
+
+
+def timed_stream(stream, metrics, model_name):
+    """Passes chunks through unchanged and records the time to the first chunk."""
+    started = time.monotonic()
+    first = True
+    try:
+        for chunk in stream:
+            if first:
+                metrics.observe(ttft_metric(model_name), time.monotonic() - started)
+                first = False
+            yield chunk
+    finally:
+        close_stream(stream)
+
+
+class _Race:
+    """Shared bookkeeping between the primary and hedge runners."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.primary = None
+        self.hedge = None
+        self.winner = None
+
+    def first_chunk(self, runner):
+        with self.lock:
+            runner.first_at = time.monotonic()
+            if self.metrics is None:
+                return
+            self.metrics.observe(ttft_metric(runner.model_name), runner.first_at - runner.started)
+
+    def record_hedge_win(self):
+        # 진 원래 요청은 바로 취소하므로 실제 TTFT를 알 수 없습니다. 지금까지 기다린 시간보다 길었던 과거 TTFT 샘플의
+        # 평균을 원래 요청의 예상 TTFT로 보고, 사용자가 실제로 기다린 시간과의 차이를 TTFT 개선량으로 기록합니다.
+        if self.metrics is None:
+            return
+        waited = self.hedge.first_at - self.primary.started
+        slower = [value for value in self.metrics.samples(ttft_metric(self.primary.model_name)) if value > waited]
+        if slower:
+            self.metrics.observe("hedge.ttft_saved_s", sum(slower) / len(slower) - waited)
+
+
+class _StreamRunner(threading.Thread):
+    def __init__(self, race, model_name, open_stream, events):
+        super().__init__(daemon=True)
+        self.race = race
+        self.model_name = model_name
+        self.open_stream = open_stream
+        self.events = events
+        # 진 쪽 스트림은 이 토큰으로 취소합니다: governor 슬롯을 바로 반환하고 응답을 닫습니다 (다음 청크를 기다리지 않음).
+        self.token = CancellationToken()
+        self.started = None
+        self.first_at = None
+
+    def run(self):
+        self.started = time.monotonic()
+        stream = None
+        try:
+            stream = self.open_stream(self.token)
+            for chunk in stream:
+                if self.first_at is None:
+                    self.race.first_chunk(self)
+                if self.token.cancelled:
+                    break
+                self.events.put((self, "chunk", chunk))
+            else:
+                self.events.put((self, "end", None))
+        except Exception as e:
+            self.events.put((self, "error", e))
+        finally:
+            if stream is not None:
+                close_stream(stream)
+
+
+def hedged_stream(open_primary, open_hedge, deadline, metrics=None,
+                  primary_model=None, hedge_model=None):
+    """
+    Streams from `open_primary(token)`; if no chunk arrives within `deadline` seconds, also starts
+    `open_hedge(token)` and yields from whichever produces a chunk first. Each opener gets its own
+    CancellationToken, which is cancelled as soon as the other side wins.
+    """
+    events = queue.Queue()
+    race = _Race(metrics)
+    race.primary = _StreamRunner(race, primary_model, open_primary, events)
+    race.primary.start()
+    runners = [race.primary]
+    failed = []
+    first_chunk = None
+    try:
+        while race.winner is None:
+            timeout = None
+            if race.hedge is None:
+                timeout = max(0.0, deadline - (time.monotonic() - race.started))
+            try:
+                runner, kind, payload = events.get(timeout=timeout)
+            except queue.Empty:
+                race.hedge = _StreamRunner(race, hedge_model or primary_model, open_hedge, events)
+                race.hedge.start()
+                runners.append(race.hedge)
+                if metrics is not None:
+                    metrics.incr("hedge.fired")
+                print(f"첫 토큰이 {deadline:.1f}초 내에 도착하지 않아 헤지 요청을 보냅니다 ({race.hedge.model_name}).")
+                continue
+            if kind == "error":
+                failed.append(payload)
+                if len(failed) == len(runners) and race.hedge is not None:
+                    raise failed[0]
+                if race.hedge is None:
+                    raise payload
+                continue
+            with race.lock:
+                race.winner = runner
+            first_chunk = payload if kind == "chunk" else None
+            if kind == "end":
+                return
+        for runner in runners:
+            if runner is not race.winner:
+                runner.token.cancel()
+        if race.winner is race.hedge and metrics is not None:
+            metrics.incr("hedge.won")
+            race.record_hedge_win()
+
+        yield first_chunk
+        while True:
+            runner, kind, payload = events.get()
+            if runner is not race.winner:
+                continue
+            if kind == "chunk":
+                yield payload
+            elif kind == "end":
+                return
+            else:
+                raise payload
+    finally:
+        for runner in runners:
+            runner.token.cancel()
@@ -0,0 +1,292 @@
+import hashlib
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+
+DEFAULT_SESSION_BUDGET_BYTES = 32 * 1024 * 1024 # 세션별로 메모리에 유지하는 첨부 데이터 상한
+MESSAGE_OVERHEAD_BYTES = 200 # Message 객체와 캐시된 dict의 대략적인 고정 크기
+
+
+class SpillStore:
+    """
+    Content-addressed spill directory shared by every session of the process.
+    Identical blobs are written once and reference counted; reads go through read-only mmaps,
+    so spilled data lives in the OS page cache rather than the Python heap.
+    The directory is private to the process and removed by `close()`.
+    """
+
+    def __init__(self, root=None):
+        self.directory = tempfile.mkdtemp(prefix="genx-spill-", dir=root)
+        self._lock = threading.Lock()
+        self._refs = {} # digest -> reference count
+        self._sizes = {}
+        self._maps = {} # digest -> mmap
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, data):
+        """Stores `data` (bytes) and returns its digest. Takes one reference."""
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if digest in self._refs:
+                self._refs[digest] += 1
+                return digest
+            path = self._path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._refs[digest] = 1
+            self._sizes[digest] = len(data)
+        return digest
+
+    def read_text(self, digest, encoding="ascii"):
+        """Decodes the blob straight from its mmap; no intermediate bytes copy is made."""
+        with self._lock:
+            mapped = self._maps.get(digest)
+            if mapped is None:
+                with open(self._path(digest), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[digest] = mapped
+            # view는 release()/close()가 mmap을 닫기 전에 반드시 해제되어야 합니다.
+            with memoryview(mapped) as view:
+                return str(view, encoding)
+
+    def release(self, digest):
+        # 파일 삭제까지 lock 안에서 합니다. 같은 digest를 다시 put()한 파일을 지우지 않도록.
+        with self._lock:
+            count = self._refs.get(digest, 0) - 1
+            if count > 0:
+                self._refs[digest] = count
+                return
+            self._refs.pop(digest, None)
+            self._sizes.pop(digest, None)
+            mapped = self._maps.pop(digest, None)
+            if mapped is not None:
+                mapped.close()
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+
+    def disk_bytes(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def close(self):
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+            self._refs.clear()
+            self._sizes.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Blob:
+    """One large string (base64 attachment data) owned by a SessionMemory; either resident or spilled to disk."""
+    __slots__ = ("size", "digest", "_data", "_owner", "__weakref__")
+
+    def __init__(self, owner, data):
+        self._owner = owner
+        self._data = data
+        self.size = len(data)
+        self.digest = None
+
+    @property
+    def resident(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        return self._owner.read(self)
+
+
+def _release_spilled(spill_store, spilled):
+    for digest in spilled:
+        spill_store.release(digest)
+    spilled.clear()
+
+
+class SessionMemory:
+    """
+    Per-session holder for attachment data with an LRU budget.
+    When resident blobs exceed `budget_bytes`, the least recently used ones are spilled to the SpillStore
+    and read back through mmap on demand. Spilled files are released when the session is garbage collected.
+    """
+
+    def __init__(self, spill_store, budget_bytes=DEFAULT_SESSION_BUDGET_BYTES, metrics=None):
+        self.spill_store = spill_store
+        self.budget_bytes = budget_bytes
+        self.metrics = metrics
+        self.history_bytes = 0 # 채팅 히스토리 추정치 (앱이 매 실행마다 갱신)
+        self.upload_bytes = 0
+        self._lock = threading.Lock()
+        self._resident = OrderedDict() # id(blob) -> blob (LRU 순서)
+        self._resident_bytes = 0
+        self._spilled = [] # 이 세션이 참조하는 spill digest 목록
+        self._spilled_bytes = 0
+        weakref.finalize(self, _release_spilled, spill_store, self._spilled)
+
+    def _incr(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    def put(self, data):
+        blob = Blob(self, data)
+        with self._lock:
+            self._resident[id(blob)] = blob
+            self._resident_bytes += blob.size
+            self._enforce_budget()
+        return blob
+
+    def read(self, blob):
+        # spill 파일을 읽는 동안 release()가 참조를 놓지 않도록 세션 lock을 잡은 채 읽습니다
+        # (lock 순서는 _enforce_budget과 같이 세션 -> SpillStore).
+        with self._lock:
+            if blob.resident:
+                self._resident.move_to_end(id(blob))
+                return blob._data
+            return self.spill_store.read_text(blob.digest)
+
+    def release(self, blob):
+        with self._lock:
+            if blob.resident:
+                if self._resident.pop(id(blob), None) is not None:
+                    self._resident_bytes -= blob.size
+                blob._data = None
+                return
+            digest, blob.digest = blob.digest, None
+            if digest is None or digest not in self._spilled:
+                return
+            self._spilled.remove(digest)
+            self._spilled_bytes -= blob.size
+        self.spill_store.release(digest)
+
+    def _enforce_budget(self):
+        # 가장 오래 사용하지 않은 blob부터 디스크로 내보냅니다 (lock을 잡은 상태에서 호출).
+        while self._resident_bytes > self.budget_bytes and self._resident:
+            _, blob = self._resident.popitem(last=False)
+            blob.digest = self.spill_store.put(blob._data.encode("ascii"))
+            blob._data = None
+            self._resident_bytes -= blob.size
+            self._spilled.append(blob.digest)
+            self._spilled_bytes += blob.size
+            self._incr("memory.spills")
+            self._incr("memory.spilled_bytes", blob.size)
+
+    def set_budget(self, budget_bytes):
+        with self._lock:
+            self.budget_bytes = budget_bytes
+            self._enforce_budget()
+
+    # --- Gemini parts ---
+    # 첨부 파트의 data(base64 문자열)를 Blob으로 바꿔 보관하고, 요청 직전에만 문자열로 되돌립니다.
+    def offload_parts(self, parts):
+        stored = []
+        for part in parts:
+            if "inline_data" in part:
+                inline_data = part["inline_data"]
+                part = {"inline_data": {"mime_type": inline_data["mime_type"], "data": self.put(inline_data["data"])}}
+            stored.append(part)
+        return stored
+
+    def materialize_parts(self, parts):
+        materialized = []
+        for part in parts:
+            if "inline_data" in part and isinstance(part["inline_data"]["data"], Blob):
+                inline_data = part["inline_data"]
+                part = {"inline_data": {"mime_type": inline_data["mime_type"], "data": inline_data["data"].data}}
+            materialized.append(part)
+        return materialized
+
+    def release_parts(self, parts):
+        for part in parts:
+            if "inline_data" in part and isinstance(part["inline_data"]["data"], Blob):
+                self.release(part["inline_data"]["data"])
+
+    def report(self):
+        with self._lock:
+            resident_bytes = self._resident_bytes
+            spilled_bytes = self._spilled_bytes
+            resident_blobs = len(self._resident)
+            spilled_blobs = len(self._spilled)
+        return {
+            "resident_bytes": resident_bytes,
+            "spilled_bytes": spilled_bytes,
+            "resident_blobs": resident_blobs,
+            "spilled_blobs": spilled_blobs,
+            "history_bytes": self.history_bytes,
+            "upload_bytes": self.upload_bytes,
+            "total_bytes": resident_bytes + self.history_bytes + self.upload_bytes,
+            "budget_bytes": self.budget_bytes,
+        }
+
+
+def history_bytes(*histories):
+    """Approximate heap size of Message lists; messages shared between histories (list copies) are counted once."""
+    seen = set()
+    total = 0
+    for history in histories:
+        total += sys.getsizeof(history)
+        for message in history:
+            if id(message) in seen:
+                continue
+            seen.add(id(message))
+            total += message.nbytes + MESSAGE_OVERHEAD_BYTES # 아직 풀지 않은 압축 메시지는 압축된 크기로 셉니다
+    return total
+
+
+def process_rss_bytes():
+    """Current resident set size of the process, or None when it cannot be determined."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # macOS는 바이트, Linux는 KiB (최대값)
+
+
+class MemoryRegistry:
+    """Process-wide view of every live SessionMemory, sharing one SpillStore."""
+
+    def __init__(self, spill_root=None, budget_bytes=DEFAULT_SESSION_BUDGET_BYTES, metrics=None):
+        self.spill_store = SpillStore(spill_root)
+        self.budget_bytes = budget_bytes
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._sessions = weakref.WeakValueDictionary() # session_id -> SessionMemory
+
+    def session(self, session_id):
+        with self._lock:
+            memory = self._sessions.get(session_id)
+            if memory is None:
+                memory = SessionMemory(self.spill_store, self.budget_bytes, self.metrics)
+                self._sessions[session_id] = memory
+            return memory
+
+    def report(self):
+        with self._lock:
+            sessions = dict(self._sessions)
+        per_session = {session_id: memory.report() for session_id, memory in sessions.items()}
+        return {
+            "sessions": per_session,
+            "session_count": len(per_session),
+            "resident_bytes": sum(r["resident_bytes"] for r in per_session.values()),
+            "history_bytes": sum(r["history_bytes"] for r in per_session.values()),
+            "upload_bytes": sum(r["upload_bytes"] for r in per_session.values()),
+            "spill_disk_bytes": self.spill_store.disk_bytes(),
+            "process_rss_bytes": process_rss_bytes(),
+        }
@@ -0,0 +1,184 @@
+import hashlib
+import sys
+import time
+
+from codec import decode_text
+
+
+def estimate_tokens(text):
+    # 대략적인 토큰 수 추정 (UTF-8 4바이트당 1토큰: 영어 약 4자, 한국어 약 1.3자)
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+class AttachmentRef:
+    """Reference to one attachment part (e.g. an image or a rendered PDF page) in the blob store."""
+
+    __slots__ = ("_digest", "_mime_type", "_size", "_name")
+
+    def __init__(self, digest, mime_type, size, name=None):
+        self._digest = digest
+        self._mime_type = mime_type
+        self._size = size
+        self._name = name
+
+    @property
+    def digest(self):
+        return self._digest
+
+    @property
+    def mime_type(self):
+        return self._mime_type
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def name(self):
+        return self._name
+
+    def to_dict(self):
+        item = {"digest": self._digest, "mime_type": self._mime_type, "size": self._size}
+        if self._name:
+            item["name"] = self._name
+        return item
+
+    @classmethod
+    def from_dict(cls, item):
+        return cls(item["digest"], item["mime_type"], item.get("size", 0), item.get("name"))
+
+    def __eq__(self, other):
+        if not isinstance(other, AttachmentRef):
+            return NotImplemented
+        return self._digest == other._digest and self._mime_type == other._mime_type
+
+    def __hash__(self):
+        return hash(self._digest)
+
+    def __repr__(self):
+        return f"AttachmentRef({self._digest[:12]!r}, {self._mime_type!r})"
+
+
+class Message:
+    """
+    One chat message. Instances are immutable and shared between chat_history, saved_sessions
+    and Gemini history, so derived data (token count, content hash, Gemini dict) is computed once.
+    `attachments` holds AttachmentRefs; the bytes live in the blob store (see attachments.py).
+    Messages loaded from a compressed document keep the stored payload and decompress it on first
+    access to `text`; the payload is reused when the message is saved again (see codec.py). Likewise a codec's
+    decision to store a body uncompressed is remembered, so it is not compressed again on every save.
+    Unpacks like the old `(role, text)` tuples.
+    """
+
+    __slots__ = ("_role", "_text", "_created_at", "_attachments", "_token_count", "_content_hash", "_gemini",
+                 "_stored", "_decode", "_raw_codec")
+
+    def __init__(self, role, text, created_at=None, attachments=()):
+        self._role = role
+        self._text = text
+        self._created_at = time.time() if created_at is None else created_at
+        self._attachments = tuple(attachments)
+        self._token_count = None
+        self._content_hash = None
+        self._gemini = None
+        self._stored = None # 압축 저장 payload (codec.py)
+        self._decode = None # 아직 풀지 않은 payload의 해제 함수
+        self._raw_codec = None # 압축하지 않고 저장하기로 한 codec의 id
+
+    @property
+    def role(self):
+        return self._role
+
+    @property
+    def text(self):
+        if self._decode is not None:
+            self._text = self._decode(self._stored)
+            self._decode = None
+        return self._text
+
+    @property
+    def created_at(self):
+        return self._created_at
+
+    @property
+    def attachments(self):
+        return self._attachments
+
+    @property
+    def nbytes(self):
+        """Approximate heap size of the body, without decompressing a still-encoded payload."""
+        size = sys.getsizeof(self._stored) if self._stored is not None else 0
+        if self._decode is None:
+            size += sys.getsizeof(self._text)
+        return size
+
+    @property
+    def token_count(self):
+        if self._token_count is None:
+            self._token_count = estimate_tokens(self.text)
+        return self._token_count
+
+    @property
+    def content_hash(self):
+        """SHA-1 digest (bytes) of role and text."""
+        if self._content_hash is None:
+            self._content_hash = hashlib.sha1(self._role.encode("utf-8") + b"\0" + self.text.encode("utf-8")).digest()
+        return self._content_hash
+
+    def to_gemini(self):
+        # Text only; attachments are re-attached by attachments.build_gemini_history.
+        # The returned dict is cached and shared; callers must not mutate it.
+        if self._gemini is None:
+            self._gemini = {"role": self._role, "parts": [{"text": self.text}]}
+        return self._gemini
+
+    def to_dict(self, codec=None):
+        payload = None
+        if codec is not None:
+            # 이미 같은 codec으로 압축된 payload가 있으면 다시 압축하지 않습니다.
+            payload = codec.reuse(self._stored) if self._stored is not None else None
+            if payload is None and self._raw_codec != codec.codec_id:
+                payload = codec.encode(self.text)
+                if payload is None:
+                    self._raw_codec = codec.codec_id
+                else:
+                    self._stored = payload
+            elif payload is not None:
+                self._stored = payload # 문자열 payload는 bytes로 바뀝니다
+        if payload is not None:
+            item = {"role": self._role, "z": payload, "created_at": self._created_at}
+        else:
+            item = {"role": self._role, "text": self.text, "created_at": self._created_at}
+        if self._attachments:
+            item["attachments"] = [ref.to_dict() for ref in self._attachments]
+        return item
+
+    @classmethod
+    def from_dict(cls, item, codec=None):
+        # 이전 버전에서 저장된 데이터에는 created_at과 attachments가 없습니다.
+        attachments = [AttachmentRef.from_dict(ref) for ref in item.get("attachments", ())]
+        if "z" not in item:
+            return cls(item["role"], item["text"], item.get("created_at", 0), attachments)
+        message = cls(item["role"], None, item.get("created_at", 0), attachments)
+        message._stored = item["z"]
+        message._decode = decode_text if codec is None else codec.decode
+        if codec is not None:
+            codec.record_read(item["z"])
+        return message
+
+    def __iter__(self):
+        yield self._role
+        yield self.text
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self._role == other._role and self.text == other.text and self._attachments == other._attachments
+
+    def __hash__(self):
+        return hash(self.content_hash)
+
+    def __repr__(self):
+        text = self.text
+        preview = text if len(text) <= 40 else text[:40] + "..."
+        return f"Message({self._role!r}, {preview!r})"
@@ -0,0 +1,71 @@
+import threading
+from collections import defaultdict, deque
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and rolling sample windows shared by the app.
+    Counters are monotonic totals; samples keep the most recent `window` values per name.
+    """
+
+    def __init__(self, window=500):
+        self._lock = threading.Lock()
+        self._window = window
+        self._counters = defaultdict(float)
+        self._samples = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, value):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self._window)
+            samples.append(value)
+
+    def count(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def sample_count(self, name):
+        with self._lock:
+            return len(self._samples.get(name, ()))
+
+    def samples(self, name):
+        with self._lock:
+            return list(self._samples.get(name, ()))
+
+    def percentile(self, name, q):
+        # q는 0~100 사이의 값. 샘플이 없으면 None을 반환합니다.
+        with self._lock:
+            values = sorted(self._samples.get(name, ()))
+        if not values:
+            return None
+        index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+        return values[index]
+
+    def mean(self, name):
+        with self._lock:
+            values = list(self._samples.get(name, ()))
+        if not values:
+            return None
+        return sum(values) / len(values)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            samples = {name: list(values) for name, values in self._samples.items()}
+        summary = {}
+        for name, values in samples.items():
+            if not values:
+                continue
+            ordered = sorted(values)
+            summary[name] = {
+                "n": len(ordered),
+                "mean": sum(ordered) / len(ordered),
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            }
+        return {"counters": counters, "samples": summary}
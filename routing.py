@@ -0,0 +1,217 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+from context_cache import IMAGE_TOKEN_ESTIMATE
+from messages import estimate_tokens
+
+AUTO_MODEL = "auto" # 설정에서 이 값을 고르면 턴마다 모델을 자동으로 선택합니다
+ROUTED_MODELS = ["gemini-2.0-flash", "gemini-2.5-flash", "gemini-2.5-pro"] # 저렴/빠름 → 강력/느림 순서
+DEFAULT_LATENCY_SLO = 4.0 # 첫 토큰까지의 목표 시간 (초)
+# 지연 시간 표본이 부족할 때 사용하는 모델별 TTFT 추정치 (초)와 첨부 파트 하나당 추가 지연
+PRIOR_TTFT = {"gemini-2.0-flash": 0.6, "gemini-2.5-flash": 1.2, "gemini-2.5-pro": 3.0}
+PRIOR_TTFT_PER_PART = 0.03
+ROUTER_MIN_SAMPLES = 5 # 통계를 믿기 시작하는 최소 표본 수
+ROUTER_WINDOW = 100 # 모델/부하별로 유지하는 최근 표본 수
+SAMPLE_MAX_AGE = 15 * 60 # 이보다 오래된 표본은 통계에서 제외합니다 (초). 일시적인 지연/품질 저하가 영구히 남지 않도록
+EXPLORATION_RATE = 0.05 # 통계 때문에 피한 모델을 이 확률로 다시 골라 재측정합니다
+SLO_PERCENTILE = 90
+# 복잡도 점수 경계: 이 값 이상이면 한 단계 강한 모델을 고릅니다
+COMPLEXITY_TIERS = (1.0, 4.0)
+RECENT_DECISIONS = 200 # 화면에 보여주기 위해 메모리에 유지하는 최근 결정 수
+
+
+class TurnFeatures:
+    __slots__ = ("prompt_tokens", "attachments", "history_tokens", "history_messages")
+
+    def __init__(self, prompt_tokens, attachments, history_tokens, history_messages):
+        self.prompt_tokens = prompt_tokens
+        self.attachments = attachments # 이번 입력의 첨부 파트 수 (이미지 한 장 또는 PDF 한 페이지가 하나)
+        self.history_tokens = history_tokens
+        self.history_messages = history_messages
+
+    @classmethod
+    def from_turn(cls, history, contents):
+        # 히스토리의 첨부는 다시 전송될 수 있으므로 이미지 토큰 추정치로 포함합니다.
+        prompt_tokens = sum(estimate_tokens(part["text"]) for part in contents if "text" in part)
+        attachments = sum(1 for part in contents if "inline_data" in part)
+        history_tokens = sum(message.token_count + IMAGE_TOKEN_ESTIMATE * len(message.attachments) for message in history)
+        return cls(prompt_tokens, attachments, history_tokens, len(history))
+
+    @property
+    def load_bucket(self):
+        # 첨부 양에 따라 지연 시간 통계를 따로 모읍니다.
+        if self.attachments == 0:
+            return "text"
+        return "docs" if self.attachments <= 10 else "heavy_docs"
+
+    def complexity(self):
+        return (
+            self.prompt_tokens / 300
+            + self.history_tokens / 8000
+            + min(self.attachments, 20) * 0.25
+            + (1.0 if self.attachments > 20 else 0.0)
+        )
+
+    def to_dict(self):
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "attachments": self.attachments,
+            "history_tokens": self.history_tokens,
+            "history_messages": self.history_messages,
+        }
+
+
+class RoutingDecision:
+    __slots__ = ("decision_id", "model_name", "reason", "complexity", "predicted_ttft", "features", "created_at", "explored")
+
+    def __init__(self, model_name, reason, complexity, predicted_ttft, features, explored=False):
+        self.decision_id = uuid.uuid4().hex[:12]
+        self.explored = explored # 통계상 피하던 모델을 재측정하기 위해 고른 결정
+        self.model_name = model_name
+        self.reason = reason
+        self.complexity = complexity
+        self.predicted_ttft = predicted_ttft
+        self.features = features
+        self.created_at = time.time()
+
+    def to_dict(self):
+        return {
+            "decision_id": self.decision_id,
+            "model": self.model_name,
+            "reason": self.reason,
+            "complexity": round(self.complexity, 3),
+            "predicted_ttft": round(self.predicted_ttft, 3),
+            "features": self.features.to_dict(),
+            "explored": self.explored,
+            "created_at": self.created_at,
+        }
+
+
+class ModelRouter:
+    """
+    Picks a model per turn for the "auto" setting.
+    The request's complexity (prompt length, attachments, history size) selects a starting tier; the tier moves up
+    when recent supervisor scores of that model fall below the threshold, and down while the model's predicted
+    time to first token (observed percentile for similar load, or a prior) exceeds the latency SLO.
+    Statistics only use samples younger than `max_sample_age`, and with probability `exploration_rate` a model
+    avoided because of its statistics is chosen anyway, so a slowdown or a bad streak is re-measured once it ends.
+    Decisions and their outcomes are appended to `log_path` as JSON lines and kept in memory for display.
+    """
+
+    def __init__(self, models=ROUTED_MODELS, metrics=None, log_path=None, exploration_rate=EXPLORATION_RATE,
+                 max_sample_age=SAMPLE_MAX_AGE, clock=time.monotonic, rng=None):
+        self.models = list(models)
+        self.metrics = metrics
+        self.log_path = log_path
+        self.exploration_rate = exploration_rate
+        self.max_sample_age = max_sample_age
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=RECENT_DECISIONS)
+        self._samples = {} # 통계 이름 -> deque((시각, 값)). 표본 나이를 알아야 하므로 MetricsRegistry와 따로 보관합니다
+
+    def _observe(self, name, value):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=ROUTER_WINDOW)
+            samples.append((self.clock(), value))
+
+    def _stat(self, name, q=None):
+        cutoff = self.clock() - self.max_sample_age
+        with self._lock:
+            values = sorted(value for observed_at, value in self._samples.get(name, ()) if observed_at >= cutoff)
+        if len(values) < ROUTER_MIN_SAMPLES:
+            return None
+        if q is None:
+            return sum(values) / len(values)
+        return values[min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))]
+
+    def _observed_ttft(self, model_name, features):
+        return self._stat(f"route.ttft.{model_name}.{features.load_bucket}", SLO_PERCENTILE)
+
+    def predicted_ttft(self, model_name, features):
+        observed = self._observed_ttft(model_name, features)
+        if observed is not None:
+            return observed
+        return PRIOR_TTFT.get(model_name, max(PRIOR_TTFT.values())) + PRIOR_TTFT_PER_PART * features.attachments
+
+    def route(self, history, contents, latency_slo=DEFAULT_LATENCY_SLO, threshold=None):
+        features = TurnFeatures.from_turn(history, contents)
+        complexity = features.complexity()
+        tier = sum(1 for bound in COMPLEXITY_TIERS if complexity >= bound)
+        tier = min(tier, len(self.models) - 1)
+        reasons = [f"복잡도 {complexity:.1f}"]
+        avoided = [] # 관측 통계 때문에 피한 모델 (사전 추정치로 피한 모델은 제외)
+        # 최근 Supervisor 점수가 기준에 못 미치는 모델이면 한 단계 강한 모델을 사용합니다.
+        if threshold is not None and tier < len(self.models) - 1:
+            mean_score = self._stat(f"route.score.{self.models[tier]}")
+            if mean_score is not None and mean_score < threshold:
+                reasons.append(f"{self.models[tier]} 평균 점수 {mean_score:.0f}점")
+                avoided.append(self.models[tier])
+                tier += 1
+        # 예상 TTFT가 SLO를 넘으면 더 빠른 모델로 내려갑니다.
+        predicted = self.predicted_ttft(self.models[tier], features)
+        while predicted > latency_slo and tier > 0:
+            reasons.append(f"{self.models[tier]} 예상 TTFT {predicted:.1f}초 > SLO {latency_slo:.1f}초")
+            if self._observed_ttft(self.models[tier], features) is not None:
+                avoided.append(self.models[tier])
+            tier -= 1
+            predicted = self.predicted_ttft(self.models[tier], features)
+        model_name = self.models[tier]
+        explored = False
+        if avoided and self.rng.random() < self.exploration_rate:
+            model_name = self.rng.choice(avoided)
+            predicted = self.predicted_ttft(model_name, features)
+            reasons.append(f"탐색: {model_name} 통계 재측정")
+            explored = True
+        decision = RoutingDecision(model_name, " · ".join(reasons), complexity, predicted, features, explored)
+        if self.metrics is not None:
+            self.metrics.incr(f"route.{decision.model_name}")
+            if explored:
+                self.metrics.incr("route.explorations")
+        self._log({"event": "decision", **decision.to_dict()})
+        return decision
+
+    def record_result(self, decision, ttft=None, seconds=None, score=None, passed=None, error=None):
+        """Feeds the outcome of a routed turn back into the statistics and the decision log."""
+        model_name = decision.model_name
+        if ttft is not None:
+            self._observe(f"route.ttft.{model_name}.{decision.features.load_bucket}", ttft)
+        if score is not None:
+            self._observe(f"route.score.{model_name}", score)
+        if self.metrics is not None:
+            if ttft is not None and ttft > 0 and decision.predicted_ttft > 0:
+                self.metrics.observe("route.ttft_prediction_ratio", ttft / decision.predicted_ttft)
+            if error is not None:
+                self.metrics.incr("route.errors")
+        self._log({
+            "event": "result",
+            "decision_id": decision.decision_id,
+            "model": model_name,
+            "ttft": None if ttft is None else round(ttft, 3),
+            "seconds": None if seconds is None else round(seconds, 3),
+            "score": score,
+            "passed": passed,
+            "error": None if error is None else str(error),
+        })
+
+    def _log(self, entry):
+        with self._lock:
+            self._recent.append(entry)
+            if self.log_path is None:
+                return
+            try:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"모델 라우팅 로그 기록 실패: {e}")
+
+    def recent(self, limit=20):
+        with self._lock:
+            return list(self._recent)[-limit:]
@@ -0,0 +1,398 @@
+"""
+Asyncio HTTP API for GenX chat turns, alongside the Streamlit UI.
+
+    GET    /healthz                  liveness and counters
+    POST   /v1/chat                  run one chat turn, streamed as server-sent events
+    DELETE /v1/requests/{request_id} cancel an in-flight turn
+
+POST /v1/chat body:
+    {"user_id": "...", "title": "...", "prompt": "...", "system_instruction": "...",
+     "settings": {"model_name": "gemini-2.5-flash", "use_supervision": true, ...}}
+Events: start, attempt, token, score, aborted, error, done. Closing the connection cancels the turn.
+A turn whose history cannot be loaded ends with an error event; if only saving fails, error is followed by done.
+`done` reports "saved": whether the turn was written to the store (false when nothing was generated or saving failed).
+Settings are type- and range-checked; invalid values are answered with 400.
+
+    python server.py --backend standin --store memory --port 8080
+"""
+import argparse
+import asyncio
+import json
+import uuid
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, fields
+
+from cancellation import CancellationToken
+from codec import codec_from_env
+from context_cache import ContextCacheManager
+from engine import EngineSettings, GeminiBackend, GenerationEngine, TurnCallbacks, default_system_instruction
+from governor import RequestGovernor
+from messages import Message
+from metrics import MetricsRegistry
+from standin import StandInBackend
+from storage import NEW_CHAT_TITLE, MemorySessionStore, UserData, firestore_store_from_env
+
+MAX_BODY_BYTES = 1 << 20
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+SETTING_NAMES = {f.name for f in fields(EngineSettings)}
+SETTING_TYPES = {f.name: f.type for f in fields(EngineSettings)}
+# 숫자 설정의 허용 범위 (Streamlit 설정 패널의 슬라이더 범위와 같습니다).
+SETTING_RANGES = {
+    "max_retries": (1, 5),
+    "threshold": (0, 100),
+    "supervisor_count": (1, 5),
+    "cascade_band": (0, 50),
+    "hedge_percentile": (50, 99),
+    "checkpoint_tokens": (50, 1000),
+    "abort_margin": (0, 50),
+    "candidate_pool_size": (1, 10),
+    "latency_slo": (1.0, 15.0),
+}
+NULLABLE_SETTINGS = {"hedge_model"}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+async def read_request(reader):
+    """Parses one HTTP/1.1 request. Returns (method, path, headers, body) or None on EOF."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HttpError(400, "잘못된 요청 형식입니다.")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HttpError(400, "Content-Length가 올바르지 않습니다.")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, "요청 본문이 너무 큽니다.")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), path.split("?", 1)[0], headers, body
+
+
+class _QueueCallbacks(TurnCallbacks):
+    """Forwards engine progress from the worker thread to the event loop as SSE events."""
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+        self.sent = 0
+
+    def _emit(self, event, data):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (event, data))
+
+    def on_attempt_start(self, attempt, max_attempts):
+        self.sent = 0
+        self._emit("attempt", {"attempt": attempt, "max_attempts": max_attempts})
+
+    def on_chunk(self, text):
+        delta = text[self.sent:]
+        self.sent = len(text)
+        self._emit("token", {"text": delta})
+
+    def on_attempt_scored(self, average, scores, passed):
+        self._emit("score", {"average": average, "scores": scores, "passed": passed})
+
+    def on_attempt_aborted(self, projected_score, text):
+        self._emit("aborted", {"projected_score": projected_score})
+
+    def on_error(self, exc):
+        self._emit("error", {"message": str(exc)})
+
+
+class GenXServer:
+    def __init__(self, engine, store, default_settings=None, max_workers=32):
+        self.engine = engine
+        self.store = store
+        self.default_settings = default_settings or EngineSettings()
+        # Gemini SDK 호출은 동기식이므로 worker 스레드에서 실행하고, 연결은 하나의 이벤트 루프에서 처리합니다.
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.requests = {} # request_id -> CancellationToken
+        self.user_locks = {} # user_id -> [asyncio.Lock, 사용 중인 요청 수] (같은 사용자의 동시 저장 충돌 방지)
+
+    @asynccontextmanager
+    async def _user_lock(self, user_id):
+        # 잠금을 기다리거나 잡고 있는 요청이 없으면 항목을 지워서 사용자 수만큼 쌓이지 않게 합니다.
+        entry = self.user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.user_locks[user_id]
+
+    async def handle(self, reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, headers, body = request
+            if path == "/healthz":
+                if method != "GET":
+                    raise HttpError(405, "GET만 지원합니다.")
+                await self._send_json(writer, 200, {
+                    "status": "ok",
+                    "in_flight": len(self.requests),
+                    "counters": self.engine.metrics.snapshot()["counters"],
+                })
+            elif path == "/v1/chat":
+                if method != "POST":
+                    raise HttpError(405, "POST만 지원합니다.")
+                try:
+                    payload = json.loads(body or b"{}")
+                except ValueError:
+                    raise HttpError(400, "JSON 본문이 올바르지 않습니다.")
+                await self._chat(reader, writer, payload)
+            elif path.startswith("/v1/requests/"):
+                if method != "DELETE":
+                    raise HttpError(405, "DELETE만 지원합니다.")
+                token = self.requests.get(path[len("/v1/requests/"):])
+                if token is None:
+                    raise HttpError(404, "진행 중인 요청을 찾을 수 없습니다.")
+                token.cancel()
+                await self._send_json(writer, 200, {"cancelled": True})
+            else:
+                raise HttpError(404, "경로를 찾을 수 없습니다.")
+        except HttpError as e:
+            try:
+                await self._send_json(writer, e.status, {"error": e.message})
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _send_json(self, writer, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+    async def _send_event(self, writer, event, data):
+        writer.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+        await writer.drain()
+
+    def _settings(self, overrides):
+        if not isinstance(overrides, dict):
+            raise HttpError(400, "settings는 객체여야 합니다.")
+        unknown = set(overrides) - SETTING_NAMES
+        if unknown:
+            raise HttpError(400, f"알 수 없는 설정: {', '.join(sorted(unknown))}")
+        for name, value in overrides.items():
+            expected = SETTING_TYPES[name]
+            if value is None and name in NULLABLE_SETTINGS:
+                continue
+            # bool은 int의 하위 클래스이므로 따로 확인합니다. float 설정에는 정수도 허용합니다.
+            if expected is bool:
+                valid = isinstance(value, bool)
+            elif expected is int:
+                valid = isinstance(value, int) and not isinstance(value, bool)
+            elif expected is float:
+                valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+            else:
+                valid = isinstance(value, str) and value != ""
+            if not valid:
+                raise HttpError(400, f"설정 {name}의 값이 올바르지 않습니다 ({expected.__name__} 필요): {value!r}")
+            limits = SETTING_RANGES.get(name)
+            if limits is not None and not limits[0] <= value <= limits[1]:
+                raise HttpError(400, f"설정 {name}은(는) {limits[0]}~{limits[1]} 범위여야 합니다: {value!r}")
+        return EngineSettings(**{**asdict(self.default_settings), **overrides})
+
+    def _load(self, user_id):
+        return self.store.load(user_id) or UserData()
+
+    def _finish_turn(self, user_id, user_data, title, instruction, history, prompt, result, model_name, cancel_token):
+        """Appends the turn, names new conversations and saves the user document (worker thread)."""
+        history = history + [Message("user", prompt), Message("model", result.response)]
+        if title == NEW_CHAT_TITLE and not result.cancelled:
+            original_title = self.engine.generate_title(model_name, prompt, cancel_token) or NEW_CHAT_TITLE
+            title_key, count = original_title, 1
+            while title_key in user_data.saved_sessions:
+                title_key = f"{original_title} ({count})"
+                count += 1
+            title = title_key
+        user_data.saved_sessions[title] = history
+        user_data.system_instructions[title] = instruction
+        user_data.last_active_title = title
+        self.store.save(user_id, user_data)
+        return title
+
+    async def _chat(self, reader, writer, payload):
+        prompt = payload.get("prompt")
+        if not isinstance(prompt, str) or not prompt:
+            raise HttpError(400, "prompt가 필요합니다.")
+        settings = self._settings(payload.get("settings", {}))
+        user_id = str(payload.get("user_id") or uuid.uuid4())
+        title = str(payload.get("title") or NEW_CHAT_TITLE)
+        request_id = str(uuid.uuid4())
+        loop = asyncio.get_running_loop()
+
+        writer.write(
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: text/event-stream; charset=utf-8\r\n"
+            "Cache-Control: no-cache\r\n"
+            f"X-Request-Id: {request_id}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1")
+        )
+        token = CancellationToken()
+        self.requests[request_id] = token
+        # 클라이언트가 연결을 끊으면 (EOF) 생성을 취소합니다.
+        watcher = asyncio.ensure_future(reader.read())
+        watcher.add_done_callback(lambda task: task.cancelled() or token.cancel())
+        client_connected = True
+
+        async def send(event, data):
+            nonlocal client_connected
+            if not client_connected:
+                return
+            try:
+                await self._send_event(writer, event, data)
+            except ConnectionError:
+                client_connected = False
+                token.cancel()
+
+        try:
+            await send("start", {"request_id": request_id, "user_id": user_id, "title": title})
+            async with self._user_lock(user_id):
+                try:
+                    user_data = await loop.run_in_executor(self.executor, self._load, user_id)
+                except Exception as e:
+                    print(f"대화 기록 불러오기 실패 ({user_id}): {e}")
+                    await send("error", {"message": f"대화 기록을 불러오지 못했습니다: {e}"})
+                    return
+                history = list(user_data.saved_sessions.get(title, []))
+                instruction = payload.get("system_instruction") or user_data.system_instructions.get(title, default_system_instruction)
+
+                queue = asyncio.Queue()
+                callbacks = _QueueCallbacks(loop, queue)
+                future = loop.run_in_executor(
+                    self.executor,
+                    lambda: self.engine.run_turn(
+                        settings, history, [{"text": prompt}], instruction,
+                        callbacks=callbacks, cancel_token=token
+                    )
+                )
+                while True:
+                    get_event = asyncio.ensure_future(queue.get())
+                    done, _ = await asyncio.wait({get_event, future}, return_when=asyncio.FIRST_COMPLETED)
+                    if get_event in done:
+                        await send(*get_event.result())
+                        continue
+                    get_event.cancel()
+                    break
+                while not queue.empty():
+                    await send(*queue.get_nowait())
+                try:
+                    result = await future
+                except Exception as e:
+                    print(f"대화 생성 실패 ({request_id}): {e}")
+                    await send("error", {"message": str(e)})
+                    return
+
+                saved_title, saved = title, False
+                if result.response:
+                    try:
+                        saved_title = await loop.run_in_executor(
+                            self.executor, self._finish_turn,
+                            user_id, user_data, title, instruction, history, prompt, result, result.model_name or settings.model_name, token
+                        )
+                        saved = True
+                    except Exception as e:
+                        # 답변은 이미 스트리밍되었으므로 오류를 알린 뒤 done도 보냅니다.
+                        print(f"대화 저장 실패 ({user_id}): {e}")
+                        saved = False
+                        await send("error", {"message": f"대화를 저장하지 못했습니다: {e}"})
+            await send("done", {
+                "response": result.response,
+                "score": result.score if settings.use_supervision else None,
+                "passed": result.passed,
+                "cancelled": result.cancelled,
+                "tokens_avoided": round(result.tokens_avoided),
+                "attempts": len(result.attempts),
+                "model": result.model_name,
+                "title": saved_title,
+                "saved": saved,
+            })
+        finally:
+            self.requests.pop(request_id, None)
+            watcher.cancel()
+
+
+def build_engine(backend, max_concurrency):
+    metrics = MetricsRegistry()
+    governor = RequestGovernor(max_concurrency=max_concurrency, metrics=metrics)
+    return GenerationEngine(
+        backend.main_model,
+        backend.supervisor_model,
+        backend.summary_model,
+        governor,
+        metrics,
+        context_cache=ContextCacheManager(backend.context_cache_backend(), metrics=metrics, governor=governor)
+    )
+
+
+async def serve(server, host, port):
+    listener = await asyncio.start_server(server.handle, host, port)
+    addresses = ", ".join(str(sock.getsockname()) for sock in listener.sockets)
+    print(f"GenX API 서버 실행 중: {addresses}")
+    async with listener:
+        await listener.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GenX 비동기 HTTP API 서버 (SSE 스트리밍)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--backend", choices=["gemini", "standin"], default="gemini")
+    parser.add_argument("--store", choices=["firestore", "memory"], default="firestore")
+    parser.add_argument("--store-path", help="memory 저장소를 미러링할 JSON 파일 경로")
+    parser.add_argument("--model", default="gemini-2.5-flash", help="요청에 설정이 없을 때 사용할 모델")
+    parser.add_argument("--workers", type=int, default=32, help="Gemini 호출용 worker 스레드 수")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="Gemini 동시 요청 수 (governor)")
+    args = parser.parse_args(argv)
+
+    backend = StandInBackend() if args.backend == "standin" else GeminiBackend()
+    engine = build_engine(backend, args.max_concurrency)
+    # 저장 압축은 GENX_STORAGE_CODEC으로 설정합니다 (codec.py).
+    codec = codec_from_env(metrics=engine.metrics)
+    store = MemorySessionStore(args.store_path, codec=codec) if args.store == "memory" else firestore_store_from_env(codec)
+    server = GenXServer(
+        engine,
+        store,
+        default_settings=EngineSettings(model_name=args.model),
+        max_workers=args.workers
+    )
+    try:
+        asyncio.run(serve(server, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
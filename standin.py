@@ -0,0 +1,137 @@
+"""
+Offline stand-ins for google.generativeai models, used by the HTTP server, batch runner and
+local testing. They mimic the small surface GenX uses: `start_chat(...).send_message(..., stream=True)`
+and `generate_content(...)`.
+"""
+import json
+import random
+import re
+import time
+
+
+class StandInChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class StandInResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StandInChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, contents, stream=False):
+        prompt = " ".join(part["text"] for part in contents if "text" in part)
+        # 인라인 히스토리의 첨부도 요청마다 업로드됩니다.
+        uploaded = sum(1 for part in contents if "text" not in part) + sum(
+            1 for item in self.history for part in item["parts"] if "text" not in part)
+        attachments = uploaded + len(self.model.cached_parts)
+        self.uploaded = uploaded
+        # 실제 모델처럼 같은 요청에도 매번 다른 답변이 나오도록 샘플 번호를 붙입니다 (재생성 후보 풀 확인용).
+        reply = f"[{self.model.model_name}] '{prompt}'에 대한 테스트 답변입니다. (히스토리 {len(self.model.cached_history) + len(self.history)}개, 첨부 {attachments}개, 샘플 {random.randint(1, 9999)})"
+        words = reply.split(" ")
+        chunks = [word + (" " if i < len(words) - 1 else "") for i, word in enumerate(words)]
+        if not stream:
+            return StandInResponse(reply)
+        return self._stream(chunks)
+
+    def _stream(self, chunks):
+        # 요청에 직접 실린 첨부가 많을수록 첫 토큰이 늦어지는 것을 흉내냅니다 (캐시된 첨부는 제외).
+        time.sleep(self.model.first_chunk_delay + self.model.attachment_delay * self.uploaded)
+        for chunk in chunks:
+            yield StandInChunk(chunk)
+            time.sleep(self.model.chunk_delay)
+
+
+class StandInModel:
+    def __init__(self, model_name, system_instruction=None, first_chunk_delay=0.05, chunk_delay=0.01,
+                 attachment_delay=0.005, cached_history=()):
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ""
+        self.first_chunk_delay = first_chunk_delay
+        self.chunk_delay = chunk_delay
+        self.attachment_delay = attachment_delay
+        self.cached_history = list(cached_history) # 캐시된 prefix의 히스토리 항목
+        self.cached_parts = [part for item in self.cached_history for part in item["parts"] if "text" not in part]
+
+    def start_chat(self, history=None):
+        return StandInChat(self, history)
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        # Supervisor 요청에는 점수를, 그 외(제목/요약)에는 짧은 텍스트를 돌려줍니다.
+        if generation_config and generation_config.get("response_mime_type") == "application/json":
+            match = re.search(r"평가자 페르소나 \((\d+)명\)", str(prompt))
+            count = int(match.group(1)) if match else 1
+            return StandInResponse(json.dumps({"scores": [random.randint(40, 95) for _ in range(count)]}))
+        if "0점부터 100점" in str(prompt):
+            return StandInResponse(str(random.randint(40, 95)))
+        text = str(prompt).strip().splitlines()[-1] if str(prompt).strip() else ""
+        return StandInResponse(text[:30] or "테스트 대화")
+
+
+class StandInCachedContent:
+    def __init__(self, name, model_name, system_instruction, history, expires_at):
+        self.name = name
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.history = history
+        self.expires_at = expires_at
+
+
+class StandInContextCacheBackend:
+    """In-memory counterpart of context_cache.GeminiContextCacheBackend; expired or deleted handles are rejected."""
+
+    def __init__(self, backend, clock=time.monotonic):
+        self.backend = backend
+        self.clock = clock
+        self.contents = {} # name -> StandInCachedContent
+        self.created = 0
+
+    def create(self, model_name, system_instruction, history, ttl):
+        self.created += 1
+        cached = StandInCachedContent(f"cachedContents/standin-{self.created}", model_name, system_instruction,
+                                      list(history), self.clock() + ttl)
+        self.contents[cached.name] = cached
+        return cached
+
+    def _check(self, cached):
+        if cached.name not in self.contents or cached.expires_at <= self.clock():
+            self.contents.pop(cached.name, None)
+            raise LookupError(f"{cached.name} not found")
+
+    def model(self, cached):
+        self._check(cached)
+        return StandInModel(cached.model_name, cached.system_instruction, self.backend.first_chunk_delay,
+                            self.backend.chunk_delay, self.backend.attachment_delay, cached.history)
+
+    def refresh(self, cached, ttl):
+        self._check(cached)
+        cached.expires_at = self.clock() + ttl
+
+    def delete(self, cached):
+        self.contents.pop(cached.name, None)
+
+
+class StandInBackend:
+    """Drop-in replacement for engine.GeminiBackend that never touches the network."""
+
+    def __init__(self, first_chunk_delay=0.05, chunk_delay=0.01, attachment_delay=0.005):
+        self.first_chunk_delay = first_chunk_delay
+        self.chunk_delay = chunk_delay
+        self.attachment_delay = attachment_delay
+
+    def main_model(self, model_name, system_instruction=None):
+        return StandInModel(model_name, system_instruction, self.first_chunk_delay, self.chunk_delay, self.attachment_delay)
+
+    def supervisor_model(self, model_name, system_instruction=None):
+        return StandInModel(model_name, system_instruction)
+
+    def summary_model(self, model_name):
+        return StandInModel(model_name)
+
+    def context_cache_backend(self):
+        return StandInContextCacheBackend(self)
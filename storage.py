@@ -0,0 +1,153 @@
+import copy
+import json
+import os
+import threading
+
+from codec import codec_from_env, decode_field, payload_text
+from messages import Message
+
+USER_SESSIONS_COLLECTION = "user_sessions"
+NEW_CHAT_TITLE = "새로운 대화"
+
+
+class UserData:
+    """In-memory form of one `user_sessions/{user_id}` document."""
+
+    def __init__(self, saved_sessions=None, system_instructions=None, last_active_title=NEW_CHAT_TITLE):
+        self.saved_sessions = saved_sessions if saved_sessions is not None else {} # title -> [Message]
+        self.system_instructions = system_instructions if system_instructions is not None else {}
+        self.last_active_title = last_active_title
+
+    @classmethod
+    def from_document(cls, data, codec=None):
+        # Firestore에서 로드된 데이터를 Message 리스트로 변환 (압축된 메시지는 처음 읽을 때 풀립니다)
+        saved_sessions = {
+            title: [Message.from_dict(item, codec) for item in history_list]
+            for title, history_list in data.get("chat_data", {}).items()
+        }
+        system_instructions = {title: decode_field(value, codec) for title, value in data.get("system_instructions", {}).items()}
+        return cls(saved_sessions, system_instructions, data.get("last_active_title", NEW_CHAT_TITLE))
+
+    def to_document(self, codec=None):
+        """`codec` (codec.StorageCodec) compresses long message bodies and system instructions; None stores plain text."""
+        system_instructions = self.system_instructions
+        if codec is not None:
+            system_instructions = {title: codec.encode_field(value) for title, value in system_instructions.items()}
+        return {
+            # Convert Message to dictionary for Firestore storage
+            "chat_data": {title: [message.to_dict(codec) for message in history_list]
+                          for title, history_list in self.saved_sessions.items()},
+            "system_instructions": system_instructions,
+            "last_active_title": self.last_active_title
+        }
+
+
+class FirestoreSessionStore:
+    """
+    Reads and writes user documents in the `user_sessions` Firestore collection.
+    With a `codec` (codec.StorageCodec), long message bodies are stored compressed; documents are readable either way.
+    """
+
+    def __init__(self, db, collection=USER_SESSIONS_COLLECTION, codec=None):
+        self.db = db
+        self.collection = collection
+        self.codec = codec
+
+    def load(self, user_id):
+        """Returns the stored UserData, or None if the user has no document."""
+        doc = self.db.collection(self.collection).document(user_id).get()
+        if not doc.exists:
+            return None
+        return UserData.from_document(doc.to_dict(), self.codec)
+
+    def save(self, user_id, user_data):
+        self.db.collection(self.collection).document(user_id).set(user_data.to_document(self.codec))
+
+    def save_many(self, items):
+        """Writes several (user_id, UserData) pairs in one batched commit (at most 500 documents)."""
+        batch = self.db.batch()
+        for user_id, user_data in items:
+            batch.set(self.db.collection(self.collection).document(user_id), user_data.to_document(self.codec))
+        batch.commit()
+
+    def iter_users(self, page_size=50, start_after=None):
+        """
+        Yields (user_id, UserData) in document-id order, reading `page_size` documents per query
+        so only one page is held in memory. `start_after` resumes after the given user id.
+        """
+        collection = self.db.collection(self.collection)
+        cursor = {"__name__": collection.document(start_after)} if start_after is not None else None
+        while True:
+            query = collection.order_by("__name__").limit(page_size)
+            if cursor is not None:
+                query = query.start_after(cursor)
+            count = 0
+            for doc in query.stream():
+                count += 1
+                cursor = doc # 다음 페이지는 마지막 문서 스냅샷 이후부터 읽습니다.
+                yield doc.id, UserData.from_document(doc.to_dict(), self.codec)
+            if count < page_size:
+                return
+
+
+class MemorySessionStore:
+    """Stand-in for FirestoreSessionStore that keeps documents in memory (optionally mirrored to a JSON file)."""
+
+    def __init__(self, path=None, codec=None):
+        self.path = path
+        self.codec = codec
+        self._documents = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self._documents = json.load(f)
+
+    def load(self, user_id):
+        with self._lock:
+            data = self._documents.get(user_id)
+            if data is None:
+                return None
+            return UserData.from_document(copy.deepcopy(data), self.codec)
+
+    def save(self, user_id, user_data):
+        self.save_many([(user_id, user_data)])
+
+    def save_many(self, items):
+        documents = [(user_id, copy.deepcopy(user_data.to_document(self.codec))) for user_id, user_data in items]
+        with self._lock:
+            self._documents.update(documents)
+            self._flush()
+
+    def _flush(self):
+        # 파일 미러는 매번 전체를 다시 쓰므로, 여러 문서는 save_many로 한 번에 저장하는 편이 좋습니다.
+        if self.path:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                # 압축된 payload(bytes)는 JSON에 base64 문자열 형태로 씁니다.
+                json.dump(self._documents, f, ensure_ascii=False, default=payload_text)
+            os.replace(tmp_path, self.path)
+
+    def iter_users(self, page_size=50, start_after=None):
+        with self._lock:
+            user_ids = sorted(self._documents)
+        for user_id in user_ids:
+            if start_after is not None and user_id <= start_after:
+                continue
+            user_data = self.load(user_id)
+            if user_data is not None:
+                yield user_id, user_data
+
+
+def firestore_store_from_env(codec=None):
+    """
+    Initializes Firebase from FIREBASE_CREDENTIAL_PATH (service-account JSON) outside of Streamlit.
+    Without an explicit `codec`, storage compression follows GENX_STORAGE_CODEC (see codec.codec_from_env).
+    """
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    if not firebase_admin._apps:
+        cred_json = os.environ.get("FIREBASE_CREDENTIAL_PATH")
+        if not cred_json:
+            raise RuntimeError("FIREBASE_CREDENTIAL_PATH environment variable is not set.")
+        firebase_admin.initialize_app(credentials.Certificate(json.loads(cred_json)))
+    return FirestoreSessionStore(firestore.client(), codec=codec if codec is not None else codec_from_env())
@@ -0,0 +1,514 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from cancellation import GenerationCancelled
+from governor import PRIORITY_SUPERVISOR
+from messages import estimate_tokens
+
+PERSONA_LIST = [
+    "당신은 매우 활발하고 외향적인 성격입니다. 챗봇의 답변이 생동감 넘치고 에너지 넘치는지 평가하십시오. 사용자와 적극적으로 소통하고 즐거움을 제공하는지 중요하게 생각합니다.",
+    "당신은 비관적인 성격으로, 모든 일에 부정적인 측면을 먼저 바라봅니다. 챗봇의 답변에서 발생 가능한 문제점이나 오류를 날카롭게 지적하고, 위험 요소를 사전에 감지하는 데 집중하십시오.",
+    "당신은 염세적인 세계관을 가진 사람입니다. 챗봇의 답변이 현실적이고 냉철한 분석을 제공하는지 평가하십시오. 챗봇이 제시하는 해결책의 실현 가능성을 꼼꼼하게 검토하고, 허황된 희망을 제시하지 않는지 확인하십시오.",
+    "당신은 긍정적이고 낙천적인 성격으로, 항상 밝은 면을 보려고 노력합니다. 챗봇의 답변이 희망과 용기를 주고, 긍정적인 분위기를 조성하는지 평가하십시오. 사용자의 기분을 좋게 만들고, 문제 해결에 대한 자신감을 심어주는지 중요하게 생각합니다.",
+    "당신은 소심하고 내성적인 성격으로, 낯선 사람과의 대화를 어려워합니다. 챗봇의 답변이 친절하고 부드러운 어조로 전달되는지, 사용자가 편안하게 질문할 수 있도록 배려하는지 평가하십시오. 사용자의 불안감을 해소하고, 안심시키는 데 집중하십시오.",
+    "당신은 꼼꼼하고 분석적인 성격으로, 세부 사항까지 놓치지 않으려고 노력합니다. 챗봇의 답변이 정확하고 논리적인 근거를 제시하는지 평가하십시오. 챗봇이 제공하는 정보의 신뢰성을 검증하고, 오류나 누락된 정보는 없는지 확인하십시오.",
+    "당신은 창의적이고 상상력이 풍부한 성격으로, 틀에 얽매이지 않는 자유로운 사고를 추구합니다. 챗봇의 답변이 독창적이고 혁신적인 아이디어를 제시하는지 평가하십시오. 챗봇이 기존의 틀을 깨고 새로운 가능성을 제시하는지 중요하게 생각합니다.",
+    "당신은 감성적이고 공감 능력이 뛰어난 성격으로, 타인의 감정에 민감하게 반응합니다. 챗봇의 답변이 사용자의 감정을 이해하고, 적절한 위로와 공감을 표현하는지 평가하십시오. 사용자의 슬픔, 분노, 기쁨 등의 감정에 적절하게 대응하는지 확인해야 합니다.",
+    "당신은 비판적이고 논쟁적인 성격으로, 타인의 주장에 대해 끊임없이 질문하고 반박합니다. 챗봇의 답변이 논리적으로 완벽하고, 반박할 수 없는 근거를 제시하는지 평가하십시오. 챗봇의 주장에 대한 허점을 찾아내고, 논리적인 오류를 지적하는 데 집중하십시오.",
+    "당신은 사교적이고 유머 감각이 뛰어난 성격으로, 사람들과의 관계를 중요하게 생각합니다. 챗봇의 답변이 유쾌하고 재미있는 요소를 포함하고 있는지 평가하십시오. 사용자와 편안하게 대화하고, 즐거움을 제공하는 데 집중하십시오.",
+    "당신은 진지하고 책임감이 강한 성격으로, 맡은 일에 최선을 다하려고 노력합니다. 챗봇의 답변이 신뢰할 수 있고, 사용자에게 실질적인 도움을 제공하는지 평가하십시오. 챗봇이 제공하는 정보의 정확성을 검증하고, 문제 해결에 필요한 모든 정보를 빠짐없이 제공하는지 확인하십시오.",
+    "당신은 호기심이 많고 탐구심이 강한 성격으로, 새로운 지식을 배우는 것을 즐거워합니다. 챗봇의 답변이 흥미로운 정보를 제공하고, 사용자의 지적 호기심을 자극하는지 평가하십시오. 챗봇이 새로운 관점을 제시하고, 더 깊이 있는 탐구를 유도하는지 중요하게 생각합니다.",
+    "당신은 관습에 얽매이지 않고 자유로운 영혼을 가진 성격입니다. 챗봇의 답변이 독창적이고 개성 넘치는 표현을 사용하는지 평가하십시오. 챗봇이 기존의 틀을 깨고 새로운 스타일을 창조하는지 중요하게 생각합니다.",
+    "당신은 현실적이고 실용적인 성격으로, 눈에 보이는 결과물을 중요하게 생각합니다. 챗봇의 답변이 사용자의 문제 해결에 실질적인 도움을 제공하고, 구체적인 실행 계획을 제시하는지 평가하십시오. 챗봇이 제시하는 해결책의 실현 가능성을 꼼꼼하게 검토하고, 현실적인 대안을 제시하는지 확인하십시오.",
+    "당신은 이상주의적이고 정의로운 성격으로, 사회 문제에 관심이 많습니다. 챗봇의 답변이 사회적 약자를 배려하고, 불평등 해소에 기여하는지 평가하십시오. 챗봇이 윤리적인 문제를 제기하고, 사회적 책임감을 강조하는지 중요하게 생각합니다.",
+    "당신은 내성적이고 조용한 성격으로, 혼자 있는 시간을 즐깁니다. 챗봇의 답변이 간결하고 명확하며, 불필요한 수식어를 사용하지 않는지 평가하십시오. 사용자가 원하는 정보만 정확하게 제공하고, 혼란을 야기하지 않는지 중요하게 생각합니다.",
+    "당신은 리더십이 강하고 통솔력이 뛰어난 성격입니다. 챗봇의 답변이 명확한 지침을 제공하고, 사용자를 올바른 방향으로 이끄는지 평가하십시오. 챗봇이 문제 해결을 위한 주도적인 역할을 수행하고, 사용자에게 자신감을 심어주는지 중요하게 생각합니다.",
+    "당신은 유머러스하고 재치 있는 성격으로, 사람들을 웃기는 것을 좋아합니다. 챗봇의 답변이 적절한 유머를 사용하여 분위기를 부드럽게 만들고, 사용자에게 즐거움을 제공하는지 평가하십시오. 챗봇이 상황에 맞는 유머를 구사하고, 불쾌감을 주지 않는지 확인해야 합니다.",
+    "당신은 겸손하고 배려심이 깊은 성격으로, 타인을 존중하고 돕는 것을 좋아합니다. 챗봇의 답변이 정중하고 예의 바르며, 사용자를 존중하는 태도를 보이는지 평가하십시오. 챗봇이 사용자의 의견을 경청하고, 공감하는 모습을 보이는지 중요하게 생각합니다.",
+    "당신은 독립적이고 자율적인 성격으로, 스스로 결정하고 행동하는 것을 선호합니다. 챗봇의 답변이 사용자의 자율성을 존중하고, 스스로 판단할 수 있도록 돕는지 평가하십시오. 챗봇이 일방적인 지시나 강요를 하지 않고, 다양한 선택지를 제시하는지 중요하게 생각합니다.",
+    "당신은 완벽주의적인 성향이 강하며, 모든 것을 최고 수준으로 만들고자 합니다. 챗봇의 답변이 문법적으로 완벽하고, 오탈자가 없는지 꼼꼼하게 확인하십시오. 또한, 정보의 정확성과 최신성을 검증하고, 최고의 답변을 제공하는 데 집중하십시오.",
+    "당신은 변화를 두려워하지 않고 새로운 시도를 즐기는 혁신가입니다. 챗봇의 답변이 기존의 방식을 벗어나 새로운 아이디어를 제시하고, 혁신적인 해결책을 제시하는지 평가하십시오. 챗봇이 미래 지향적인 비전을 제시하고, 새로운 가능성을 탐색하는 데 집중하십시오."
+]
+SUPERVISOR_RUBRIC = """
+당신은 AI 챗봇의 답변을 평가하는 전문 Supervisor입니다.
+당신의 임무는 챗봇 사용자의 입력, 챗봇 AI의 이전 대화 히스토리, 챗봇 AI의 현재 system_instruction, 그리고 챗봇 AI가 생성한 답변을 종합적으로 검토하여, 해당 답변이 사용자의 의도와 챗봇의 지시에 얼마나 적절하고 유용하게 생성되었는지 0점부터 100점 사이의 점수로 평가하는 것입니다.
+
+평가 기준:
+1. 사용자 의도 부합성 (총점 30점):
+1.1 질문의 핵심 파악 (0~5점): 사용자의 질문 또는 요청의 핵심 의도를 정확하게 파악했는가?
+1.2 명확하고 직접적인 응답 (0~5점): 질문에 대한 답변이 모호하지 않고 명확하며, 직접적으로 관련되어 있는가?
+1.3 정보의 완전성 (0~5점): 사용자가 필요로 하는 정보를 빠짐없이 제공하고 있는가?
+1.4 목적 충족 (0~5점): 답변이 사용자의 정보 획득 목적 또는 문제 해결 목적을 충족시키는가?
+1.5 추가적인 도움 제공 (0~5점): 필요한 경우, 추가적인 정보나 관련 자료를 제공하여 사용자의 이해를 돕는가?
+1.6 적절한 용어 수준 (0~5점): 답변이 사용자의 수준에 맞추어 설명되어 있는가? 너무 높거나 너무 간단하지는 않은가?
+
+2. 챗봇 시스템 지시 준수 (총점 30점):
+2.1 페르소나 일관성 (0~5점): 챗봇이 system instruction에 명시된 페르소나를 일관되게 유지하고 있는가?
+2.2 답변 스타일 준수 (0~5점): 답변의 어조, 표현 방식 등이 system instruction에 지정된 스타일을 따르고 있는가?
+2.3 정보 포함/제외 규칙 준수 (0~5점): system instruction에 따라 특정 정보가 포함되거나 제외되었는가?
+2.4 형식 준수 (0~5점): system instruction에 명시된 답변 형식 (예: 목록, 표 등)을 정확하게 따르고 있는가?
+2.5 지시 이행 (0~5점): 시스템 지시 사항 (예: 특정 링크 제공, 특정 행동 유도)에 대한 이행 여부
+2.6 문법 및 맞춤법 정확성 (0~5점): 문법 및 맞춤법 오류 없이 system instruction에 따라 작성되었는가?
+
+3. 대화 흐름의 자연스러움 및 일관성 (총점 20점):
+3.1 이전 대화 맥락 이해 (0~5점): 이전 대화 내용을 정확하게 이해하고, 현재 답변에 반영하고 있는가?
+3.2 자연스러운 연결 (0~5점): 이전 대화와 현재 답변이 부자연스럽거나 갑작스럽지 않고 자연스럽게 이어지는가?
+3.3 주제 일관성 (0~5점): 대화 주제에서 벗어나지 않고 일관성을 유지하고 있는가?
+3.4 부적절한 내용 회피 (0~5점): 맥락에 맞지 않거나 부적절한 내용을 포함하지 않고 있는가?
+
+4. 정보의 정확성 및 유용성 (총점 20점):
+4.1 사실 기반 정보 (0~5점): 제공되는 정보가 사실에 근거하고 정확한가?
+4.2 최신 정보 (0~5점): 제공되는 정보가 최신 정보를 반영하고 있는가?
+4.3 정보의 신뢰성 (0~5점): 제공되는 정보의 출처가 신뢰할 만한가?
+4.4 유용한 정보 (0~5점): 사용자가 실제로 활용할 수 있는 실질적인 정보를 제공하는가?
+
+5. 감점 요소
+5.1 Hallucination을 발견했을 경우, -40점
+5.2 이전 답변 중 잊어버린 내용이 발견되었을 경우, -20점
+5.3 Instruction 혹은 이전 답변에서 사용자가 원하는 문장 형식이나 양식이 있었음에도 따르지 않았을 경우, -10점
+
+-----------------------------------------------------------------------------------
+"""
+
+SYSTEM_INSTRUCTION_SUPERVISOR = SUPERVISOR_RUBRIC + """
+출력 형식:
+
+오직 하나의 정수 값 (0-100)만 출력하세요. 다른 텍스트나 설명은 일절 포함하지 마십시오.
+"""
+
+# 여러 페르소나를 한 번의 요청으로 평가할 때 사용하는 지시문
+SYSTEM_INSTRUCTION_BATCH_SUPERVISOR = SUPERVISOR_RUBRIC + """
+이번 평가에서는 여러 명의 평가자 페르소나가 주어집니다.
+각 페르소나의 관점에서 서로 독립적으로 위 기준을 적용하여 점수를 매기십시오.
+
+출력 형식:
+
+{"scores": [정수, 정수, ...]} 형태의 JSON 객체 하나만 출력하세요.
+scores 배열에는 주어진 페르소나 순서대로 정확히 페르소나 개수만큼의 0-100 정수가 들어가야 합니다. 다른 텍스트나 설명은 일절 포함하지 마십시오.
+"""
+
+# 그 다다음 줄부터 왜 그런 점수가 나왔는지 서술하세요. 각 항목들에 대해 명확하게 각각 몇 점을 주었는지, 무엇에서 감점당했는지 서술하시오.
+# 예시:
+# 73
+
+# 내가 이 점수를 매기게 된 것은 다음과 같은 이유에서다.
+# 1. 사용자 의도 부합성
+# 1.1 질문의 핵심 파악 (?/5): ~~~
+# 1.2 명확하고 직접적인 응답 (?/5): ~~~
+# 1.3 정보의 완전성 (?/5): ~~~
+# 1.4 목적 충족 (?/5): ~~~
+# 1.5 추가적인 도움 제공 (?/5): ~~~
+# 1.6 적절한 용어 수준 (?/5): ~~~
+# ...
+
+SUPERVISOR_DEFAULT_SCORE = 50 # 평가에 실패했을 때 사용하는 기본 점수
+_JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+_INTEGER_PATTERN = re.compile(r"-?\d+")
+
+
+def _clamp_score(score):
+    if not (0 <= score <= 100):
+        print(f"경고: Supervisor가 0-100 범위를 벗어난 점수를 반환했습니다: {score}")
+    return max(0, min(100, score))
+
+
+def parse_score(text):
+    """Extracts the first integer from a supervisor reply. Returns None if there is none."""
+    match = _INTEGER_PATTERN.search(text or "")
+    if match is None:
+        return None
+    return _clamp_score(int(match.group()))
+
+
+def parse_batched_scores(text, expected_count):
+    """
+    Parses a batched supervisor reply of the form {"scores": [..]} (or a bare list).
+    Returns a list of `expected_count` scores, or None when the reply is malformed.
+    """
+    text = (text or "").strip()
+    candidates = [text]
+    match = _JSON_OBJECT_PATTERN.search(text)
+    if match is not None:
+        candidates.append(match.group())
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            data = data.get("scores")
+        if not isinstance(data, list) or len(data) != expected_count:
+            continue
+        if not all(isinstance(score, (int, float)) and not isinstance(score, bool) for score in data):
+            continue
+        return [_clamp_score(int(round(score))) for score in data]
+    return None
+
+
+def format_history(chat_history):
+    return "\n".join(f"{message.role}: {message.text}" for message in chat_history)
+
+
+def build_evaluation_prompt(user_input, history_text, system_instruction, ai_response):
+    # Supervisor에게 전달할 메시지 구성
+    return f"""
+    사용자 입력: {user_input}
+    ---
+    채팅 히스토리:
+    
+{history_text}
+    ---
+    챗봇 AI 시스템 지시: {system_instruction}
+    ---
+    챗봇 AI 답변: {ai_response}
+
+    위 정보를 바탕으로, 챗봇 AI의 답변에 대해 0점부터 100점 사이의 점수를 평가하세요.
+    """
+
+
+def build_partial_evaluation_prompt(user_input, history_text, system_instruction, partial_response):
+    return f"""
+    사용자 입력: {user_input}
+    ---
+    채팅 히스토리:
+    
+{history_text}
+    ---
+    챗봇 AI 시스템 지시: {system_instruction}
+    ---
+    챗봇 AI 답변 (아직 생성 중인 앞부분): {partial_response}
+
+    답변이 아직 완성되지 않았습니다. 문장이 끊긴 것은 감점하지 말고, 지금까지의 방향과 내용을 바탕으로
+    이 답변이 이대로 완성되었을 때 받을 점수를 0점부터 100점 사이로 예측하세요.
+    """
+
+
+def build_digest_prompt(previous_digest, messages, max_chars):
+    previous = previous_digest or "(없음)"
+    return f"""
+    다음은 챗봇과 사용자의 이전 대화 요약과, 그 이후에 이어진 대화입니다.
+    챗봇 답변을 평가하는 Supervisor가 참고할 수 있도록 두 내용을 합쳐 하나의 요약으로 갱신하세요.
+    사용자의 요구사항, 사용자가 지정한 형식이나 양식, 챗봇이 제공한 핵심 사실과 약속은 빠짐없이 남기고,
+    {max_chars}자 이내로 작성하세요. 요약 외의 다른 텍스트는 출력하지 마십시오.
+    ---
+    이전 요약:
+    {previous}
+    ---
+    이어진 대화:
+{format_history(messages)}
+    """
+
+
+class HistoryDigestCache:
+    """
+    Process-wide cache of rolling summaries keyed by a chained hash of the summarized messages.
+    A longer prefix is summarized incrementally from the longest cached shorter prefix,
+    so each message is folded into a digest at most once per conversation.
+    `generate(prompt)` returns the summary text.
+    """
+
+    def __init__(self, generate, max_entries=512, max_chars=1500, metrics=None):
+        self.generate = generate
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.metrics = metrics
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _incr(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    @staticmethod
+    def chain_hashes(messages):
+        # 각 Message에 캐시된 content_hash를 이어서 해시하므로 본문을 다시 읽지 않습니다.
+        hashes = []
+        current = b""
+        for message in messages:
+            current = hashlib.sha1(current + message.content_hash).digest()
+            hashes.append(current)
+        return hashes
+
+    def _lookup(self, key):
+        with self._lock:
+            digest = self._entries.get(key)
+            if digest is not None:
+                self._entries.move_to_end(key)
+            return digest
+
+    def _store(self, key, digest):
+        with self._lock:
+            self._entries[key] = digest
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def digest(self, messages):
+        hashes = self.chain_hashes(messages)
+        cached = self._lookup(hashes[-1])
+        if cached is not None:
+            self._incr("digest.hits")
+            return cached
+        self._incr("digest.misses")
+        start, previous = 0, None
+        for index in range(len(hashes) - 2, -1, -1):
+            previous = self._lookup(hashes[index])
+            if previous is not None:
+                start = index + 1
+                break
+        try:
+            digest = self.generate(build_digest_prompt(previous, messages[start:], self.max_chars)).strip()
+        except Exception as e:
+            print(f"히스토리 요약 생성 중 오류 발생: {e}. 이전 대화를 잘라서 사용합니다.")
+            return format_history(messages)[-self.max_chars:]
+        self._store(hashes[-1], digest)
+        return digest
+
+
+class SupervisorContextBuilder:
+    """
+    Builds the chat-history block of supervisor prompts within a token budget.
+    Histories that fit are passed verbatim; otherwise the last `keep_recent` messages stay verbatim
+    and everything older is replaced by a cached digest.
+    """
+
+    def __init__(self, digest_cache, token_budget=4000, keep_recent=6):
+        self.digest_cache = digest_cache
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+
+    def build(self, chat_history):
+        chat_history = list(chat_history)
+        costs = [message.token_count for message in chat_history]
+        if sum(costs) <= self.token_budget:
+            return format_history(chat_history)
+        split = max(0, len(chat_history) - self.keep_recent)
+        # 최근 메시지만으로도 예산을 넘으면 최소 2개(직전 사용자/챗봇 턴)만 남깁니다.
+        while split < len(chat_history) - 2 and sum(costs[split:]) > self.token_budget:
+            split += 1
+        recent = format_history(chat_history[split:])
+        if split == 0:
+            return recent
+        digest = self.digest_cache.digest(chat_history[:split])
+        return f"(이전 대화 {split}개 메시지 요약)\n{digest}\n\n(최근 대화)\n{recent}"
+
+
+def build_batched_evaluation_prompt(evaluation_prompt, personas):
+    persona_lines = "\n".join(f"[{i + 1}] {persona}" for i, persona in enumerate(personas))
+    return f"""{evaluation_prompt}
+    ---
+    평가자 페르소나 ({len(personas)}명):
+{persona_lines}
+
+    각 페르소나의 관점에서 독립적으로 평가하고, 순서대로 {len(personas)}개의 점수를 JSON으로 출력하세요.
+    """
+
+
+class SupervisorPanel:
+    """
+    Runs a panel of persona supervisors over one AI answer.
+    `load_model(model_name, system_instruction)` returns a GenerativeModel; calls go through `governor`.
+    Once `cancel_token` is cancelled, remaining evaluations raise GenerationCancelled instead of scoring.
+    """
+
+    def __init__(self, load_model, governor, model_name, metrics=None, context_builder=None, cancel_token=None):
+        self.load_model = load_model
+        self.governor = governor
+        self.model_name = model_name
+        self.metrics = metrics
+        self.context_builder = context_builder
+        self.cancel_token = cancel_token
+
+    def build_prompt(self, user_input, chat_history, system_instruction, ai_response):
+        if self.context_builder is None:
+            history_text = format_history(chat_history)
+        else:
+            history_text = self.context_builder.build(chat_history)
+        evaluation_prompt = build_evaluation_prompt(user_input, history_text, system_instruction, ai_response)
+        if self.metrics is not None:
+            self.metrics.observe("supervisor.prompt_tokens", estimate_tokens(evaluation_prompt))
+        return evaluation_prompt
+
+    def _incr(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    def _generate(self, system_instruction, prompt, **kwargs):
+        model = self.load_model(self.model_name, system_instruction)
+        self._incr("supervisor.requests")
+        self._incr(f"supervisor.requests.{self.model_name}")
+        return self.governor.call(self.model_name, model.generate_content, prompt, priority=PRIORITY_SUPERVISOR,
+                                  cancel_token=self.cancel_token, **kwargs)
+
+    def evaluate(self, evaluation_prompt, persona):
+        """
+        Supervisor 모델을 사용하여 AI 응답의 적절성을 평가합니다.
+        """
+        score_text = ""
+        try:
+            response = self._generate(persona + "\n" + SYSTEM_INSTRUCTION_SUPERVISOR, evaluation_prompt)
+            score_text = response.text.strip()
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            print(f"Supervisor 모델 호출 중 오류 발생: {e}")
+            return SUPERVISOR_DEFAULT_SCORE # 오류 발생 시 기본 점수 반환
+        score = parse_score(score_text)
+        if score is None:
+            print(f"Supervisor 응답을 점수로 변환하는 데 실패했습니다: {score_text}")
+            return SUPERVISOR_DEFAULT_SCORE
+        return score
+
+    def evaluate_batched(self, evaluation_prompt, personas):
+        """Scores all `personas` in one request. Returns None when the reply cannot be parsed."""
+        try:
+            response = self._generate(
+                SYSTEM_INSTRUCTION_BATCH_SUPERVISOR,
+                build_batched_evaluation_prompt(evaluation_prompt, personas),
+                generation_config={"response_mime_type": "application/json"}
+            )
+            reply_text = response.text
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            print(f"일괄 Supervisor 호출 중 오류 발생: {e}")
+            return None
+        scores = parse_batched_scores(reply_text, len(personas))
+        if scores is None:
+            print(f"일괄 Supervisor 응답 형식이 올바르지 않습니다: {reply_text[:200]}")
+        return scores
+
+    def run_prompt(self, count, evaluation_prompt, batched=True):
+        """Returns `count` scores for a prepared evaluation prompt, one per randomly chosen persona."""
+        if batched and count > 1:
+            personas = random.sample(PERSONA_LIST, min(count, len(PERSONA_LIST)))
+            scores = self.evaluate_batched(evaluation_prompt, personas)
+            if scores is not None:
+                self._incr("supervisor.batched")
+                return scores
+            # 일괄 응답이 잘못된 경우 페르소나별 개별 호출로 대체합니다.
+            self._incr("supervisor.batch_fallbacks")
+        else:
+            personas = [random.choice(PERSONA_LIST) for _ in range(count)]
+        return [self.evaluate(evaluation_prompt, persona) for persona in personas]
+
+    def run(self, count, user_input, chat_history, system_instruction, ai_response, batched=True):
+        evaluation_prompt = self.build_prompt(user_input, chat_history, system_instruction, ai_response)
+        return self.run_prompt(count, evaluation_prompt, batched=batched)
+
+
+def is_borderline(scores, threshold, band):
+    """True when the average score lies within `band` points of `threshold`."""
+    average = sum(scores) / len(scores)
+    return abs(average - threshold) <= band
+
+
+class SupervisorCascade:
+    """
+    Runs the panel on `cheap_model` first and escalates to `strong_model` only when
+    the cheap verdict is within `band` points of the pass threshold.
+    """
+
+    def __init__(self, load_model, governor, cheap_model, strong_model, threshold, band, metrics=None,
+                 context_builder=None, cancel_token=None):
+        self.cheap = SupervisorPanel(load_model, governor, cheap_model, metrics=metrics, context_builder=context_builder,
+                                     cancel_token=cancel_token)
+        self.strong = SupervisorPanel(load_model, governor, strong_model, metrics=metrics, context_builder=context_builder,
+                                      cancel_token=cancel_token)
+        self.threshold = threshold
+        self.band = band
+        self.metrics = metrics
+        self.cancel_token = cancel_token
+
+    def _incr(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    def run(self, count, user_input, chat_history, system_instruction, ai_response, batched=True):
+        started = time.monotonic()
+        # 히스토리 요약은 한 번만 만들어 1단계와 재평가에서 함께 사용합니다.
+        evaluation_prompt = self.strong.build_prompt(user_input, chat_history, system_instruction, ai_response)
+        if self.cheap.model_name == self.strong.model_name:
+            scores = self.strong.run_prompt(count, evaluation_prompt, batched=batched)
+        else:
+            scores = self.cheap.run_prompt(count, evaluation_prompt, batched=batched)
+            if is_borderline(scores, self.threshold, self.band):
+                if self.cancel_token is not None:
+                    self.cancel_token.raise_if_cancelled()
+                self._incr("cascade.escalations")
+                print(f"Supervisor 점수가 경계 구간에 있어 {self.strong.model_name} 모델로 다시 평가합니다: {scores}")
+                scores = self.strong.run_prompt(count, evaluation_prompt, batched=batched)
+            else:
+                self._incr("cascade.resolved_cheap")
+        if self.metrics is not None:
+            self.metrics.observe("supervision.seconds", time.monotonic() - started)
+        return scores
+
+
+class StreamingSupervisor:
+    """
+    Scores a partial answer with one cheap supervisor request every `checkpoint_tokens` tokens while it streams.
+    Checks run on `executor` so streaming is never paused; `observe` returns the projected score once a check
+    comes back more than `margin` points below `threshold`, telling the caller to abort the attempt.
+    The model and history context are prepared on the calling thread (they may use Streamlit caches).
+    """
+
+    def __init__(self, load_model, governor, model_name, executor, user_input, chat_history, system_instruction,
+                 threshold, margin, checkpoint_tokens, metrics=None, context_builder=None, cancel_token=None):
+        self.governor = governor
+        self.model_name = model_name
+        self.executor = executor
+        self.model = load_model(model_name, SYSTEM_INSTRUCTION_SUPERVISOR)
+        history_text = format_history(chat_history) if context_builder is None else context_builder.build(chat_history)
+        self.user_input = user_input
+        self.history_text = history_text
+        self.system_instruction = system_instruction
+        self.abort_below = threshold - margin
+        self.checkpoint_tokens = checkpoint_tokens
+        self.metrics = metrics
+        self.cancel_token = cancel_token
+        self.start_attempt()
+
+    def _incr(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    def start_attempt(self):
+        self._pending = None
+        self._next_checkpoint = self.checkpoint_tokens
+
+    def _check(self, partial_response):
+        prompt = build_partial_evaluation_prompt(self.user_input, self.history_text, self.system_instruction, partial_response)
+        self._incr("checkpoint.checks")
+        self._incr("supervisor.requests")
+        self._incr(f"supervisor.requests.{self.model_name}")
+        response = self.governor.call(self.model_name, self.model.generate_content, prompt, priority=PRIORITY_SUPERVISOR,
+                                      cancel_token=self.cancel_token)
+        return parse_score(response.text)
+
+    def observe(self, partial_response):
+        """Called for each streamed chunk. Returns the projected score when the attempt should be aborted, else None."""
+        if self._pending is not None and self._pending.done():
+            future, self._pending = self._pending, None
+            try:
+                score = future.result()
+            except Exception as e:
+                print(f"중간 Supervisor 평가 중 오류 발생: {e}")
+                score = None
+            if score is not None and score < self.abort_below:
+                return score
+        if self._pending is None and estimate_tokens(partial_response) >= self._next_checkpoint:
+            self._next_checkpoint = estimate_tokens(partial_response) + self.checkpoint_tokens
+            self._pending = self.executor.submit(self._check, partial_response)
+        return None
+
+    def finish(self):
+        # 스트림이 끝난 뒤 도착하는 결과는 필요 없으므로 대기 중인 평가를 버립니다.
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
@@ -0,0 +1,298 @@
+"""
+Streaming export/import of GenX conversations as NDJSON (optionally gzip-compressed).
+
+Export reads one user document at a time and writes one record per line:
+    {"kind": "header", "format": "genx-ndjson", "version": 1, "exported_at": ...}
+    {"kind": "user", "user_id": "...", "last_active_title": "..."}
+    {"kind": "conversation", "user_id": "...", "title": "...", "system_instruction": "...", "messages": 2}
+    {"kind": "message", "user_id": "...", "title": "...", "index": 0, "role": "user", "text": "...", "created_at": ...}
+    {"kind": "instruction", "user_id": "...", "title": "...", "system_instruction": "..."}
+    {"kind": "end_user", "user_id": "...", "conversations": 1, "messages": 2, "instructions": 1}
+`instruction` records carry system instructions of titles without a saved conversation (e.g. set on a new chat
+before its first message); exports without them (no `instructions` count) still import.
+Messages are always exported as plain text, so exports do not depend on the storage codec (codec.py);
+imported documents are compressed according to GENX_STORAGE_CODEC.
+Import rebuilds one user at a time and writes users in batched commits. Committed user ids are appended to a
+checkpoint file, so an interrupted import resumes where it stopped. Users whose records are incomplete
+(no matching `end_user`, e.g. a truncated export) are not written.
+
+    python transfer.py export backup.ndjson.gz --store firestore
+    python transfer.py import backup.ndjson.gz --store memory --store-path sessions.json --batch-size 50
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+from codec import codec_from_env
+from messages import Message
+from storage import NEW_CHAT_TITLE, MemorySessionStore, UserData, firestore_store_from_env
+
+FORMAT_NAME = "genx-ndjson"
+FORMAT_VERSION = 1
+DEFAULT_BATCH_SIZE = 50 # 한 번의 batch commit에 쓰는 사용자 문서 수
+MAX_BATCH_DOCUMENTS = 500 # Firestore batch 하나에 넣을 수 있는 최대 쓰기 수
+MAX_BATCH_BYTES = 8 * 1024 * 1024 # Firestore 요청 크기 제한(10MiB) 아래로 batch를 나눕니다
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def open_output(path, compress=None):
+    if compress is None:
+        compress = path.endswith(".gz")
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+def open_input(path):
+    # 확장자 대신 파일 앞부분으로 gzip 여부를 판단합니다.
+    with open(path, "rb") as f:
+        compressed = f.read(2) == GZIP_MAGIC
+    if compressed:
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def user_records(user_id, user_data):
+    """Yields the NDJSON records of one user, conversation by conversation."""
+    yield {"kind": "user", "user_id": user_id, "last_active_title": user_data.last_active_title}
+    message_count = 0
+    for title, history in user_data.saved_sessions.items():
+        yield {
+            "kind": "conversation",
+            "user_id": user_id,
+            "title": title,
+            "system_instruction": user_data.system_instructions.get(title),
+            "messages": len(history),
+        }
+        for index, message in enumerate(history):
+            yield {"kind": "message", "user_id": user_id, "title": title, "index": index, **message.to_dict()}
+        message_count += len(history)
+    instruction_count = 0
+    for title, system_instruction in user_data.system_instructions.items():
+        if title not in user_data.saved_sessions:
+            instruction_count += 1
+            yield {"kind": "instruction", "user_id": user_id, "title": title, "system_instruction": system_instruction}
+    yield {"kind": "end_user", "user_id": user_id, "conversations": len(user_data.saved_sessions), "messages": message_count,
+           "instructions": instruction_count}
+
+
+class TransferReporter:
+    def __init__(self, label, interval=10.0):
+        self.label = label
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.users = 0
+        self.messages = 0
+        self.skipped = 0
+        self.last_user_id = None
+
+    def record(self, user_id, messages):
+        self.users += 1
+        self.messages += messages
+        self.last_user_id = user_id
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def report(self, final=False):
+        elapsed = max(1e-9, time.monotonic() - self.started)
+        state = "완료" if final else "진행"
+        skipped = f" · 건너뜀 {self.skipped}명" if self.skipped else ""
+        print(f"[{self.label} {state}] 사용자 {self.users}명 · 메시지 {self.messages}개{skipped} · "
+              f"{self.users / elapsed:.1f}명/초 · 마지막 사용자 {self.last_user_id} · {elapsed:.0f}초 경과", file=sys.stderr)
+
+
+def export_users(store, path, user_ids=None, start_after=None, page_size=50, compress=None, reporter=None):
+    """
+    Streams users from `store` into an NDJSON file. Only one user document is held in memory at a time.
+    `user_ids` limits the export to those users; otherwise every user after `start_after` is exported.
+    """
+    reporter = reporter or TransferReporter("내보내기")
+    if user_ids:
+        users = ((user_id, store.load(user_id)) for user_id in user_ids)
+    else:
+        users = store.iter_users(page_size=page_size, start_after=start_after)
+    with open_output(path, compress) as out:
+        header = {"kind": "header", "format": FORMAT_NAME, "version": FORMAT_VERSION, "exported_at": time.time()}
+        out.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for user_id, user_data in users:
+            if user_data is None:
+                print(f"사용자 {user_id}의 문서가 없어 건너뜁니다.", file=sys.stderr)
+                reporter.skipped += 1
+                continue
+            messages = 0
+            for record in user_records(user_id, user_data):
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                if record["kind"] == "message":
+                    messages += 1
+            reporter.record(user_id, messages)
+    reporter.report(final=True)
+    return reporter
+
+
+def _lines(f):
+    # 중간에 잘린 gzip 파일은 읽을 수 있는 데까지만 읽습니다.
+    line_number = 0
+    try:
+        for line in f:
+            line_number += 1
+            yield line_number, line
+    except EOFError:
+        print(f"{line_number}번째 줄 이후 압축 파일이 잘려 있습니다.", file=sys.stderr)
+
+
+def read_users(path):
+    """
+    Rebuilds users from an NDJSON export, yielding (user_id, UserData, message_count) once each user is complete.
+    Incomplete users (missing records or no `end_user`) are reported and skipped.
+    """
+    with open_input(path) as f:
+        user_id = None
+        user_data = None
+        instruction_count = 0
+        for line_number, line in _lines(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                kind = record["kind"]
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"{path}:{line_number}: 레코드 파싱 실패, 건너뜁니다: {e}", file=sys.stderr)
+                continue
+            if kind == "header":
+                if record.get("format") != FORMAT_NAME or record.get("version", 0) > FORMAT_VERSION:
+                    raise ValueError(f"지원하지 않는 내보내기 형식입니다: {record.get('format')} v{record.get('version')}")
+            elif kind == "user":
+                if user_id is not None:
+                    print(f"사용자 {user_id}의 레코드가 끝나지 않아 건너뜁니다.", file=sys.stderr)
+                user_id = record["user_id"]
+                user_data = UserData(last_active_title=record.get("last_active_title") or NEW_CHAT_TITLE)
+                instruction_count = 0
+            elif user_id is None or record.get("user_id") != user_id:
+                print(f"{path}:{line_number}: 사용자 레코드 밖의 {kind} 레코드를 건너뜁니다.", file=sys.stderr)
+            elif kind == "conversation":
+                user_data.saved_sessions[record["title"]] = []
+                if record.get("system_instruction") is not None:
+                    user_data.system_instructions[record["title"]] = record["system_instruction"]
+            elif kind == "message":
+                user_data.saved_sessions.setdefault(record["title"], []).append(Message.from_dict(record))
+            elif kind == "instruction":
+                # 대화 없이 시스템 명령어만 있는 제목입니다. 빈 대화는 만들지 않습니다.
+                user_data.system_instructions[record["title"]] = record["system_instruction"]
+                instruction_count += 1
+            elif kind == "end_user":
+                message_count = sum(len(history) for history in user_data.saved_sessions.values())
+                if message_count != record.get("messages") or len(user_data.saved_sessions) != record.get("conversations"):
+                    print(f"사용자 {user_id}의 메시지 수가 일치하지 않아 건너뜁니다 "
+                          f"({message_count}/{record.get('messages')}).", file=sys.stderr)
+                elif instruction_count != record.get("instructions", instruction_count):
+                    print(f"사용자 {user_id}의 시스템 명령어 수가 일치하지 않아 건너뜁니다 "
+                          f"({instruction_count}/{record.get('instructions')}).", file=sys.stderr)
+                else:
+                    yield user_id, user_data, message_count
+                user_id = None
+                user_data = None
+        if user_id is not None:
+            print(f"사용자 {user_id}의 레코드가 끝나지 않아 건너뜁니다 (잘린 파일).", file=sys.stderr)
+
+
+def read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def _value_bytes(value):
+    # Firestore 문서 크기 계산과 비슷하게 셉니다: 문자열은 UTF-8 길이 + 1, bytes는 길이, 숫자/불리언/None은 8.
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(key.encode("utf-8")) + 1 + _value_bytes(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_value_bytes(item) for item in value)
+    return 8
+
+
+def _document_bytes(user_data, codec=None):
+    """Approximate write size of the document `store.save_many` will write (messages, instructions, attachment refs)."""
+    return _value_bytes(user_data.to_document(codec))
+
+
+def import_users(store, path, batch_size=DEFAULT_BATCH_SIZE, checkpoint_path=None, skip_existing=False, reporter=None):
+    """
+    Writes the users of an NDJSON export into `store` with batched commits.
+    Memory holds the user being read plus one pending batch. After each commit the user ids are appended to
+    `checkpoint_path`; users already listed there are skipped, which makes an interrupted import resumable.
+    """
+    reporter = reporter or TransferReporter("가져오기")
+    done = read_checkpoint(checkpoint_path)
+    batch_size = max(1, min(batch_size, MAX_BATCH_DOCUMENTS))
+    batch = []
+    batch_messages = []
+    batch_bytes = 0
+
+    def flush():
+        nonlocal batch, batch_messages, batch_bytes
+        if not batch:
+            return
+        store.save_many(batch)
+        if checkpoint_path:
+            with open(checkpoint_path, "a", encoding="utf-8") as f:
+                f.write("".join(user_id + "\n" for user_id, _ in batch))
+                f.flush()
+                os.fsync(f.fileno())
+        for (user_id, _), message_count in zip(batch, batch_messages):
+            reporter.record(user_id, message_count)
+        batch, batch_messages, batch_bytes = [], [], 0
+
+    for user_id, user_data, message_count in read_users(path):
+        if user_id in done or (skip_existing and store.load(user_id) is not None):
+            reporter.skipped += 1
+            continue
+        # 저장할 때와 같은 codec으로 만든 문서 크기로 batch를 나눕니다 (압축 결과는 Message에 남아 저장 시 재사용됩니다).
+        size = _document_bytes(user_data, store.codec)
+        if batch and batch_bytes + size > MAX_BATCH_BYTES:
+            flush()
+        batch.append((user_id, user_data))
+        batch_messages.append(message_count)
+        batch_bytes += size
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    reporter.report(final=True)
+    return reporter
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GenX 대화 NDJSON 내보내기/가져오기")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="NDJSON 파일 (.gz이면 gzip 압축)")
+    parser.add_argument("--store", choices=["firestore", "memory"], default="firestore")
+    parser.add_argument("--store-path", help="memory 저장소를 미러링할 JSON 파일 경로")
+    parser.add_argument("--user", action="append", dest="users", help="내보낼 사용자 ID (여러 번 지정 가능)")
+    parser.add_argument("--start-after", help="이 사용자 ID 다음부터 내보냅니다 (중단된 내보내기 이어서 하기)")
+    parser.add_argument("--page-size", type=int, default=50, help="내보낼 때 한 번에 읽는 사용자 문서 수")
+    parser.add_argument("--gzip", action="store_true", help="확장자와 관계없이 gzip으로 압축")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="가져올 때 한 번에 커밋하는 사용자 수")
+    parser.add_argument("--checkpoint", help="가져온 사용자 ID 기록 파일 (기본: <path>.imported)")
+    parser.add_argument("--skip-existing", action="store_true", help="이미 문서가 있는 사용자는 덮어쓰지 않습니다")
+    args = parser.parse_args(argv)
+
+    store = MemorySessionStore(args.store_path, codec=codec_from_env()) if args.store == "memory" else firestore_store_from_env()
+    if args.command == "export":
+        export_users(store, args.path, args.users, args.start_after, args.page_size, compress=True if args.gzip else None)
+    else:
+        import_users(store, args.path, args.batch_size, args.checkpoint or args.path + ".imported", args.skip_existing)
+
+
+if __name__ == "__main__":
+    main()
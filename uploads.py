@@ -0,0 +1,223 @@
+import base64
+import io
+import os
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+
+MAX_UPLOAD_FILES = 10 # 한 번에 첨부할 수 있는 파일 수
+MAX_UPLOAD_TOTAL_BYTES = 50 * 1024 * 1024 # 한 턴에 첨부하는 파일 전체 크기 상한
+MAX_PDF_PAGES_TO_PROCESS = 100 # 한 턴의 모든 PDF에서 이미지로 변환하는 페이지 수 상한
+PDF_RENDER_DPI = 300 # OCR/비전 품질을 위한 PDF 렌더링 해상도
+PDF_PAGES_PER_TASK = 8 # 큰 PDF는 이 페이지 수 단위로 나눠 여러 작업자가 동시에 렌더링합니다
+MAX_IMAGE_SIDE = 3072 # 이보다 큰 이미지는 축소합니다 (Gemini가 어차피 축소하므로 업로드만 줄어듭니다)
+SUPPORTED_IMAGE_TYPES = ("image/png", "image/jpeg", "image/webp") # 그대로 보낼 수 있는 이미지 형식
+UPLOAD_FILE_TYPES = ["png", "jpg", "jpeg", "webp", "gif", "bmp", "pdf"]
+
+
+# --- Worker functions ---
+# 프로세스 풀에서 실행되므로 모듈 최상위 함수로 두고, 바이트나 파일 경로만 주고받습니다.
+# (PyMuPDF는 스레드 간 동시 사용을 지원하지 않으므로 페이지 수 확인과 렌더링 모두 별도 프로세스에서 합니다.)
+# PDF는 임시 파일에 한 번만 쓰고 경로를 넘기므로, 여러 작업으로 나눠도 PDF 전체를 작업마다 복사하지 않습니다.
+def render_pdf_pages(path, start, stop, dpi=PDF_RENDER_DPI):
+    """Renders pages [start, stop) of the PDF at `path` to PNG. Returns (list of PNG bytes, seconds)."""
+    import fitz
+    started = time.perf_counter()
+    images = []
+    with fitz.open(path) as pdf_document:
+        for page_num in range(start, min(stop, len(pdf_document))):
+            page = pdf_document.load_page(page_num)
+            pix = page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72))
+            images.append(pix.tobytes()) # PNG
+    return images, time.perf_counter() - started
+
+
+def normalize_image(data, mime_type, max_side=MAX_IMAGE_SIDE):
+    """
+    Applies EXIF orientation, downsizes images larger than `max_side` and converts formats Gemini does not accept
+    (GIF, BMP, ...) to PNG. Returns ((mime_type, bytes), seconds); small supported images are returned unchanged.
+    """
+    from PIL import Image, ImageOps
+    started = time.perf_counter()
+    with Image.open(io.BytesIO(data)) as image:
+        # exif_transpose는 회전이 필요 없어도 새 이미지를 반환하므로 Orientation 태그(0x0112)로 직접 판단합니다.
+        # 회전해도 가로/세로만 바뀌므로 긴 변의 길이는 같습니다.
+        rotated = image.getexif().get(0x0112, 1) not in (1, None)
+        oversized = max(image.size) > max_side
+        if mime_type in SUPPORTED_IMAGE_TYPES and not rotated and not oversized:
+            return (mime_type, data), time.perf_counter() - started
+        transposed = ImageOps.exif_transpose(image) if rotated else image
+        if oversized:
+            transposed.thumbnail((max_side, max_side))
+        output = io.BytesIO()
+        if mime_type == "image/jpeg":
+            transposed.convert("RGB").save(output, format="JPEG", quality=90)
+        else:
+            mime_type = "image/png"
+            transposed.save(output, format="PNG")
+    return (mime_type, output.getvalue()), time.perf_counter() - started
+
+
+def pdf_page_count(path):
+    import fitz
+    with fitz.open(path) as pdf_document:
+        return len(pdf_document)
+
+
+@dataclass
+class FileResult:
+    """Preprocessing outcome of one uploaded file, in upload order."""
+    name: str
+    mime_type: str
+    size: int
+    parts: list = field(default_factory=list) # Gemini inline_data 파트 (페이지 순서)
+    pages: int = 0 # 변환한 PDF 페이지 수 (이미지는 0)
+    total_pages: int = 0 # PDF 원본 페이지 수
+    seconds: float = 0.0 # 일괄 처리 시작부터 이 파일이 끝날 때까지 걸린 시간
+    work_seconds: float = 0.0 # 작업자가 이 파일에 실제로 사용한 시간의 합
+    tasks: int = 0
+    done_tasks: int = 0
+    error: str = None
+    note: str = None # 예산 때문에 일부만 처리했거나 건너뛴 경우의 안내
+
+    @property
+    def done(self):
+        return self.done_tasks >= self.tasks
+
+    @property
+    def progress(self):
+        return 1.0 if self.tasks == 0 else self.done_tasks / self.tasks
+
+
+def _inline_part(mime_type, data):
+    return {"inline_data": {"mime_type": mime_type, "data": base64.b64encode(data).decode("ascii")}}
+
+
+def plan_uploads(files, max_total_bytes=MAX_UPLOAD_TOTAL_BYTES):
+    """
+    Assigns the shared size budget in upload order. `files` is a list of (name, mime_type, data).
+    Returns the FileResults; files over budget or of unsupported types get a note or error.
+    """
+    results = []
+    remaining_bytes = max_total_bytes
+    for name, mime_type, data in files:
+        result = FileResult(name, mime_type, len(data))
+        results.append(result)
+        if len(data) > remaining_bytes:
+            result.note = f"첨부 파일 전체 크기 제한({max_total_bytes // (1024 * 1024)}MB)을 넘어 건너뛰었습니다."
+        elif mime_type != "application/pdf" and not mime_type.startswith("image/"):
+            result.error = f"지원되지 않는 파일 형식입니다: {mime_type}"
+        else:
+            remaining_bytes -= len(data)
+    return results
+
+
+def plan_pdf_pages(result, remaining_pages, max_pages=MAX_PDF_PAGES_TO_PROCESS):
+    """Returns how many pages of a PDF (with `total_pages` known) fit in the remaining page budget, setting a note if cut."""
+    pages = min(result.total_pages, remaining_pages)
+    if pages == 0 and result.total_pages:
+        result.note = f"페이지 제한({max_pages}페이지)을 모두 사용하여 건너뛰었습니다."
+    elif pages < result.total_pages:
+        result.note = f"페이지 제한({max_pages}페이지)으로 처음 {pages}페이지만 처리했습니다."
+    return pages
+
+
+def preprocess_uploads(files, executor, max_total_bytes=MAX_UPLOAD_TOTAL_BYTES, max_pages=MAX_PDF_PAGES_TO_PROCESS,
+                       on_progress=None, metrics=None):
+    """
+    Preprocesses uploaded files concurrently on `executor` (image normalization, PDF page rendering)
+    and returns the FileResults in upload order. `on_progress(index, result)` is called from the calling thread
+    whenever a task of that file finishes, so the caller can update per-file progress.
+    PDFs are written to a temporary file once; page counting and rendering run on `executor` and read from it.
+    Use `combined_parts(results)` for the ordered Gemini parts.
+    """
+    started = time.perf_counter()
+    results = plan_uploads(files, max_total_bytes)
+    chunks = {} # future -> (file_index, task_number)
+    outputs = [{} for _ in results] # file_index -> {task_number: output}
+    task_numbers = iter(range(1 << 30))
+
+    def submit(index, function, *args):
+        try:
+            chunks[executor.submit(function, *args)] = (index, next(task_numbers))
+            results[index].tasks += 1
+        except Exception as e: # 예: 프로세스 풀이 종료된 경우
+            results[index].error = f"파일 처리 작업을 시작할 수 없습니다: {e}"
+
+    with tempfile.TemporaryDirectory(prefix="genx-upload-") as temp_dir:
+        pdf_paths = {}
+        counts = {} # future -> file_index
+        for index, ((name, mime_type, data), result) in enumerate(zip(files, results)):
+            if result.note or result.error:
+                continue
+            if mime_type == "application/pdf":
+                path = os.path.join(temp_dir, f"{index}.pdf")
+                with open(path, "wb") as f:
+                    f.write(data)
+                pdf_paths[index] = path
+                try:
+                    counts[executor.submit(pdf_page_count, path)] = index
+                except Exception as e:
+                    result.error = f"파일 처리 작업을 시작할 수 없습니다: {e}"
+            else:
+                submit(index, normalize_image, data, mime_type)
+        # 페이지 예산은 업로드 순서대로 나누므로 모든 PDF의 페이지 수를 먼저 확인합니다 (이미지는 그동안 계속 처리됨).
+        wait(counts)
+        for future, index in counts.items():
+            try:
+                results[index].total_pages = future.result()
+            except Exception as e:
+                results[index].error = f"PDF 파일을 열 수 없습니다: {e}"
+        remaining_pages = max_pages
+        for index in sorted(pdf_paths):
+            result = results[index]
+            if result.error:
+                continue
+            pages = plan_pdf_pages(result, remaining_pages, max_pages)
+            remaining_pages -= pages
+            for start in range(0, pages, PDF_PAGES_PER_TASK):
+                submit(index, render_pdf_pages, pdf_paths[index], start, min(start + PDF_PAGES_PER_TASK, pages))
+
+        pending = set(chunks)
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index, task_number = chunks[future]
+                result = results[index]
+                result.done_tasks += 1
+                try:
+                    output, seconds = future.result()
+                    outputs[index][task_number] = output
+                    result.work_seconds += seconds
+                except Exception as e:
+                    result.error = f"파일 처리 중 오류 발생: {e}"
+                if result.done:
+                    result.seconds = time.perf_counter() - started
+                if on_progress is not None:
+                    on_progress(index, result)
+    for result, file_outputs in zip(results, outputs):
+        if result.error:
+            result.parts = []
+            continue
+        for task_number in sorted(file_outputs):
+            output = file_outputs[task_number]
+            if result.mime_type == "application/pdf":
+                result.parts.extend(_inline_part("image/png", image) for image in output)
+                result.pages += len(output)
+            else:
+                result.parts.append(_inline_part(*output))
+    if metrics is not None:
+        metrics.incr("uploads.files", len(results))
+        metrics.incr("uploads.pages", sum(result.pages for result in results))
+        metrics.observe("uploads.batch_seconds", time.perf_counter() - started)
+        metrics.observe("uploads.work_seconds", sum(result.work_seconds for result in results))
+        for result in results:
+            if result.tasks and not result.error:
+                metrics.observe("uploads.file_seconds", result.seconds)
+    return results
+
+
+def combined_parts(results):
+    """All successfully processed parts, in upload order and page order."""
+    return [part for result in results for part in result.parts]